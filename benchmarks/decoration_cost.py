@@ -0,0 +1,61 @@
+"""Benchmark for the cost of decorating functions, which is paid at import time.
+
+A synthetic module with many functions is created, and every function is decorated
+with `@autometrics` before `init()` is called, the way a large app is imported. The
+numbers are the time per decorated function in microseconds.
+
+Usage:
+
+    poetry run python benchmarks/decoration_cost.py [--functions 3000]
+"""
+import argparse
+import sys
+import time
+import types
+
+from autometrics import autometrics
+
+
+def create_module(name: str, functions: int) -> types.ModuleType:
+    """Create a module with the given number of functions, registered in `sys.modules`."""
+    module = types.ModuleType(name)
+    sys.modules[name] = module
+    source = "\n".join(
+        f"def function_{index}():\n    '''Docstring of function {index}.'''\n"
+        for index in range(functions)
+    )
+    exec(compile(source, f"{name}.py", "exec"), module.__dict__)
+    return module
+
+
+def measure(functions: int, rounds: int) -> float:
+    """Measure the best time (in microseconds) to decorate a function."""
+    best = float("inf")
+    for round_index in range(rounds):
+        module = create_module(f"decoration_benchmark_{round_index}", functions)
+        to_decorate = [
+            getattr(module, f"function_{index}") for index in range(functions)
+        ]
+        start = time.perf_counter_ns()
+        for func in to_decorate:
+            autometrics(func)
+        best = min(best, (time.perf_counter_ns() - start) / functions / 1e3)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--functions", type=int, default=3000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    per_function = measure(args.functions, args.rounds)
+    print(f"functions per round: {args.functions}")
+    print(f"decoration: {per_function:.1f} us/function")
+    print(
+        f"total for {args.functions} functions: {per_function * args.functions / 1e3:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Micro-benchmark for the per-call overhead of the autometrics decorator.
+
+Every decorator configuration gets its own specialized wrapper, so each variant is
+measured separately, as well as a block tracked with `track()`. The numbers are the
+time per call in nanoseconds, with the cost of calling the undecorated function
+subtracted.
+
+Usage:
+
+    poetry run python benchmarks/decorator_overhead.py [--tracker prometheus] [--calls 100000] [--exemplars]
+
+With `--exemplars`, exemplars are enabled and the calls are made inside a sampled span.
+"""
+import argparse
+import asyncio
+import contextlib
+import time
+
+from autometrics import autometrics, init, track
+
+
+def noop():
+    pass
+
+
+async def async_noop():
+    pass
+
+
+VARIANTS = {
+    "plain": {},
+    "track_concurrency": {"track_concurrency": True},
+    "record_error_if": {"record_error_if": lambda result: False},
+    "record_success_if": {"record_success_if": lambda exception: False},
+    "sample_rate=0.1": {"sample_rate": 0.1},
+    "all options": {
+        "track_concurrency": True,
+        "record_error_if": lambda result: False,
+        "record_success_if": lambda exception: False,
+    },
+}
+
+
+def measure(func, calls: int) -> float:
+    """Measure the time per call (in ns) of a synchronous function."""
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            func()
+        best = min(best, (time.perf_counter_ns() - start) / calls)
+    return best
+
+
+def measure_async(func, calls: int) -> float:
+    """Measure the time per call (in ns) of an async function."""
+
+    async def run() -> float:
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter_ns()
+            for _ in range(calls):
+                await func()
+            best = min(best, (time.perf_counter_ns() - start) / calls)
+        return best
+
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tracker", default="opentelemetry")
+    parser.add_argument("--calls", type=int, default=100_000)
+    parser.add_argument("--exemplars", action="store_true")
+    args = parser.parse_args()
+
+    init(tracker=args.tracker, enable_exemplars=args.exemplars)
+    with span() if args.exemplars else contextlib.nullcontext():
+        run(args)
+
+
+def span():
+    """Start a sampled span, so the calls have a trace context to link exemplars to."""
+    # pylint: disable=import-outside-toplevel
+    from opentelemetry.sdk.trace import TracerProvider
+
+    return TracerProvider().get_tracer(__name__).start_as_current_span("benchmark")
+
+
+def run(args):
+    baseline = measure(noop, args.calls)
+    async_baseline = measure_async(async_noop, args.calls)
+    print(f"tracker: {args.tracker}, calls per round: {args.calls}")
+    print(f"{'variant':<20} {'sync ns/call':>14} {'async ns/call':>14}")
+    for name, options in VARIANTS.items():
+        sync_wrapped = autometrics(**options)(noop)
+        async_wrapped = autometrics(**options)(async_noop)
+        sync_ns = measure(sync_wrapped, args.calls) - baseline
+        async_ns = measure_async(async_wrapped, args.calls) - async_baseline
+        print(f"{name:<20} {sync_ns:>14.0f} {async_ns:>14.0f}")
+
+    block = track("noop_block")
+
+    def block_noop():
+        with block:
+            pass
+
+    async def async_block_noop():
+        async with block:
+            pass
+
+    sync_ns = measure(block_noop, args.calls) - baseline
+    async_ns = measure_async(async_block_noop, args.calls) - async_baseline
+    print(f"{'track() block':<20} {sync_ns:>14.0f} {async_ns:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,6 @@
 from .decorator import *
 from .initialization import init
+from .reload import update_settings, watch_settings
+from .slowlog import SlowCall, slow_calls
+from .sketch import quantiles
+from .slo import objective_status
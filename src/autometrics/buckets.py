@@ -0,0 +1,65 @@
+"""Histogram bucket layouts of single functions, see `@autometrics(buckets=...)`."""
+from math import isinf
+from typing import TYPE_CHECKING, Iterable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .objectives import Objective
+
+# The boundaries of the buckets derived from a latency threshold, as multiples of it.
+# They are finer around the threshold, where the latency objective is decided.
+OBJECTIVE_BUCKET_FACTORS = (
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    0.9,
+    1.0,
+    1.1,
+    1.25,
+    1.5,
+    2.0,
+    4.0,
+    10.0,
+)
+
+
+def validate_buckets(buckets: Iterable[float]) -> Tuple[float, ...]:
+    """Turn the boundaries of a bucket layout into sorted, unique floats.
+
+    The +Inf bucket is implied, so it is dropped if it is given."""
+    layout = tuple(sorted({float(bound) for bound in buckets if not isinf(bound)}))
+    if not layout:
+        raise ValueError("Histogram buckets should have at least one finite boundary.")
+    if layout[0] < 0.0:
+        raise ValueError(
+            f"Histogram bucket {layout[0]} is not supported, durations are not negative."
+        )
+    return layout
+
+
+def objective_buckets(threshold: float) -> Tuple[float, ...]:
+    """Derive a bucket layout from a latency threshold (in seconds).
+
+    The threshold is a boundary itself, so the calls that meet the objective are counted
+    exactly. The other boundaries are rounded to 6 significant digits."""
+    return tuple(
+        threshold if factor == 1.0 else float(f"{threshold * factor:.6g}")
+        for factor in OBJECTIVE_BUCKET_FACTORS
+    )
+
+
+def function_buckets(
+    objective: Optional["Objective"], buckets: Optional[Tuple[float, ...]] = None
+) -> Optional[Tuple[float, ...]]:
+    """Get the bucket layout of a function: its own, or the one of its objective.
+
+    The latency threshold of the objective is always a boundary, so the recording rules
+    that match `le` to the threshold find it in the buckets of the function as well. None
+    means that the function uses the histogram buckets of the settings."""
+    if objective is None:
+        return buckets
+    if buckets is None:
+        return objective.buckets
+    if objective.latency is not None:
+        return validate_buckets((*buckets, float(objective.latency[0].value)))
+    return buckets
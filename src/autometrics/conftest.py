@@ -9,13 +9,14 @@ def reset_environment(monkeypatch):
     import importlib
     import opentelemetry
     import prometheus_client
-    from . import initialization
+    from . import decorator, initialization
     from .tracker import tracker
 
     importlib.reload(opentelemetry)
     importlib.reload(prometheus_client)
     importlib.reload(initialization)
     importlib.reload(tracker)
+    decorator.set_track_callers(True)
     # we'll set debug to true to ensure calling init more than once will fail whole test
     monkeypatch.setenv("AUTOMETRICS_DEBUG", "true")
 
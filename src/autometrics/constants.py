@@ -5,25 +5,40 @@ SPEC_VERSION = "1.0.0"
 COUNTER_NAME = "function.calls"
 HISTOGRAM_NAME = "function.calls.duration"
 CONCURRENCY_NAME = "function.calls.concurrent"
+QUANTILES_NAME = "function.calls.duration.quantiles"
+OBJECTIVE_BURN_RATE_NAME = "objective.burn_rate"
+OBJECTIVE_BUDGET_NAME = "objective.error_budget_remaining"
 # NOTE - The Rust implementation does not use `build.info`, instead opts for just `build_info`
 BUILD_INFO_NAME = "build_info"
 SERVICE_NAME = "service.name"
 REPOSITORY_URL = "repository.url"
 REPOSITORY_PROVIDER = "repository.provider"
 AUTOMETRICS_VERSION = "autometrics.version"
+SAMPLE_RATE = "autometrics.sample_rate"
 
 
 COUNTER_NAME_PROMETHEUS = COUNTER_NAME.replace(".", "_")
 HISTOGRAM_NAME_PROMETHEUS = HISTOGRAM_NAME.replace(".", "_")
 CONCURRENCY_NAME_PROMETHEUS = CONCURRENCY_NAME.replace(".", "_")
+QUANTILES_NAME_PROMETHEUS = QUANTILES_NAME.replace(".", "_")
+OBJECTIVE_BURN_RATE_NAME_PROMETHEUS = OBJECTIVE_BURN_RATE_NAME.replace(".", "_")
+OBJECTIVE_BUDGET_NAME_PROMETHEUS = OBJECTIVE_BUDGET_NAME.replace(".", "_")
 SERVICE_NAME_PROMETHEUS = SERVICE_NAME.replace(".", "_")
 REPOSITORY_URL_PROMETHEUS = REPOSITORY_URL.replace(".", "_")
 REPOSITORY_PROVIDER_PROMETHEUS = REPOSITORY_PROVIDER.replace(".", "_")
 AUTOMETRICS_VERSION_PROMETHEUS = AUTOMETRICS_VERSION.replace(".", "_")
+SAMPLE_RATE_PROMETHEUS = SAMPLE_RATE.replace(".", "_")
 
 COUNTER_DESCRIPTION = "Autometrics counter for tracking function calls"
 HISTOGRAM_DESCRIPTION = "Autometrics histogram for tracking function call duration"
 CONCURRENCY_DESCRIPTION = "Autometrics gauge for tracking function call concurrency"
+QUANTILES_DESCRIPTION = (
+    "Autometrics summary for tracking quantiles of recent function call durations"
+)
+OBJECTIVE_BURN_RATE_DESCRIPTION = (
+    "Autometrics gauge for tracking the burn rates of objectives evaluated in-process"
+)
+OBJECTIVE_BUDGET_DESCRIPTION = "Autometrics gauge for tracking the remaining error budgets of objectives evaluated in-process"
 BUILD_INFO_DESCRIPTION = (
     "Autometrics info metric for tracking software version and build details"
 )
@@ -1,15 +1,36 @@
 """Autometrics module."""
-import time
 import inspect
+import sys
+import warnings
 
-from contextvars import ContextVar, Token
+from contextvars import ContextVar
 from functools import wraps
-from typing import overload, TypeVar, Callable, Optional, Awaitable, Union, Coroutine
+from random import random
+from time import perf_counter_ns
+from typing import (
+    overload,
+    Any,
+    Dict,
+    List,
+    Tuple,
+    TypeVar,
+    Callable,
+    Optional,
+    Awaitable,
+    Sequence,
+    Union,
+    Coroutine,
+)
 from typing_extensions import ParamSpec
 
+from .buckets import validate_buckets
 from .objectives import Objective
-from .tracker import get_tracker, Result
+from .sketch import QuantileOptions, QuantileSketch
+from .slowlog import SlowLog, SlowLogOptions
+from .tracker import BatchResult, FunctionHandle, Result
+from .settings import validate_sample_rate
 from .utils import (
+    get_frame_module_name,
     get_function_name,
     get_module_name,
     append_docs_to_docstring,
@@ -20,8 +41,230 @@ R = TypeVar("R")
 Y = TypeVar("Y")
 S = TypeVar("S")
 
-caller_module_var: ContextVar[str] = ContextVar("caller.module", default="")
-caller_function_var: ContextVar[str] = ContextVar("caller.function", default="")
+# The (module, function) of the decorated function that is currently running
+caller_var: ContextVar[Tuple[str, str]] = ContextVar("caller", default=("", ""))
+
+
+class _CallerPartVar:
+    """One part of `caller_var`, in place of the former `caller_module_var` and
+    `caller_function_var` context variables. Deprecated, use `caller_var`."""
+
+    def __init__(self, name: str, index: int):
+        self.name = name
+        self._index = index
+
+    def _warn(self):
+        warnings.warn(
+            f"{self.name} is deprecated, use caller_var, which holds a (module, function) tuple.",
+            DeprecationWarning,
+            stacklevel=3,
+        )
+
+    def get(self) -> str:
+        self._warn()
+        return caller_var.get()[self._index]
+
+    def set(self, value: str) -> "_CallerPartToken":
+        self._warn()
+        caller = caller_var.get()
+        token = _CallerPartToken(self, caller[self._index])
+        caller_var.set(self._replace(caller, value))
+        return token
+
+    def reset(self, token: "_CallerPartToken"):
+        """Restore the value this part had before `set`, leaving the other part as it
+        is now, so the parts can be reset in any order."""
+        self._warn()
+        if token.var is not self:
+            raise ValueError(f"{token!r} was created by a different variable")
+        if token.used:
+            raise RuntimeError(f"{token!r} has already been used once")
+        token.used = True
+        caller_var.set(self._replace(caller_var.get(), token.old_value))
+
+    def _replace(self, caller: Tuple[str, str], value: str) -> Tuple[str, str]:
+        if self._index == 0:
+            return (value, caller[1])
+        return (caller[0], value)
+
+
+class _CallerPartToken:
+    """The value a part of `caller_var` had before it was set, to restore it."""
+
+    __slots__ = ("var", "old_value", "used")
+
+    def __init__(self, var: _CallerPartVar, old_value: str):
+        self.var = var
+        self.old_value = old_value
+        self.used = False
+
+
+caller_module_var = _CallerPartVar("caller_module_var", 0)
+caller_function_var = _CallerPartVar("caller_function_var", 1)
+
+
+# The wrapper factories that were compiled, per combination of decorator options
+_wrapper_factories: Dict[Tuple[bool, bool, bool, bool, bool, bool, bool], Callable] = {}
+
+
+def no_caller() -> Tuple[str, str]:
+    """Get an empty caller, used instead of the current caller when callers are not tracked."""
+    return ("", "")
+
+
+# How the wrappers get the caller of a function, swapped when caller tracking is toggled
+_get_caller: Callable[[], Tuple[str, str]] = caller_var.get
+
+
+def set_track_callers(enabled: bool):
+    """Record the caller of every call, or record all calls without a caller.
+
+    The function that gets the caller is swapped in the globals of the compiled wrappers,
+    so the wrappers do not check the setting on every call."""
+    global _get_caller
+    _get_caller = caller_var.get if enabled else no_caller
+    for factory in _wrapper_factories.values():
+        factory.__globals__["get_caller"] = _get_caller
+
+
+def create_wrapper(
+    func: Callable,
+    handle: FunctionHandle,
+    callee: Tuple[str, str],
+    is_async: bool = False,
+    track_concurrency: Optional[bool] = False,
+    record_error_if: Optional[Callable[[Any], bool]] = None,
+    record_success_if: Optional[Callable[[Exception], bool]] = None,
+    sample_rate: Optional[float] = None,
+    slow_log: Optional[SlowLog] = None,
+    sketch: Optional[QuantileSketch] = None,
+) -> Callable:
+    """Create a wrapper that is specialized for the given decorator options.
+
+    Only the code for the enabled options ends up in the wrapper, so a call does not
+    pay for checking options that are not used. The code is compiled once per
+    combination of options, so decorating a function only creates a closure."""
+    # Without an explicit rate for the function, the rate from the settings
+    # is only known once the function is bound to a tracker.
+    sampled = sample_rate is None or sample_rate < 1.0
+    key = (
+        is_async,
+        bool(track_concurrency),
+        record_error_if is not None,
+        record_success_if is not None,
+        sampled,
+        slow_log is not None,
+        sketch is not None,
+    )
+    factory = _wrapper_factories.get(key)
+    if factory is None:
+        factory = _wrapper_factories.setdefault(key, compile_wrapper_factory(*key))
+    wrapper = factory(
+        func,
+        callee,
+        handle.metrics,
+        record_error_if,
+        record_success_if,
+        random,
+        slow_log,
+        sketch,
+    )
+    return wraps(func)(wrapper)
+
+
+def compile_wrapper_factory(
+    is_async: bool,
+    track_concurrency: bool,
+    record_error_if: bool,
+    record_success_if: bool,
+    sampled: bool,
+    slow_log: bool = False,
+    sketch: bool = False,
+) -> Callable:
+    """Generate and compile a function that creates wrappers for the given decorator options."""
+
+    def duration_lines(indent: str) -> List[str]:
+        """Generate the lines that pass a call slower than the threshold to the slow log,
+        and its duration to the quantile sketch."""
+        lines = []
+        if slow_log:
+            lines += [
+                f"{indent}if duration > slow_log.threshold:",
+                f"{indent}    slow_log.record(duration, metrics, args, kwds, caller_module, caller_function)",
+            ]
+        if sketch:
+            lines.append(f"{indent}sketch.observe(duration)")
+        return lines
+
+    def call_lines(indent: str, timed: bool) -> List[str]:
+        """Generate the lines that call the function and record its result."""
+        lines = []
+        if timed:
+            lines.append("start_time = perf_counter_ns()")
+        lines.append("try:")
+        if track_concurrency:
+            lines.append("    metrics.start()")
+        lines += [
+            f"    result = {'await ' if is_async else ''}func(*args, **kwds)",
+            "except Exception as exception:",
+        ]
+        if timed:
+            lines.append("    duration = (perf_counter_ns() - start_time) / 1e9")
+            lines += duration_lines("    ")
+        if record_success_if:
+            lines.append(
+                "    result_type = OK if record_success_if(exception) else ERROR"
+            )
+        else:
+            lines.append("    result_type = ERROR")
+        lines += [
+            f"    metrics.finish({'duration' if timed else 'None'}, caller_module, caller_function, result_type)",
+            "    raise",
+            "finally:",
+            "    reset_caller(token)",
+        ]
+        if timed:
+            lines.append("duration = (perf_counter_ns() - start_time) / 1e9")
+            lines += duration_lines("")
+        if record_error_if:
+            lines.append("result_type = ERROR if record_error_if(result) else OK")
+        else:
+            lines.append("result_type = OK")
+        lines += [
+            f"metrics.finish({'duration' if timed else 'None'}, caller_module, caller_function, result_type)",
+            "return result",
+        ]
+        return [f"{indent}{line}" for line in lines]
+
+    lines: List[str] = [
+        f"{'async ' if is_async else ''}def wrapper(*args, **kwds):",
+        "    caller_module, caller_function = get_caller()",
+        "    metrics = get_metrics()",
+        "    token = set_caller(callee)",
+    ]
+    if sampled:
+        lines += [
+            "    sample_rate = metrics.sample_rate",
+            "    if sample_rate < 1.0 and random() >= sample_rate:",
+            *call_lines("        ", timed=False),
+        ]
+    lines += call_lines("    ", timed=True)
+    lines = [
+        "def create(func, callee, get_metrics, record_error_if, record_success_if, random, slow_log, sketch):",
+        *[f"    {line}" for line in lines],
+        "    return wrapper",
+    ]
+
+    namespace: Dict[str, Any] = {
+        "get_caller": _get_caller,
+        "set_caller": caller_var.set,
+        "reset_caller": caller_var.reset,
+        "perf_counter_ns": perf_counter_ns,
+        "OK": Result.OK,
+        "ERROR": Result.ERROR,
+    }
+    exec(compile("\n".join(lines), "<autometrics wrapper>", "exec"), namespace)
+    return namespace["create"]
 
 
 # Decorator with arguments (where decorated function returns an awaitable)
@@ -33,6 +276,10 @@ def autometrics(
     track_concurrency: Optional[bool] = False,
     record_error_if: Callable[[R], bool],
     record_success_if: Optional[Callable[[Exception], bool]] = None,
+    sample_rate: Optional[float] = None,
+    slow_log: Union[bool, SlowLogOptions] = False,
+    buckets: Optional[Sequence[float]] = None,
+    quantiles: Union[bool, QuantileOptions] = False,
 ) -> Union[
     Callable[
         [Callable[Params, Coroutine[Y, S, R]]], Callable[Params, Coroutine[Y, S, R]]
@@ -50,6 +297,10 @@ def autometrics(
     objective: Optional[Objective] = None,
     track_concurrency: Optional[bool] = False,
     record_success_if: Optional[Callable[[Exception], bool]] = None,
+    sample_rate: Optional[float] = None,
+    slow_log: Union[bool, SlowLogOptions] = False,
+    buckets: Optional[Sequence[float]] = None,
+    quantiles: Union[bool, QuantileOptions] = False,
 ) -> Callable[[Callable[Params, R]], Callable[Params, R]]:
     ...
 
@@ -69,201 +320,101 @@ def autometrics(
     track_concurrency=None,
     record_error_if=None,
     record_success_if=None,
+    sample_rate=None,
+    slow_log=False,
+    buckets=None,
+    quantiles=False,
 ):
-    """Decorator for tracking function calls and duration. Supports synchronous and async functions."""
-
-    def register_function_info(
-        function: str,
-        module: str,
-    ):
-        get_tracker().initialize_counters(
-            function=function, module=module, objective=objective
-        )
+    """Decorator for tracking function calls and duration. Supports synchronous and async functions.
 
-    def track_start(function: str, module: str):
-        get_tracker().start(
-            function=function, module=module, track_concurrency=track_concurrency
-        )
+    With `slow_log`, the calls that are slower than the latency threshold of the objective
+    (or a multiple of the p99 of the function) are recorded with their arguments and
+    caller, see `slow_calls`. It takes `True` or the `SlowLogOptions`.
+
+    With `buckets`, the latency histogram of the function has buckets of its own (in
+    seconds), instead of the buckets of its objective or of the settings.
 
-    def track_result_ok(
-        duration: float,
-        function: str,
-        module: str,
-        caller_module: str,
-        caller_function: str,
-    ):
-        get_tracker().finish(
-            duration,
-            function=function,
-            module=module,
-            caller_module=caller_module,
-            caller_function=caller_function,
+    With `quantiles`, the durations of the function also go into a streaming sketch, so
+    the quantiles of its recent calls can be queried in-process (see `quantiles`) and are
+    exported as a summary. It takes `True` or the `QuantileOptions`."""
+
+    if sample_rate is not None:
+        validate_sample_rate(sample_rate)
+    layout = None if buckets is None else validate_buckets(buckets)
+
+    def decorate(func, is_async: bool):
+        """Helper for decorating functions, to track calls and duration."""
+
+        module_name = get_module_name(func)
+        func_name = get_function_name(func)
+        handle = FunctionHandle(
+            function=func_name,
+            module=module_name,
             objective=objective,
             track_concurrency=track_concurrency,
-            result=Result.OK,
+            sample_rate=sample_rate,
+            buckets=layout,
         )
 
-    def track_result_error(
-        duration: float,
-        function: str,
-        module: str,
-        caller_module: str,
-        caller_function: str,
-    ):
-        get_tracker().finish(
-            duration,
-            function=function,
-            module=module,
-            caller_module=caller_module,
-            caller_function=caller_function,
-            objective=objective,
+        function_slow_log = None
+        if slow_log:
+            function_slow_log = SlowLog(
+                func_name,
+                module_name,
+                objective,
+                **({} if slow_log is True else slow_log),
+            )
+
+        function_sketch = None
+        if quantiles:
+            function_sketch = QuantileSketch(
+                func_name,
+                module_name,
+                **({} if quantiles is True else quantiles),
+            )
+
+        wrapper = create_wrapper(
+            func,
+            handle,
+            (module_name, func_name),
+            is_async=is_async,
             track_concurrency=track_concurrency,
-            result=Result.ERROR,
+            record_error_if=record_error_if,
+            record_success_if=record_success_if,
+            sample_rate=sample_rate,
+            slow_log=function_slow_log,
+            sketch=function_sketch,
         )
-
-    def sync_decorator(func: Callable[Params, R]) -> Callable[Params, R]:
+        wrapper.__doc__ = append_docs_to_docstring(func, func_name, module_name)
+        wrapper._autometrics_handle = handle  # type: ignore
+        # A batch does not start any calls, so it should not finish them
+        wrapper._autometrics_batch_handle = (  # type: ignore
+            FunctionHandle(
+                function=func_name,
+                module=module_name,
+                objective=objective,
+                sample_rate=sample_rate,
+                buckets=layout,
+            )
+            if track_concurrency
+            else handle
+        )
+        if function_slow_log is not None:
+            wrapper._autometrics_slow_log = function_slow_log  # type: ignore
+        if function_sketch is not None:
+            wrapper._autometrics_quantiles = function_sketch  # type: ignore
+        return wrapper
+
+    # The annotations of the helpers are strings, so they are not evaluated for every decoration
+    def sync_decorator(func: "Callable[Params, R]") -> "Callable[Params, R]":
         """Helper for decorating synchronous functions, to track calls and duration."""
-
-        module_name = get_module_name(func)
-        func_name = get_function_name(func)
-        register_function_info(func_name, module_name)
-
-        @wraps(func)
-        def sync_wrapper(*args: Params.args, **kwds: Params.kwargs) -> R:
-            caller_module = caller_module_var.get()
-            caller_function = caller_function_var.get()
-            context_token_module: Optional[Token] = None
-            context_token_function: Optional[Token] = None
-            start_time = time.time()
-
-            try:
-                context_token_module = caller_module_var.set(module_name)
-                context_token_function = caller_function_var.set(func_name)
-                if track_concurrency:
-                    track_start(module=module_name, function=func_name)
-                result = func(*args, **kwds)
-                duration = time.time() - start_time
-                if record_error_if and record_error_if(result):
-                    track_result_error(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-                else:
-                    track_result_ok(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-
-            except Exception as exception:
-                duration = time.time() - start_time
-                if record_success_if and record_success_if(exception):
-                    track_result_ok(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-                else:
-                    track_result_error(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-                # Reraise exception
-                raise exception
-
-            finally:
-                if context_token_module is not None:
-                    caller_module_var.reset(context_token_module)
-                if context_token_function is not None:
-                    caller_function_var.reset(context_token_function)
-
-            return result
-
-        sync_wrapper.__doc__ = append_docs_to_docstring(func, func_name, module_name)
-        return sync_wrapper
+        return decorate(func, is_async=False)
 
     def async_decorator(
-        func: Callable[Params, Awaitable[R]]
-    ) -> Callable[Params, Awaitable[R]]:
+        func: "Callable[Params, Awaitable[R]]",
+    ) -> "Callable[Params, Awaitable[R]]":
         """Helper for decorating async functions, to track calls and duration."""
-
-        module_name = get_module_name(func)
-        func_name = get_function_name(func)
-        register_function_info(func_name, module_name)
-
-        @wraps(func)
-        async def async_wrapper(*args: Params.args, **kwds: Params.kwargs) -> R:
-            caller_module = caller_module_var.get()
-            caller_function = caller_function_var.get()
-            context_token_module: Optional[Token] = None
-            context_token_function: Optional[Token] = None
-            start_time = time.time()
-
-            try:
-                context_token_module = caller_module_var.set(module_name)
-                context_token_function = caller_function_var.set(func_name)
-                if track_concurrency:
-                    track_start(module=module_name, function=func_name)
-                result = await func(*args, **kwds)
-                duration = time.time() - start_time
-                if record_error_if and record_error_if(result):
-                    track_result_error(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-                else:
-                    track_result_ok(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-
-            except Exception as exception:
-                duration = time.time() - start_time
-                if record_success_if and record_success_if(exception):
-                    track_result_ok(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-                else:
-                    track_result_error(
-                        duration,
-                        function=func_name,
-                        module=module_name,
-                        caller_module=caller_module,
-                        caller_function=caller_function,
-                    )
-                # Reraise exception
-                raise exception
-
-            finally:
-                if context_token_module is not None:
-                    caller_module_var.reset(context_token_module)
-                if context_token_function is not None:
-                    caller_function_var.reset(context_token_function)
-
-            return result
-
-        async_wrapper.__doc__ = append_docs_to_docstring(func, func_name, module_name)
-        return async_wrapper
+        return decorate(func, is_async=True)
 
     def pick_decorator(func):
         """Pick the correct decorator based on the function type."""
@@ -277,3 +428,131 @@ def autometrics(
         return async_decorator(func)
     else:
         return sync_decorator(func)
+
+
+def observe_many(
+    func: Callable,
+    durations: Sequence[Optional[float]],
+    results: Optional[Sequence[BatchResult]] = None,
+):
+    """Record a batch of calls (or items processed) for a function at once.
+
+    The calls are recorded with the same labels as the calls to the function itself,
+    using the current caller. `durations` holds the duration of every call in seconds
+    (None, or NaN in a NumPy array, when it was not timed), and `results` holds their
+    results, either as `Result` values or as booleans that are true for a success.
+    Without results, all the calls succeeded. NumPy arrays are recorded without
+    iterating over them in Python."""
+    handle: Optional[FunctionHandle] = getattr(func, "_autometrics_batch_handle", None)
+    if handle is None:
+        handle = FunctionHandle(
+            function=get_function_name(func), module=get_module_name(func)
+        )
+    caller_module, caller_function = _get_caller()
+    handle.metrics().finish_many(durations, caller_module, caller_function, results)
+
+
+# The tracked blocks that are running in the current context, as a linked stack of
+# (metrics, caller, caller token, start time or None when not sampled, previous entry)
+_block_var: ContextVar[Optional[Tuple[Any, ...]]] = ContextVar("block", default=None)
+
+
+class TrackedBlock:
+    """A block of code that is tracked like a call to a decorated function.
+
+    The block can be entered any number of times, from any thread or task, with `with`
+    or `async with`. Its metrics are resolved once, when the block is created."""
+
+    __slots__ = ("handle", "callee")
+
+    def __init__(self, handle: FunctionHandle):
+        self.handle = handle
+        self.callee = (handle.module, handle.function)
+
+    def __enter__(self) -> "TrackedBlock":
+        caller = _get_caller()
+        metrics = self.handle.metrics()
+        if self.handle.track_concurrency:
+            metrics.start()
+        token = caller_var.set(self.callee)
+        sample_rate = metrics.sample_rate
+        start_time = (
+            None if sample_rate < 1.0 and random() >= sample_rate else perf_counter_ns()
+        )
+        _block_var.set((metrics, caller, token, start_time, _block_var.get()))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        end_time = perf_counter_ns()
+        metrics, caller, token, start_time, previous = _block_var.get()  # type: ignore
+        _block_var.set(previous)
+        caller_var.reset(token)
+        duration = None if start_time is None else (end_time - start_time) / 1e9
+        result = Result.OK if exc_type is None else Result.ERROR
+        metrics.finish(duration, caller[0], caller[1], result)
+
+    async def __aenter__(self) -> "TrackedBlock":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        self.__exit__(exc_type, exc_value, traceback)
+
+
+_blocks: Dict[
+    Tuple[
+        str,
+        str,
+        Optional[Objective],
+        bool,
+        Optional[float],
+        Optional[Tuple[float, ...]],
+    ],
+    TrackedBlock,
+] = {}
+
+
+def track(
+    name: str,
+    module: Optional[str] = None,
+    objective: Optional[Objective] = None,
+    track_concurrency: bool = False,
+    sample_rate: Optional[float] = None,
+    buckets: Optional[Sequence[float]] = None,
+) -> TrackedBlock:
+    """Track a block of code like a call to a function with the given name.
+
+    The block is recorded with the same metrics as a decorated function, and functions
+    called inside of it see it as their caller. Without a module, the module of the code
+    calling `track` is used. With `buckets`, the latency histogram of the block has
+    buckets of its own, like with `@autometrics(buckets=...)`. To skip even the lookup
+    of the block, create it once (e.g. at module level) and enter it as often as needed:
+
+        parse_block = track("parse")
+
+        with parse_block:
+            ...
+    """
+    if module is None:
+        module = get_frame_module_name(sys._getframe(1))
+    layout = None if buckets is None else tuple(buckets)
+    key = (name, module, objective, track_concurrency, sample_rate, layout)
+    block = _blocks.get(key)
+    if block is None:
+        if sample_rate is not None:
+            validate_sample_rate(sample_rate)
+        if layout is not None:
+            layout = validate_buckets(layout)
+        block = _blocks.setdefault(
+            key,
+            TrackedBlock(
+                FunctionHandle(
+                    function=name,
+                    module=module,
+                    objective=objective,
+                    track_concurrency=track_concurrency,
+                    sample_rate=sample_rate,
+                    buckets=layout,
+                )
+            ),
+        )
+    return block
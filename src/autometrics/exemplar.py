@@ -1,17 +1,120 @@
+import threading
+
+from heapq import heappush, heapreplace
+from itertools import count
+from typing import Dict, Generic, Iterator, List, Mapping, Optional, Tuple, TypeVar
+
 from opentelemetry import trace
+from opentelemetry.context import Context
 
+EXEMPLAR_REFRESH_INTERVAL = 1.0
+"""The minimum time (in seconds) before the exemplar of a series is replaced.
 
-def get_exemplar():
-    """Generates an exemplar dictionary from the current implicit OTel context if available"""
-    span_context = trace.get_current_span().get_span_context()
+Until then, calls that would replace it skip looking up the trace context."""
 
-    # Only include the exemplar if it is valid and sampled
-    if span_context.is_valid and span_context.trace_flags.sampled:
-        # You must set the trace_id and span_id exemplar labels like this to link OTel and
-        # Prometheus. They must be formatted as hexadecimal strings.
-        return {
-            "trace_id": trace.format_trace_id(span_context.trace_id),
-            "span_id": trace.format_span_id(span_context.span_id),
-        }
+DEFAULT_TAIL_EXEMPLARS = 5
+"""The number of slowest calls kept per series by a tail exemplar reservoir, unless
+`exemplar_reservoir_size` is set."""
+
+T = TypeVar("T")
 
+
+def get_trace_context(context: Optional[Context] = None) -> Optional[Tuple[int, int]]:
+    """Get the trace and span id of the current span (or the span of the given context),
+    if it is valid and sampled."""
+    span_context = trace.get_current_span(context).get_span_context()
+    if span_context.is_valid and span_context.trace_flags.sampled:
+        return span_context.trace_id, span_context.span_id
     return None
+
+
+class ExemplarLabels(Mapping[str, str]):
+    """The labels of an exemplar, linking it to a trace.
+
+    The trace and span ids are kept as integers, and only formatted as the hexadecimal
+    strings that link OTel and Prometheus when the labels are read (at scrape time)."""
+
+    __slots__ = ("trace_id", "span_id", "_labels")
+
+    def __init__(self, trace_id: int, span_id: int):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self._labels: Optional[Dict[str, str]] = None
+
+    def _format(self) -> Dict[str, str]:
+        labels = self._labels
+        if labels is None:
+            labels = self._labels = {
+                "trace_id": trace.format_trace_id(self.trace_id),
+                "span_id": trace.format_span_id(self.span_id),
+            }
+        return labels
+
+    def __getitem__(self, key: str) -> str:
+        return self._format()[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(("trace_id", "span_id"))
+
+    def __len__(self) -> int:
+        return 2
+
+    def __repr__(self) -> str:
+        return f"ExemplarLabels({self._format()!r})"
+
+
+def get_exemplar() -> Optional[Mapping[str, str]]:
+    """Get the labels of an exemplar from the current implicit OTel context, if available"""
+    trace_context = get_trace_context()
+    if trace_context is None:
+        return None
+    return ExemplarLabels(*trace_context)
+
+
+class TailExemplarReservoir(Generic[T]):
+    """Keeps the exemplars of the slowest calls of a series, and of its most recent error.
+
+    The slowest calls are kept in a min-heap of (at most) `size` entries, so a call that
+    is slower than the fastest one kept replaces it in O(log size). `accepts` is a cheap
+    check (without a lock) that callers make before looking up the trace context, so
+    ordinary calls cost a comparison once the reservoir is full. `collect` returns the
+    exemplars and starts a new interval."""
+
+    __slots__ = ("size", "_slowest", "_error", "_sequence", "_lock")
+
+    def __init__(self, size: int = DEFAULT_TAIL_EXEMPLARS):
+        self.size = size
+        self._slowest: List[Tuple[float, int, T]] = []
+        self._error: Optional[T] = None
+        # Breaks ties between calls that took as long, the exemplars are not compared
+        self._sequence = count()
+        self._lock = threading.Lock()
+
+    def accepts(self, value: float, error: bool = False) -> bool:
+        """Check if a call would be kept, before its exemplar is built."""
+        if error:
+            return True
+        slowest = self._slowest
+        return len(slowest) < self.size or value > slowest[0][0]
+
+    def add(self, value: float, exemplar: T, error: bool = False):
+        """Keep the exemplar of a call, if it is one of the slowest (or an error)."""
+        with self._lock:
+            if error:
+                self._error = exemplar
+            slowest = self._slowest
+            entry = (value, next(self._sequence), exemplar)
+            if len(slowest) < self.size:
+                heappush(slowest, entry)
+            elif value > slowest[0][0]:
+                heapreplace(slowest, entry)
+
+    def collect(self) -> Tuple[List[T], Optional[T]]:
+        """Get the exemplars of the slowest calls (slowest first) and of the most recent
+        error since the last collection, and reset the reservoir."""
+        with self._lock:
+            slowest, error = self._slowest, self._error
+            self._slowest = []
+            self._error = None
+        slowest.sort(reverse=True)
+        return [exemplar for _, _, exemplar in slowest], error
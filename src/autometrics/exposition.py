@@ -1,14 +1,18 @@
+import logging
+import os
+
 from opentelemetry.sdk.metrics.export import (
     AggregationTemporality,
     MetricReader,
     PeriodicExportingMetricReader,
 )
-from opentelemetry.exporter.prometheus import PrometheusMetricReader
 from prometheus_client import start_http_server
 from pydantic import ConfigDict, TypeAdapter
 from typing import Dict, Literal, Optional, Union
 from typing_extensions import TypedDict
 
+from .tracker.opentelemetry import PrometheusExemplarReader
+
 # GRPC is optional so we'll only type it if it's available
 try:
     from grpc import ChannelCredentials  # type: ignore
@@ -99,15 +103,31 @@ ExporterOptions = Union[
 ]
 
 
-def create_exporter(config: ExporterOptions) -> Optional[MetricReader]:
-    """Create an exporter based on the configuration."""
+def create_exporter(
+    config: ExporterOptions, forked: bool = False
+) -> Optional[MetricReader]:
+    """Create an exporter based on the configuration.
+
+    In a forked process, the port of the Prometheus exporter can already be taken by the
+    parent or another worker, in which case this process does not serve its metrics. A
+    custom exporter instance cannot be reused in a forked process, so it is not created.
+    """
     if config["type"] == "prometheus":
         config = PrometheusValidator.validate_python(config)
-        start_http_server(
-            config.get("port", 9464),
-            config.get("address", "0.0.0.0"),
-        )
-        return PrometheusMetricReader()
+        try:
+            start_http_server(
+                config.get("port", 9464),
+                config.get("address", "0.0.0.0"),
+            )
+        except OSError:
+            if not forked:
+                raise
+            logging.warning(
+                "Port %s is already in use, the metrics of process %s are not served by the exporter.",
+                config.get("port", 9464),
+                os.getpid(),
+            )
+        return PrometheusExemplarReader()
     if config["type"] == "otlp-proto-http":
         config = OtlpHttpExporterValidator.validate_python(config)
         try:
@@ -154,6 +174,13 @@ def create_exporter(config: ExporterOptions) -> Optional[MetricReader]:
             raise ImportError("OTLP exporter (GRPC) not installed")
     if config["type"] == "otel-custom":
         config = OtelCustomValidator.validate_python(config)
+        if forked:
+            # A reader can only be registered with one meter provider
+            logging.warning(
+                "A custom exporter cannot be created again in a forked process, the metrics of process %s are exposed with the default reader.",
+                os.getpid(),
+            )
+            return None
         return config.get("exporter", None)
     else:
         raise ValueError("Invalid exporter type")
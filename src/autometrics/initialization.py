@@ -4,7 +4,8 @@ import os
 from typing_extensions import Unpack
 
 
-from .tracker import init_tracker, get_tracker
+from .decorator import set_track_callers
+from .tracker import init_tracker, get_tracker, preload_tracker
 from .tracker.temporary import TemporaryTracker
 from .settings import AutometricsOptions, init_settings
 
@@ -34,5 +35,10 @@ def init(**kwargs: Unpack[AutometricsOptions]):
             logging.warn(f"{NOT_TEMP_TRACKER_ERROR} This init() call will be ignored.")
             return
     settings = init_settings(**kwargs)
-    tracker = init_tracker(settings["tracker"], settings)
-    temp_tracker.replay_queue(tracker)
+    set_track_callers(settings.track_callers)
+    if settings.preload:
+        # The tracker is created in every worker that is forked from this process
+        preload_tracker(settings)
+        return
+    tracker = init_tracker(settings.tracker, settings)
+    temp_tracker.replay(tracker)
@@ -2,7 +2,12 @@ import logging
 
 from enum import Enum
 from re import match
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Optional, Sequence, Tuple, Union
+
+from .buckets import objective_buckets, validate_buckets
+
+if TYPE_CHECKING:
+    from .slo import EvaluationOptions, ObjectiveEvaluator
 
 
 class ObjectivePercentile(Enum):
@@ -65,6 +70,12 @@ class ObjectiveLatency(Enum):
 #
 # By default, these recording rules will effectively lay dormant.
 # However, they are enabled when the special labels are present on certain metrics.
+#
+# The latency histograms of the functions of an objective with a latency threshold get
+# buckets of their own, with the threshold as a boundary and finer buckets around it.
+#
+# With `evaluate=True`, the objective is also evaluated in-process: its burn rates and
+# remaining error budgets are available from `objective_status` and exported as gauges.
 class Objective:
     """A Service-Level Objective (SLO) for a function or group of functions."""
 
@@ -76,12 +87,23 @@ class Objective:
     This means that the function or group of functions that are part of this objective
     should return an `Ok` result at least this percentage of the time."""
     latency: Optional[Tuple[ObjectiveLatency, ObjectivePercentile]]
+    buckets: Optional[Tuple[float, ...]]
+    """The boundaries of the latency histogram buckets of the functions of this objective.
+
+    Unless they are given, they are derived from the latency threshold. The threshold is
+    always one of the boundaries. Without a latency threshold, the functions use the
+    histogram buckets of the settings."""
+    evaluator: Optional["ObjectiveEvaluator"]
+    """Counts the calls of the functions of this objective in windows, when it is
+    evaluated in-process."""
 
     def __init__(
         self,
         name: str,
         success_rate: Optional[ObjectivePercentile] = None,
         latency: Optional[Tuple[ObjectiveLatency, ObjectivePercentile]] = None,
+        buckets: Optional[Sequence[float]] = None,
+        evaluate: Union[bool, "EvaluationOptions"] = False,
     ):
         """Create a new objective with the given name.
 
@@ -92,6 +114,22 @@ class Objective:
         self.name = name
         self.success_rate = success_rate
         self.latency = latency
+        if buckets is not None:
+            # The latency threshold is always a boundary, see `function_buckets`
+            threshold = () if latency is None else (float(latency[0].value),)
+            self.buckets = validate_buckets((*buckets, *threshold))
+        elif latency is not None:
+            self.buckets = objective_buckets(float(latency[0].value))
+        else:
+            self.buckets = None
+        self.evaluator = None
+        if evaluate:
+            # pylint: disable=import-outside-toplevel
+            from .slo import ObjectiveEvaluator
+
+            self.evaluator = ObjectiveEvaluator(
+                self, **({} if evaluate is True else evaluate)
+            )
 
         # Check that name only contains alphanumeric characters and hyphens
         if match(r"^[\w-]+$", name) is None:
@@ -1,10 +1,22 @@
 import urllib.parse
 import os
-from typing import Optional
-from dotenv import load_dotenv
+from functools import lru_cache
+from string import Formatter
+from typing import Dict, Optional
 
 ADD_BUILD_INFO_LABELS = "* on (instance, job) group_left(version, commit) (last_over_time(build_info[1s]) or on (instance, job) up)"
 
+REQUEST_RATE_QUERY = f'sum by (function, module, commit, version) (rate (function_calls_count_total{{{{function="{{function}}",module="{{module}}"}}}}[5m]) {ADD_BUILD_INFO_LABELS})'
+LATENCY_QUERY = f'sum by (le, function, module, commit, version) (rate(function_calls_duration_bucket{{{{function="{{function}}",module="{{module}}"}}}}[5m]) {ADD_BUILD_INFO_LABELS})'
+ERROR_RATIO_QUERY = f'sum by (function, module, commit, version) (rate (function_calls_count_total{{{{function="{{function}}",module="{{module}}", result="error"}}}}[5m]) {ADD_BUILD_INFO_LABELS}) / {REQUEST_RATE_QUERY}'
+
+# Format strings with `function` and `module` fields
+QUERIES = {
+    "Request rate URL": REQUEST_RATE_QUERY,
+    "Latency URL": LATENCY_QUERY,
+    "Error Ratio URL": ERROR_RATIO_QUERY,
+}
+
 
 def cleanup_url(url: str) -> str:
     """Remove the trailing slash if there is one."""
@@ -13,13 +25,41 @@ def cleanup_url(url: str) -> str:
     return url
 
 
+@lru_cache(maxsize=None)
+def load_env():
+    """Load the `.env` file into the environment, only once per process."""
+    # pylint: disable=import-outside-toplevel
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+
+def quote_format_string(format_string: str) -> str:
+    """URL-encode the literal text of a format string, keeping its fields.
+
+    Encoding works character by character, so filling in the encoded fields gives the
+    same result as encoding the formatted string."""
+    quoted = []
+    for literal_text, field_name, _, _ in Formatter().parse(format_string):
+        quoted.append(urllib.parse.quote(literal_text))
+        if field_name is not None:
+            quoted.append(f"{{{field_name}}}")
+    return "".join(quoted)
+
+
+@lru_cache(maxsize=None)
+def quoted_queries() -> Dict[str, str]:
+    """Get the URL-encoded queries, as format strings with `function` and `module` fields."""
+    return {name: quote_format_string(query) for name, query in QUERIES.items()}
+
+
 class Generator:
     """Generate prometheus query urls for a given function/module."""
 
     def __init__(
         self, function_name: str, module_name: str, base_url: Optional[str] = None
     ):
-        load_dotenv()
+        load_env()
         self.function_name = function_name
         self.module_name = module_name
 
@@ -28,23 +68,13 @@ class Generator:
 
     def create_urls(self):
         """Create the prometheus query urls for the function and module."""
-        request_rate_query = f'sum by (function, module, commit, version) (rate (function_calls_count_total{{function="{self.function_name}",module="{self.module_name}"}}[5m]) {ADD_BUILD_INFO_LABELS})'
-        latency_query = f'sum by (le, function, module, commit, version) (rate(function_calls_duration_bucket{{function="{self.function_name}",module="{self.module_name}"}}[5m]) {ADD_BUILD_INFO_LABELS})'
-        error_ratio_query = f'sum by (function, module, commit, version) (rate (function_calls_count_total{{function="{self.function_name}",module="{self.module_name}", result="error"}}[5m]) {ADD_BUILD_INFO_LABELS}) / {request_rate_query}'
-
-        queries = {
-            "Request rate URL": request_rate_query,
-            "Latency URL": latency_query,
-            "Error Ratio URL": error_ratio_query,
+        function = urllib.parse.quote(self.function_name)
+        module = urllib.parse.quote(self.module_name)
+        return {
+            name: f"{self.base_url}/graph?g0.expr={query.format(function=function, module=module)}&g0.tab=0"
+            for name, query in quoted_queries().items()
         }
 
-        urls = {}
-        for [name, query] in queries.items():
-            # for query in queries:
-            generated_url = self.create_prometheus_url(query)
-            urls[name] = generated_url
-        return urls
-
     def create_prometheus_url(self, query: str):
         """Create a the full query url for a given query."""
         encoded_query = urllib.parse.quote(query)
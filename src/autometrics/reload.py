@@ -0,0 +1,154 @@
+import logging
+import os
+import signal
+import threading
+
+from typing import Any, Optional
+from typing_extensions import Unpack
+
+from .decorator import set_track_callers
+from .settings import (
+    RUNTIME_SETTINGS,
+    RuntimeOptions,
+    SettingsSnapshot,
+    get_settings,
+    set_settings,
+)
+from .tracker import apply_settings
+
+_lock = threading.Lock()
+
+
+def update_settings(**changes: Unpack[RuntimeOptions]) -> SettingsSnapshot:
+    """Change settings while the app is running.
+
+    Exemplars (`enable_exemplars`), the sample rate (`sample_rate`) and caller tracking
+    (`track_callers`) can be changed after `init()`. The settings are swapped for a new
+    snapshot in one go, and the tracker and decorated functions pick it up. Functions
+    that were decorated with a sample rate of their own keep it."""
+    unsupported = set(changes) - set(RUNTIME_SETTINGS)
+    if unsupported:
+        raise ValueError(
+            f"Settings {', '.join(sorted(unsupported))} cannot be changed at runtime, only {', '.join(RUNTIME_SETTINGS)} can."
+        )
+    with _lock:
+        settings = get_settings().replace(**changes)
+        set_settings(settings)
+        apply_settings(settings)
+        set_track_callers(settings.track_callers)
+    return settings
+
+
+def read_settings_file(path: str) -> RuntimeOptions:
+    """Read the settings that can be changed at runtime from a file.
+
+    The file has the same variables as the environment (AUTOMETRICS_EXEMPLARS,
+    AUTOMETRICS_SAMPLE_RATE and AUTOMETRICS_TRACK_CALLERS), in the format of a `.env`
+    file. Variables that are not in the file are not changed."""
+    # pylint: disable=import-outside-toplevel
+    from dotenv import dotenv_values
+
+    values = dotenv_values(path)
+    options: RuntimeOptions = {}
+    if values.get("AUTOMETRICS_EXEMPLARS") is not None:
+        options["enable_exemplars"] = values["AUTOMETRICS_EXEMPLARS"] == "true"
+    if values.get("AUTOMETRICS_SAMPLE_RATE") is not None:
+        options["sample_rate"] = float(values["AUTOMETRICS_SAMPLE_RATE"])  # type: ignore
+    if values.get("AUTOMETRICS_TRACK_CALLERS") is not None:
+        options["track_callers"] = values["AUTOMETRICS_TRACK_CALLERS"] != "false"
+    return options
+
+
+def reload_settings(path: str) -> SettingsSnapshot:
+    """Apply the settings from a file, see `read_settings_file`."""
+    return update_settings(**read_settings_file(path))
+
+
+class SettingsWatcher:
+    """Reloads the settings from a file when it changes, or when the process gets a signal.
+
+    The file is checked for changes every `interval` seconds, on a background thread.
+    Without an interval, the file is only read when the signal (e.g. `signal.SIGHUP`) is
+    received. The settings are applied on the background thread in both cases."""
+
+    def __init__(
+        self,
+        path: str,
+        interval: Optional[float] = 5.0,
+        signum: Optional[int] = None,
+    ):
+        self.path = path
+        self.interval = interval
+        self.signum = signum
+        self._mtime: Optional[int] = None
+        self._reload_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._previous_handler: Any = None
+
+    def check(self) -> bool:
+        """Reload the settings if the file changed since it was last read."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        reload_settings(self.path)
+        return True
+
+    def start(self):
+        """Apply the settings from the file, and start watching it."""
+        if self._thread is not None:
+            return
+        self.check()
+        self._stop_event.clear()
+        if self.signum is not None:
+            self._previous_handler = signal.signal(self.signum, self._on_signal)
+        self._thread = threading.Thread(
+            target=self._run, name="autometrics-settings-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching the file."""
+        self._stop_event.set()
+        self._reload_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.signum is not None:
+            signal.signal(self.signum, self._previous_handler or signal.SIG_DFL)
+
+    def _on_signal(self, signum, frame):
+        # Applying the settings takes locks that the interrupted code could be holding,
+        # so the settings are reloaded on the background thread
+        self._reload_event.set()
+
+    def _run(self):
+        while True:
+            signalled = self._reload_event.wait(self.interval)
+            if self._stop_event.is_set():
+                break
+            self._reload_event.clear()
+            if signalled:
+                # Reload even if the file looks unchanged
+                self._mtime = None
+            try:
+                self.check()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(
+                    "Failed to reload the autometrics settings from %s", self.path
+                )
+
+
+def watch_settings(
+    path: str, interval: Optional[float] = 5.0, signum: Optional[int] = None
+) -> SettingsWatcher:
+    """Apply the settings from a file, and reload them when it changes or on a signal.
+
+    See `SettingsWatcher` and `read_settings_file`."""
+    watcher = SettingsWatcher(path, interval, signum)
+    watcher.start()
+    return watcher
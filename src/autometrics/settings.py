@@ -1,21 +1,59 @@
 import os
 
-from typing import cast, Dict, List, TypedDict, Optional, Any
+from typing import (
+    TYPE_CHECKING,
+    cast,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Tuple,
+    TypedDict,
+    Optional,
+    Any,
+)
 from typing_extensions import Unpack
 
+from .constants import SPEC_VERSION
+from .tracker.exponential import (
+    DEFAULT_MAX_BUCKETS,
+    DEFAULT_MAX_SCALE,
+    MAX_SCALE,
+    MIN_SCALE,
+)
 from .tracker.types import TrackerType
-from .exposition import ExporterOptions
+from .tracker.warmup import DEFAULT_RELATIVE_ERROR
 from .objectives import ObjectiveLatency
 from .utils import extract_repository_provider, read_repository_url_from_fs
 
+if TYPE_CHECKING:
+    # Importing the exporters pulls in the OpenTelemetry SDK and pydantic
+    from .exposition import ExporterOptions
+
 
 class AutometricsSettings(TypedDict):
     """Settings for autometrics."""
 
     histogram_buckets: List[float]
+    exponential_histograms: bool
+    histogram_max_scale: int
+    histogram_max_buckets: int
+    warmup_calls: Optional[int]
+    warmup_seconds: Optional[float]
+    bucket_relative_error: float
+    bucket_cache_file: Optional[str]
     tracker: TrackerType
-    exporter: Optional[ExporterOptions]
+    exporter: Optional["ExporterOptions"]
     enable_exemplars: bool
+    exemplar_reservoir_size: Optional[int]
+    tail_exemplars: bool
+    sample_rate: float
+    overhead_budget: Optional[float]
+    thread_sharding: bool
+    background_tracking: bool
+    multiprocess_dir: Optional[str]
+    preload: bool
+    track_callers: bool
     service_name: str
     commit: str
     version: str
@@ -28,15 +66,122 @@ class AutometricsOptions(TypedDict, total=False):
     """User supplied overrides for autometrics settings."""
 
     histogram_buckets: List[float]
+    exponential_histograms: bool
+    histogram_max_scale: int
+    histogram_max_buckets: int
+    warmup_calls: Optional[int]
+    warmup_seconds: Optional[float]
+    bucket_relative_error: float
+    bucket_cache_file: Optional[str]
     tracker: str
     exporter: Dict[str, Any]
     enable_exemplars: bool
+    exemplar_reservoir_size: Optional[int]
+    tail_exemplars: bool
+    sample_rate: float
+    overhead_budget: Optional[float]
+    thread_sharding: bool
+    background_tracking: bool
+    multiprocess_dir: Optional[str]
+    preload: bool
+    track_callers: bool
+    service_name: str
+    commit: str
+    version: str
+    branch: str
+    repository_url: str
+    repository_provider: str
+
+
+class RuntimeOptions(TypedDict, total=False):
+    """Settings that can be changed while the app is running, see `update_settings`."""
+
+    enable_exemplars: bool
+    sample_rate: float
+    track_callers: bool
+
+
+RUNTIME_SETTINGS = tuple(RuntimeOptions.__annotations__)
+
+
+class SettingsSnapshot(Mapping[str, Any]):
+    """An immutable snapshot of the settings, compiled once.
+
+    The settings can be read as attributes (`settings.service_name`), or as keys of a
+    mapping. The labels that only depend on the settings are computed up front. Changing
+    the settings at runtime swaps the whole snapshot for a new one."""
+
+    histogram_buckets: List[float]
+    exponential_histograms: bool
+    histogram_max_scale: int
+    histogram_max_buckets: int
+    warmup_calls: Optional[int]
+    warmup_seconds: Optional[float]
+    bucket_relative_error: float
+    bucket_cache_file: Optional[str]
+    tracker: TrackerType
+    exporter: Optional["ExporterOptions"]
+    enable_exemplars: bool
+    exemplar_reservoir_size: Optional[int]
+    tail_exemplars: bool
+    sample_rate: float
+    overhead_budget: Optional[float]
+    thread_sharding: bool
+    background_tracking: bool
+    multiprocess_dir: Optional[str]
+    preload: bool
+    track_callers: bool
     service_name: str
     commit: str
     version: str
     branch: str
     repository_url: str
     repository_provider: str
+    build_info_labels: Tuple[str, str, str, str, str]
+    """The values of the build info labels that follow the commit, version and branch:
+    the service name, repository url and provider, spec version and sample rate."""
+
+    __slots__ = (*AutometricsSettings.__annotations__, "build_info_labels")
+
+    def __init__(self, values: AutometricsSettings):
+        for key in AutometricsSettings.__annotations__:
+            object.__setattr__(self, key, values[key])  # type: ignore
+        object.__setattr__(
+            self,
+            "build_info_labels",
+            (
+                values["service_name"],
+                values["repository_url"],
+                values["repository_provider"],
+                SPEC_VERSION,
+                str(values["sample_rate"]),
+            ),
+        )
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(
+            "The settings cannot be modified, use update_settings() to change them."
+        )
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in AutometricsSettings.__annotations__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(AutometricsSettings.__annotations__)
+
+    def __len__(self) -> int:
+        return len(AutometricsSettings.__annotations__)
+
+    def __repr__(self) -> str:
+        return f"SettingsSnapshot({dict(self)!r})"
+
+    def replace(self, **changes: Unpack[RuntimeOptions]) -> "SettingsSnapshot":
+        """Create a snapshot with some of the settings changed."""
+        values = cast(AutometricsSettings, {**self, **changes})
+        validate_settings(values)
+        return SettingsSnapshot(values)
 
 
 def get_objective_boundaries():
@@ -44,10 +189,10 @@ def get_objective_boundaries():
     return list(map(lambda c: float(c.value), ObjectiveLatency))
 
 
-settings: Optional[AutometricsSettings] = None
+settings: Optional[SettingsSnapshot] = None
 
 
-def init_settings(**overrides: Unpack[AutometricsOptions]) -> AutometricsSettings:
+def init_settings(**overrides: Unpack[AutometricsOptions]) -> SettingsSnapshot:
     tracker_setting = (
         overrides.get("tracker") or os.getenv("AUTOMETRICS_TRACKER") or "opentelemetry"
     )
@@ -57,10 +202,10 @@ def init_settings(**overrides: Unpack[AutometricsOptions]) -> AutometricsSetting
         else TrackerType.OPENTELEMETRY
     )
 
-    exporter: Optional[ExporterOptions] = None
+    exporter: Optional["ExporterOptions"] = None
     exporter_option = overrides.get("exporter")
     if exporter_option:
-        exporter = cast(ExporterOptions, exporter_option)
+        exporter = cast("ExporterOptions", exporter_option)
 
     repository_url: Optional[str] = overrides.get(
         "repository_url", os.getenv("AUTOMETRICS_REPOSITORY_URL")
@@ -74,12 +219,79 @@ def init_settings(**overrides: Unpack[AutometricsOptions]) -> AutometricsSetting
     if repository_provider is None and repository_url is not None:
         repository_provider = extract_repository_provider(repository_url)
 
+    exemplar_reservoir_size: Optional[int] = overrides.get("exemplar_reservoir_size")
+    if exemplar_reservoir_size is None and os.getenv(
+        "AUTOMETRICS_EXEMPLAR_RESERVOIR_SIZE"
+    ):
+        exemplar_reservoir_size = int(os.environ["AUTOMETRICS_EXEMPLAR_RESERVOIR_SIZE"])
+
+    warmup_calls: Optional[int] = overrides.get("warmup_calls")
+    if warmup_calls is None and os.getenv("AUTOMETRICS_WARMUP_CALLS"):
+        warmup_calls = int(os.environ["AUTOMETRICS_WARMUP_CALLS"])
+
+    warmup_seconds: Optional[float] = overrides.get("warmup_seconds")
+    if warmup_seconds is None and os.getenv("AUTOMETRICS_WARMUP_SECONDS"):
+        warmup_seconds = float(os.environ["AUTOMETRICS_WARMUP_SECONDS"])
+
+    overhead_budget: Optional[float] = overrides.get("overhead_budget")
+    if overhead_budget is None and os.getenv("AUTOMETRICS_OVERHEAD_BUDGET"):
+        overhead_budget = float(os.environ["AUTOMETRICS_OVERHEAD_BUDGET"])
+
     config: AutometricsSettings = {
         "histogram_buckets": overrides.get("histogram_buckets")
         or get_objective_boundaries(),
+        "exponential_histograms": overrides.get(
+            "exponential_histograms",
+            os.getenv("AUTOMETRICS_EXPONENTIAL_HISTOGRAMS") == "true",
+        ),
+        "histogram_max_scale": overrides.get(
+            "histogram_max_scale",
+            int(os.getenv("AUTOMETRICS_HISTOGRAM_MAX_SCALE", str(DEFAULT_MAX_SCALE))),
+        ),
+        "histogram_max_buckets": overrides.get(
+            "histogram_max_buckets",
+            int(
+                os.getenv("AUTOMETRICS_HISTOGRAM_MAX_BUCKETS", str(DEFAULT_MAX_BUCKETS))
+            ),
+        ),
+        "warmup_calls": warmup_calls,
+        "warmup_seconds": warmup_seconds,
+        "bucket_relative_error": overrides.get(
+            "bucket_relative_error",
+            float(
+                os.getenv(
+                    "AUTOMETRICS_BUCKET_RELATIVE_ERROR", str(DEFAULT_RELATIVE_ERROR)
+                )
+            ),
+        ),
+        "bucket_cache_file": overrides.get(
+            "bucket_cache_file", os.getenv("AUTOMETRICS_BUCKET_CACHE_FILE")
+        ),
         "enable_exemplars": overrides.get(
             "enable_exemplars", os.getenv("AUTOMETRICS_EXEMPLARS") == "true"
         ),
+        "exemplar_reservoir_size": exemplar_reservoir_size,
+        "tail_exemplars": overrides.get(
+            "tail_exemplars", os.getenv("AUTOMETRICS_TAIL_EXEMPLARS") == "true"
+        ),
+        "sample_rate": overrides.get(
+            "sample_rate", float(os.getenv("AUTOMETRICS_SAMPLE_RATE", "1.0"))
+        ),
+        "overhead_budget": overhead_budget,
+        "thread_sharding": overrides.get(
+            "thread_sharding", os.getenv("AUTOMETRICS_THREAD_SHARDING") == "true"
+        ),
+        "background_tracking": overrides.get(
+            "background_tracking",
+            os.getenv("AUTOMETRICS_BACKGROUND_TRACKING") == "true",
+        ),
+        "multiprocess_dir": overrides.get(
+            "multiprocess_dir", os.getenv("AUTOMETRICS_MULTIPROCESS_DIR")
+        ),
+        "preload": overrides.get("preload", os.getenv("AUTOMETRICS_PRELOAD") == "true"),
+        "track_callers": overrides.get(
+            "track_callers", os.getenv("AUTOMETRICS_TRACK_CALLERS") != "false"
+        ),
         "tracker": tracker_type,
         "exporter": exporter,
         "service_name": overrides.get(
@@ -102,11 +314,11 @@ def init_settings(**overrides: Unpack[AutometricsOptions]) -> AutometricsSetting
     validate_settings(config)
 
     global settings
-    settings = config
+    settings = SettingsSnapshot(config)
     return settings
 
 
-def get_settings() -> AutometricsSettings:
+def get_settings() -> SettingsSnapshot:
     """Get the current settings."""
     global settings
     if settings is None:
@@ -114,8 +326,58 @@ def get_settings() -> AutometricsSettings:
     return settings
 
 
+def set_settings(snapshot: SettingsSnapshot):
+    """Replace the current settings. The trackers are not updated, see `update_settings`."""
+    global settings
+    settings = snapshot
+
+
 def validate_settings(settings: AutometricsSettings):
     """Ensure that the settings are valid. For example, we don't support OpenTelemetry exporters with Prometheus tracker."""
+    validate_sample_rate(settings["sample_rate"])
+    if settings["overhead_budget"] is not None and settings["overhead_budget"] <= 0:
+        raise ValueError(
+            f"Overhead budget {settings['overhead_budget']} is not supported, it should be greater than 0."
+        )
+    if (
+        settings["exemplar_reservoir_size"] is not None
+        and settings["exemplar_reservoir_size"] <= 0
+    ):
+        raise ValueError(
+            f"Exemplar reservoir size {settings['exemplar_reservoir_size']} is not supported, it should be greater than 0."
+        )
+    if not MIN_SCALE <= settings["histogram_max_scale"] <= MAX_SCALE:
+        raise ValueError(
+            f"Histogram max scale {settings['histogram_max_scale']} is not supported, it should be between {MIN_SCALE} and {MAX_SCALE}."
+        )
+    if settings["histogram_max_buckets"] < 2:
+        raise ValueError(
+            f"Histogram max buckets {settings['histogram_max_buckets']} is not supported, it should be at least 2."
+        )
+    if settings["exponential_histograms"] and (
+        settings["thread_sharding"] or settings["multiprocess_dir"]
+    ):
+        raise ValueError(
+            "Exponential histograms are not supported with thread sharding or a multiprocess directory."
+        )
+    if settings["warmup_calls"] is not None and settings["warmup_calls"] <= 0:
+        raise ValueError(
+            f"Warm-up calls {settings['warmup_calls']} is not supported, it should be greater than 0."
+        )
+    if settings["warmup_seconds"] is not None and settings["warmup_seconds"] < 0:
+        raise ValueError(
+            f"Warm-up seconds {settings['warmup_seconds']} is not supported, it should not be negative."
+        )
+    if not 0.0 < settings["bucket_relative_error"] < 1.0:
+        raise ValueError(
+            f"Bucket relative error {settings['bucket_relative_error']} is not supported, it should be greater than 0 and less than 1."
+        )
+    if (
+        settings["warmup_calls"] is not None or settings["warmup_seconds"] is not None
+    ) and (settings["exponential_histograms"] or settings["multiprocess_dir"]):
+        raise ValueError(
+            "Learning histogram buckets during a warm-up is not supported with exponential histograms or a multiprocess directory."
+        )
     if settings["exporter"]:
         exporter_type = settings["exporter"]["type"]
         if settings["tracker"] == TrackerType.PROMETHEUS:
@@ -123,3 +385,11 @@ def validate_settings(settings: AutometricsSettings):
                 raise ValueError(
                     f"Exporter type {exporter_type} is not supported with Prometheus tracker."
                 )
+
+
+def validate_sample_rate(sample_rate: float):
+    """Ensure that the sample rate is a fraction of calls that can be sampled."""
+    if not 0.0 < sample_rate <= 1.0:
+        raise ValueError(
+            f"Sample rate {sample_rate} is not supported, it should be greater than 0 and at most 1."
+        )
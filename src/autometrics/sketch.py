@@ -0,0 +1,209 @@
+"""Streaming quantiles of the durations of decorated functions, see `@autometrics(quantiles=...)`."""
+import threading
+
+from math import ceil, log
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Sequence
+from typing_extensions import TypedDict
+from weakref import WeakSet
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+DEFAULT_QUANTILE_WINDOW = 60.0
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 1024
+# Durations up to a nanosecond are counted as zero
+MIN_DURATION = 1e-9
+
+
+class QuantileOptions(TypedDict, total=False):
+    """Options for the quantile sketch of a function."""
+
+    quantiles: Sequence[float]
+    """The quantiles that are exported. Default is the p50, p90 and p99."""
+    window: float
+    """The quantiles are computed over the calls of the last 1 to 2 windows (in
+    seconds). Default is 60."""
+    relative_accuracy: float
+    """The relative error of the quantiles. Default is 1%."""
+    max_bins: int
+    """The number of bins a sketch keeps at most. Default is 1024."""
+
+
+class DDSketch:
+    """A mergeable sketch of durations, with quantiles within a relative error.
+
+    Like DDSketch, bin `index` counts the durations in `(gamma ** (index - 1),
+    gamma ** index]`, with `gamma = (1 + relative_accuracy) / (1 - relative_accuracy)`,
+    so adding a duration is a logarithm and a dict update. When more than `max_bins` bins
+    have values, the lowest bins are collapsed into one: the memory stays bounded, at the
+    expense of the accuracy of the lowest quantiles. It is not thread safe."""
+
+    def __init__(
+        self,
+        relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+        max_bins: int = DEFAULT_MAX_BINS,
+    ):
+        if not 0.0 < relative_accuracy < 1.0:
+            raise ValueError(
+                f"Relative accuracy {relative_accuracy} should be between 0 and 1."
+            )
+        if max_bins <= 0:
+            raise ValueError(f"Max bins {max_bins} should be greater than 0.")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self._multiplier = 1.0 / log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, duration: float):
+        """Add a duration in seconds."""
+        self.count += 1
+        self.sum += duration
+        if duration <= MIN_DURATION:
+            self.zero_count += 1
+            return
+        index = ceil(log(duration) * self._multiplier)
+        bins = self.bins
+        bins[index] = bins.get(index, 0) + 1
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other: "DDSketch"):
+        """Add the durations of another sketch with the same relative accuracy."""
+        if other.gamma != self.gamma:
+            raise ValueError("Only sketches with the same relative accuracy merge.")
+        bins = self.bins
+        for index, count in other.bins.items():
+            bins[index] = bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        """Collapse the lowest bins into one, until the bins fit."""
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        lowest = indexes[excess]
+        bins = self.bins
+        for index in indexes[:excess]:
+            bins[lowest] += bins.pop(index)
+
+    def quantiles(self, quantiles: Sequence[float]) -> List[Optional[float]]:
+        """Get the given quantiles (between 0 and 1), or None for an empty sketch."""
+        if not self.count:
+            return [None for _ in quantiles]
+        bins = sorted(self.bins.items())
+        values: List[Optional[float]] = []
+        for quantile in quantiles:
+            if not 0.0 <= quantile <= 1.0:
+                raise ValueError(f"Quantile {quantile} should be between 0 and 1.")
+            rank = quantile * (self.count - 1)
+            cumulative = self.zero_count
+            value = 0.0
+            if cumulative <= rank:
+                for index, count in bins:
+                    cumulative += count
+                    if cumulative > rank:
+                        break
+                # The middle of the bin, relative to its bounds
+                value = 2.0 * self.gamma**index / (self.gamma + 1.0)
+            values.append(value)
+        return values
+
+
+class QuantileSketch:
+    """Keeps the quantiles of the recent durations of a function.
+
+    The durations go into the sketch of the current window. Every `window` seconds it
+    becomes the previous window, and the quantiles are those of both sketches merged: they
+    follow the calls of the last 1 to 2 windows, with the memory of two sketches."""
+
+    def __init__(
+        self,
+        function: str,
+        module: str,
+        quantiles: Sequence[float] = DEFAULT_QUANTILES,
+        window: float = DEFAULT_QUANTILE_WINDOW,
+        relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+        max_bins: int = DEFAULT_MAX_BINS,
+    ):
+        if window <= 0.0:
+            raise ValueError(f"Quantile window {window} should be greater than 0.")
+        for quantile in quantiles:
+            if not 0.0 <= quantile <= 1.0:
+                raise ValueError(f"Quantile {quantile} should be between 0 and 1.")
+        self.function = function
+        self.module = module
+        self.quantiles = tuple(quantiles)
+        self.window = window
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._current = DDSketch(relative_accuracy, max_bins)
+        self._previous = DDSketch(relative_accuracy, max_bins)
+        self._rotate_at = monotonic() + window
+        self._lock = threading.Lock()
+        _sketches.add(self)
+
+    def observe(self, duration: float):
+        """Observe a duration in seconds."""
+        with self._lock:
+            if monotonic() >= self._rotate_at:
+                self._rotate()
+            self._current.add(duration)
+
+    def _rotate(self):
+        """Start a new window, dropping the windows that are over."""
+        now = monotonic()
+        if now >= self._rotate_at + self.window:
+            # Nothing was observed during the last window
+            self._previous = DDSketch(self.relative_accuracy, self.max_bins)
+            self._rotate_at = now + self.window
+        else:
+            self._previous = self._current
+            self._rotate_at += self.window
+        self._current = DDSketch(self.relative_accuracy, self.max_bins)
+
+    def sketch(self) -> DDSketch:
+        """Get a sketch of the durations of the last 1 to 2 windows."""
+        merged = DDSketch(self.relative_accuracy, self.max_bins)
+        with self._lock:
+            if monotonic() >= self._rotate_at:
+                self._rotate()
+            merged.merge(self._previous)
+            merged.merge(self._current)
+        return merged
+
+    def clear(self):
+        """Drop the observed durations."""
+        with self._lock:
+            self._current = DDSketch(self.relative_accuracy, self.max_bins)
+            self._previous = DDSketch(self.relative_accuracy, self.max_bins)
+
+
+_sketches: "WeakSet[QuantileSketch]" = WeakSet()
+
+
+def function_sketches() -> List[QuantileSketch]:
+    """Get the quantile sketches of the decorated functions, which the trackers export."""
+    return list(_sketches)
+
+
+def quantiles(
+    func: Callable, quantiles: Optional[Sequence[float]] = None
+) -> List[Optional[float]]:
+    """Get quantiles of the recent durations (in seconds) of a function decorated with
+    `quantiles`, e.g. `quantiles(func, [0.5, 0.99])`. The default is the quantiles that
+    are exported. A quantile is None when the function was not called recently."""
+    sketch: Optional[QuantileSketch] = getattr(func, "_autometrics_quantiles", None)
+    if sketch is None:
+        raise ValueError(
+            f"{getattr(func, '__qualname__', func)} is not decorated with quantiles, use @autometrics(quantiles=True)."
+        )
+    return sketch.sketch().quantiles(
+        sketch.quantiles if quantiles is None else quantiles
+    )
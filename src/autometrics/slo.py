@@ -0,0 +1,429 @@
+"""In-process evaluation of objectives, see `Objective(evaluate=...)`."""
+import logging
+import threading
+
+from time import monotonic
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from typing_extensions import TypedDict
+from weakref import WeakSet
+
+from .tracker.batch import bucket_means, is_numpy_array, summarize_batch
+from .tracker.types import BatchResult, FunctionMetrics, Result
+
+if TYPE_CHECKING:
+    from .objectives import Objective
+
+# The short and long windows of the multiwindow, multi-burn-rate alerts of the SRE
+# workbook: 5m and 1h, 30m and 6h, 2h and 1d, 6h and 3d
+DEFAULT_BURN_RATE_WINDOWS = (300.0, 1800.0, 3600.0, 7200.0, 21600.0, 86400.0, 259200.0)
+DEFAULT_BUDGET_WINDOW = 30 * 86400.0
+DEFAULT_WINDOW_SLOTS = 12
+
+
+class EvaluationOptions(TypedDict, total=False):
+    """Options for the in-process evaluation of an objective."""
+
+    windows: Sequence[float]
+    """The windows (in seconds) to compute burn rates over. Default is 5m, 30m, 1h, 2h,
+    6h, 1d and 3d."""
+    budget_window: float
+    """The window (in seconds) of the error budget. Default is 30 days."""
+    slots: int
+    """The number of slots a window is counted in, the calls leave a window one slot at
+    a time. Default is 12."""
+
+
+class BurnRate(NamedTuple):
+    """The rates at which an objective spends its error budgets over a window.
+
+    A burn rate of 1 spends the budget exactly over the budget window, so a burn rate of
+    14.4 over an hour spends 2% of a 30 day budget in that hour."""
+
+    window: float
+    """The window in seconds."""
+    success_rate: Optional[float]
+    """The fraction of calls that failed, relative to the error budget of the success
+    rate objective. None without calls or a success rate objective."""
+    latency: Optional[float]
+    """The fraction of timed calls slower than the latency threshold, relative to the
+    error budget of the latency objective. None without timed calls or a latency
+    objective."""
+
+
+class ObjectiveStatus(NamedTuple):
+    """The burn rates and remaining error budgets of an objective."""
+
+    objective: str
+    burn_rates: Tuple[BurnRate, ...]
+    """The burn rates over the windows, shortest first."""
+    success_rate_budget: Optional[float]
+    """The fraction of the error budget of the success rate that is left in the budget
+    window, below 0 when it is overspent. None without calls or a success rate objective."""
+    latency_budget: Optional[float]
+    """The fraction of the error budget of the latency that is left in the budget window.
+    None without timed calls or a latency objective."""
+
+
+class WindowCounts:
+    """The counts of the calls of a window, in a ring of slots.
+
+    Every slot is tagged with the slot number it counts, so the slots that fell out of
+    the window are dropped when they are reused or summed, without a timer."""
+
+    __slots__ = ("slot_seconds", "epochs", "counts")
+
+    def __init__(self, window: float, slots: int):
+        self.slot_seconds = window / slots
+        self.epochs = [-1] * slots
+        # calls, errors, timed calls and slow calls of every slot
+        self.counts = [[0, 0, 0, 0] for _ in range(slots)]
+
+    def add(self, now: float, counts: List[int]):
+        """Add counts to the slot of the given time."""
+        epoch = int(now / self.slot_seconds)
+        index = epoch % len(self.epochs)
+        slot = self.counts[index]
+        if self.epochs[index] != epoch:
+            self.epochs[index] = epoch
+            slot[:] = counts
+        else:
+            for position, count in enumerate(counts):
+                slot[position] += count
+
+    def total(self, now: float) -> List[int]:
+        """Sum the counts of the slots in the window that ends at the given time."""
+        epoch = int(now / self.slot_seconds)
+        oldest = epoch - len(self.epochs)
+        total = [0, 0, 0, 0]
+        for slot_epoch, slot in zip(self.epochs, self.counts):
+            if oldest < slot_epoch <= epoch:
+                for position, count in enumerate(slot):
+                    total[position] += count
+        return total
+
+
+class ObjectiveEvaluator:
+    """Counts the calls of the functions of an objective, to compute its burn rates and
+    remaining error budgets in-process.
+
+    A call only updates the counts since the last flush. They are flushed into the
+    windows, each a ring of a fixed number of slots, when the shortest slot is over or
+    when the status is read: the memory is fixed per objective. After a flush, the
+    subscribed callbacks get the status of the objective."""
+
+    def __init__(
+        self,
+        objective: "Objective",
+        windows: Sequence[float] = DEFAULT_BURN_RATE_WINDOWS,
+        budget_window: float = DEFAULT_BUDGET_WINDOW,
+        slots: int = DEFAULT_WINDOW_SLOTS,
+    ):
+        if objective.success_rate is None and objective.latency is None:
+            raise ValueError(
+                f"Objective {objective.name} has no success rate or latency to evaluate."
+            )
+        if not windows or min(windows) <= 0.0 or budget_window <= 0.0:
+            raise ValueError("Objective windows should be greater than 0.")
+        if slots <= 0:
+            raise ValueError(f"Window slots {slots} should be greater than 0.")
+        self.objective = objective
+        self.windows = tuple(sorted(windows))
+        self.budget_window = budget_window
+        self.success_budget = (
+            None
+            if objective.success_rate is None
+            else 1.0 - float(objective.success_rate.value) / 100.0
+        )
+        self.latency_budget = None
+        self.latency_threshold = float("inf")
+        if objective.latency is not None:
+            self.latency_threshold = float(objective.latency[0].value)
+            self.latency_budget = 1.0 - float(objective.latency[1].value) / 100.0
+        self._windows = [WindowCounts(window, slots) for window in self.windows]
+        self._budget = WindowCounts(budget_window, slots)
+        self._flush_seconds = self.windows[0] / slots
+        self._flush_at = monotonic() + self._flush_seconds
+        # calls, errors, timed calls and slow calls since the last flush
+        self._pending = [0, 0, 0, 0]
+        self._callbacks: List[Callable[[ObjectiveStatus], None]] = []
+        self._lock = threading.Lock()
+        _evaluators.add(self)
+
+    def record(self, duration: Optional[float], result: Result = Result.OK):
+        """Count a call of a function of the objective."""
+        with self._lock:
+            pending = self._pending
+            pending[0] += 1
+            if result == Result.ERROR:
+                pending[1] += 1
+            if duration is not None:
+                pending[2] += 1
+                if duration > self.latency_threshold:
+                    pending[3] += 1
+            flush = monotonic() >= self._flush_at
+        if flush:
+            self.flush()
+
+    def record_many(
+        self,
+        durations: Sequence[Optional[float]],
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Count a batch of calls of a function of the objective."""
+        counts, timed, _ = summarize_batch(durations, results)
+        threshold = self.latency_threshold
+        if is_numpy_array(timed):
+            slow = int((timed > threshold).sum())  # type: ignore
+        else:
+            slow = sum(1 for duration in timed if duration > threshold)
+        with self._lock:
+            pending = self._pending
+            pending[0] += sum(counts.values())
+            pending[1] += counts.get(Result.ERROR, 0)
+            pending[2] += len(timed)
+            pending[3] += slow
+            flush = monotonic() >= self._flush_at
+        if flush:
+            self.flush()
+
+    def record_bucketed(
+        self,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Count calls with the same result that were already counted in histogram
+        buckets. The calls of a bucket are slow if their mean duration is."""
+        means, counts = bucket_means(bounds, bucket_counts, bucket_sums)
+        threshold = self.latency_threshold
+        slow = sum(count for mean, count in zip(means, counts) if mean > threshold)
+        timed = sum(counts)
+        with self._lock:
+            pending = self._pending
+            pending[0] += untimed + timed
+            if result == Result.ERROR:
+                pending[1] += untimed + timed
+            pending[2] += timed
+            pending[3] += slow
+            flush = monotonic() >= self._flush_at
+        if flush:
+            self.flush()
+
+    def _flush(self, now: float):
+        """Add the counts since the last flush to the windows."""
+        pending = self._pending
+        if any(pending):
+            for window in self._windows:
+                window.add(now, pending)
+            self._budget.add(now, pending)
+            self._pending = [0, 0, 0, 0]
+        self._flush_at = now + self._flush_seconds
+
+    def flush(self):
+        """Add the counts since the last flush to the windows, and pass the status to the
+        subscribed callbacks."""
+        with self._lock:
+            self._flush(monotonic())
+        if self._callbacks:
+            status = self.status()
+            for callback in list(self._callbacks):
+                try:
+                    callback(status)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception(
+                        f"Objective callback {callback} failed for {self.objective.name}"
+                    )
+
+    def subscribe(self, callback: Callable[[ObjectiveStatus], None]):
+        """Call a function with the status of the objective after every flush.
+
+        It is called by a thread that calls a function of the objective (or reads its
+        status), at most once per slot of the shortest window, so it should be quick."""
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback: Callable[[ObjectiveStatus], None]):
+        """Stop calling a function with the status of the objective."""
+        self._callbacks.remove(callback)
+
+    def _burn_rate(
+        self, bad: int, total: int, budget: Optional[float]
+    ) -> Optional[float]:
+        """Get the fraction of bad calls relative to an error budget."""
+        if budget is None or not total:
+            return None
+        return bad / total / budget
+
+    def status(self) -> ObjectiveStatus:
+        """Get the burn rates and remaining error budgets of the objective."""
+        with self._lock:
+            now = monotonic()
+            self._flush(now)
+            totals = [window.total(now) for window in self._windows]
+            calls, errors, timed, slow = self._budget.total(now)
+        success_burn = self._burn_rate(errors, calls, self.success_budget)
+        latency_burn = self._burn_rate(slow, timed, self.latency_budget)
+        return ObjectiveStatus(
+            self.objective.name,
+            tuple(
+                BurnRate(
+                    window,
+                    self._burn_rate(total[1], total[0], self.success_budget),
+                    self._burn_rate(total[3], total[2], self.latency_budget),
+                )
+                for window, total in zip(self.windows, totals)
+            ),
+            None if success_burn is None else 1.0 - success_burn,
+            None if latency_burn is None else 1.0 - latency_burn,
+        )
+
+    def clear(self):
+        """Drop the counted calls."""
+        with self._lock:
+            slots = len(self._budget.epochs)
+            self._windows = [WindowCounts(window, slots) for window in self.windows]
+            self._budget = WindowCounts(self.budget_window, slots)
+            self._pending = [0, 0, 0, 0]
+
+
+_evaluators: "WeakSet[ObjectiveEvaluator]" = WeakSet()
+
+
+def objective_evaluators() -> List[ObjectiveEvaluator]:
+    """Get the evaluators of the objectives, which the trackers export."""
+    return list(_evaluators)
+
+
+def objective_status(objective: "Objective") -> ObjectiveStatus:
+    """Get the burn rates and remaining error budgets of an objective that is evaluated
+    in-process."""
+    if objective.evaluator is None:
+        raise ValueError(
+            f"Objective {objective.name} is not evaluated in-process, use Objective(..., evaluate=True)."
+        )
+    return objective.evaluator.status()
+
+
+def status_gauges(
+    status: ObjectiveStatus,
+) -> Dict[Tuple[str, str], List[Tuple[str, float]]]:
+    """Get the values of the burn rate and error budget gauges of a status, by metric
+    ("burn_rate" or "error_budget_remaining") and indicator ("success_rate" or
+    "latency"), as (window, value) pairs. The error budget has an empty window."""
+    gauges: Dict[Tuple[str, str], List[Tuple[str, float]]] = {}
+    for burn_rate in status.burn_rates:
+        window = f"{burn_rate.window:g}"
+        for indicator, value in [
+            ("success_rate", burn_rate.success_rate),
+            ("latency", burn_rate.latency),
+        ]:
+            if value is not None:
+                gauges.setdefault(("burn_rate", indicator), []).append((window, value))
+    for indicator, value in [
+        ("success_rate", status.success_rate_budget),
+        ("latency", status.latency_budget),
+    ]:
+        if value is not None:
+            gauges.setdefault(("error_budget_remaining", indicator), []).append(
+                ("", value)
+            )
+    return gauges
+
+
+class EvaluatedFunctionMetrics:
+    """Metrics of a function of an objective that is evaluated in-process: the calls are
+    recorded on the metrics of the tracker, and counted by the evaluator."""
+
+    def __init__(self, metrics: FunctionMetrics, evaluator: ObjectiveEvaluator):
+        self.metrics = metrics
+        self.evaluator = evaluator
+        self.start = metrics.start
+
+    @property
+    def sample_rate(self) -> float:
+        return self.metrics.sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, sample_rate: float):
+        self.metrics.sample_rate = sample_rate
+
+    @property
+    def calls(self) -> int:
+        return self.metrics.calls
+
+    @calls.setter
+    def calls(self, calls: int):
+        self.metrics.calls = calls
+
+    @property
+    def timed_calls(self) -> int:
+        return self.metrics.timed_calls
+
+    @timed_calls.setter
+    def timed_calls(self, timed_calls: int):
+        self.metrics.timed_calls = timed_calls
+
+    @property
+    def timed_duration(self) -> float:
+        return self.metrics.timed_duration
+
+    @timed_duration.setter
+    def timed_duration(self, timed_duration: float):
+        self.metrics.timed_duration = timed_duration
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Record a call, and count it for the objective."""
+        self.metrics.finish(duration, caller_module, caller_function, result)
+        self.evaluator.record(duration, result)
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Record a batch of calls, and count them for the objective."""
+        self.metrics.finish_many(durations, caller_module, caller_function, results)
+        self.evaluator.record_many(durations, results)
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls that were already counted in histogram buckets, and count them
+        for the objective."""
+        self.metrics.add_bucketed(
+            caller_module,
+            caller_function,
+            result,
+            untimed,
+            bounds,
+            bucket_counts,
+            bucket_sums,
+        )
+        self.evaluator.record_bucketed(
+            result, untimed, bounds, bucket_counts, bucket_sums
+        )
@@ -0,0 +1,207 @@
+"""Records of the slowest calls of decorated functions, see `@autometrics(slow_log=...)`."""
+import reprlib
+import sys
+import threading
+import traceback
+
+from heapq import heappush, heapreplace
+from itertools import count
+from time import time
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+from typing_extensions import TypedDict
+
+from .objectives import Objective
+
+DEFAULT_SLOW_LOG_SIZE = 100
+DEFAULT_P99_MULTIPLE = 3.0
+MAX_ARGUMENTS_LENGTH = 200
+MAX_STACK_DEPTH = 8
+
+# The expected number of timed calls between two calls that are slower than the p99
+CALLS_PER_P99 = 100
+GEOMETRIC_LOG_BIAS = 1.781
+
+
+class SlowLogOptions(TypedDict, total=False):
+    """Options for the slow log of a function."""
+
+    size: int
+    """The number of calls to keep, the slowest ones are kept. Default is 100."""
+    threshold: Optional[float]
+    """Record calls slower than this (in seconds). Default is the latency threshold of
+    the objective of the function."""
+    p99_multiple: Optional[float]
+    """Record calls slower than this multiple of the (approximate) p99 of the function.
+    Default is 3 for functions without a latency objective or threshold."""
+    capture_stack: bool
+    """Record where the function was called from. Default is `False`."""
+
+
+class SlowCall(NamedTuple):
+    """A call that was slower than the threshold of the slow log."""
+
+    function: str
+    module: str
+    duration: float
+    """The duration of the call in seconds."""
+    arguments: str
+    """The arguments of the call, with long values shortened."""
+    caller_module: str
+    caller_function: str
+    time: float
+    """When the call finished, in seconds since the epoch."""
+    stack: Optional[str] = None
+    """Where the function was called from (innermost last), if the stack is captured."""
+
+
+_arguments_repr = reprlib.Repr()
+_arguments_repr.maxstring = 60
+_arguments_repr.maxother = 60
+_arguments_repr.maxlevel = 2
+
+
+def format_arguments(args: Tuple[Any, ...], kwds: dict) -> str:
+    """Format the arguments of a call, shortening long values."""
+    parts = [_arguments_repr.repr(arg) for arg in args]
+    parts += [f"{key}={_arguments_repr.repr(value)}" for key, value in kwds.items()]
+    arguments = ", ".join(parts)
+    if len(arguments) > MAX_ARGUMENTS_LENGTH:
+        arguments = arguments[: MAX_ARGUMENTS_LENGTH - 3] + "..."
+    return arguments
+
+
+class SlowLog:
+    """Keeps the slowest calls of a function that exceeded its threshold.
+
+    The wrapper of the function compares the duration of every timed call with
+    `threshold`, only slower calls reach `record`. When the log follows the p99 of the
+    function, `threshold` is the approximate p99 (or the latency threshold, if it is
+    lower): the roughly 1% of calls above the p99 adapt the estimate (from the number of
+    calls in between), and the calls above the multiple of the p99 (or above the latency
+    threshold) are recorded. The calls are kept in a min-heap of `size` entries, so a call
+    replaces the fastest one kept when the log is full."""
+
+    def __init__(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        size: int = DEFAULT_SLOW_LOG_SIZE,
+        threshold: Optional[float] = None,
+        p99_multiple: Optional[float] = None,
+        capture_stack: bool = False,
+    ):
+        if threshold is None and objective is not None and objective.latency:
+            threshold = float(objective.latency[0].value)
+        if threshold is None and p99_multiple is None:
+            p99_multiple = DEFAULT_P99_MULTIPLE
+        if size <= 0:
+            raise ValueError(f"Slow log size {size} should be greater than 0.")
+        self.function = function
+        self.module = module
+        self.size = size
+        self.latency_threshold = threshold
+        self.p99_multiple = p99_multiple
+        self.capture_stack = capture_stack
+        self.p99: Optional[float] = None
+        """The approximate p99 of the function, when the log follows it."""
+        self.threshold = 0.0 if threshold is None or p99_multiple else threshold
+        """The duration (in seconds) above which a call reaches `record`."""
+        self._calls_at_p99 = 0
+        self._slowest: List[Tuple[float, int, SlowCall]] = []
+        self._sequence = count()
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        duration: float,
+        metrics: Any,
+        args: Tuple[Any, ...],
+        kwds: dict,
+        caller_module: str,
+        caller_function: str,
+    ):
+        """Record a call that was slower than `threshold`."""
+        if self.p99_multiple is not None:
+            with self._lock:
+                p99 = self.p99
+                # Calls above the latency threshold but not above the p99 also reach
+                # this method, they say nothing about the p99
+                if p99 is None or duration > p99:
+                    p99 = self._adapt_p99(duration, metrics.timed_calls)
+            latency_threshold = self.latency_threshold
+            if duration <= p99 * self.p99_multiple and (
+                latency_threshold is None or duration <= latency_threshold
+            ):
+                return
+        slowest = self._slowest
+        if len(slowest) >= self.size and duration <= slowest[0][0]:
+            return
+        stack = None
+        if self.capture_stack:
+            # Skip this method and the wrapper of the function
+            stack = "".join(
+                traceback.format_list(
+                    traceback.extract_stack(sys._getframe(2), limit=MAX_STACK_DEPTH)
+                )
+            )
+        call = SlowCall(
+            self.function,
+            self.module,
+            duration,
+            format_arguments(args, kwds),
+            caller_module,
+            caller_function,
+            time(),
+            stack,
+        )
+        with self._lock:
+            slowest = self._slowest
+            entry = (duration, next(self._sequence), call)
+            if len(slowest) < self.size:
+                heappush(slowest, entry)
+            elif duration > slowest[0][0]:
+                heapreplace(slowest, entry)
+
+    def _adapt_p99(self, duration: float, timed_calls: int) -> float:
+        """Move the p99 estimate towards the duration that 1 in 100 calls exceed, with a
+        call above the estimate. Should be called while holding the lock."""
+        calls = timed_calls - self._calls_at_p99
+        self._calls_at_p99 = timed_calls
+        if self.p99 is None:
+            p99 = duration
+        else:
+            # Fewer calls than expected since the previous one above the estimate means
+            # that it is too low, more calls means that it is too high. The number of
+            # calls in between is geometric, its log is exp(Euler's constant) too small
+            # on average.
+            ratio = min(max(calls, 1) * GEOMETRIC_LOG_BIAS / CALLS_PER_P99, 100.0)
+            p99 = self.p99 * ratio**-0.1
+        self.p99 = p99
+        # Calls above the latency threshold are recorded whatever the p99
+        threshold = p99
+        if self.latency_threshold is not None:
+            threshold = min(threshold, self.latency_threshold)
+        self.threshold = threshold
+        return p99
+
+    def calls(self) -> List[SlowCall]:
+        """Get the recorded calls, slowest first."""
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        return [call for _, _, call in slowest]
+
+    def clear(self):
+        """Drop the recorded calls."""
+        with self._lock:
+            self._slowest = []
+
+
+def slow_calls(func: Callable) -> List[SlowCall]:
+    """Get the slowest calls recorded for a function decorated with a slow log, slowest first."""
+    slow_log: Optional[SlowLog] = getattr(func, "_autometrics_slow_log", None)
+    if slow_log is None:
+        raise ValueError(
+            f"{getattr(func, '__qualname__', func)} is not decorated with a slow log, use @autometrics(slow_log=True)."
+        )
+    return slow_log.calls()
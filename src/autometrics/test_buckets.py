@@ -0,0 +1,125 @@
+"""Tests for the bucket layouts of single functions."""
+import gc
+
+import pytest
+
+from prometheus_client import REGISTRY
+
+from .buckets import objective_buckets, validate_buckets
+from .decorator import autometrics, track
+from .initialization import init
+from .objectives import Objective, ObjectiveLatency, ObjectivePercentile
+from .tracker import get_tracker
+from .tracker.prometheus import use_collector
+
+
+def get_bounds(function: str):
+    """Get the upper bounds of the exposed buckets of a function."""
+    return [
+        float(sample.labels["le"])
+        for metric in REGISTRY.collect()
+        for sample in metric.samples
+        if sample.name == "function_calls_duration_seconds_bucket"
+        and sample.labels["function"] == function
+    ]
+
+
+def test_validate_buckets():
+    assert validate_buckets([0.5, 0.1, float("inf"), 0.1]) == (0.1, 0.5)
+    with pytest.raises(ValueError):
+        validate_buckets([float("inf")])
+    with pytest.raises(ValueError):
+        validate_buckets([-1.0, 1.0])
+
+
+def test_objective_buckets():
+    """Test that the latency threshold is a boundary, with finer buckets around it."""
+    buckets = objective_buckets(0.01)
+    assert 0.01 in buckets
+    assert buckets[0] == 0.001 and buckets[-1] == 0.1
+    # Half of the buckets are within a factor of 2 of the threshold
+    assert len([bound for bound in buckets if 0.005 <= bound <= 0.02]) >= 6
+
+    objective = Objective(
+        "cache", latency=(ObjectiveLatency.Ms5, ObjectivePercentile.P99)
+    )
+    assert objective.buckets == objective_buckets(0.005)
+    assert Objective("cache", buckets=[0.002, 0.001]).buckets == (0.001, 0.002)
+    # The latency threshold is always a boundary
+    assert Objective(
+        "cache",
+        latency=(ObjectiveLatency.Ms5, ObjectivePercentile.P99),
+        buckets=[0.001, 0.01],
+    ).buckets == (0.001, 0.005, 0.01)
+    assert Objective("cache").buckets is None
+
+
+@pytest.mark.parametrize(
+    "tracker, thread_sharding",
+    [("prometheus", False), ("prometheus", True), ("opentelemetry", False)],
+)
+def test_function_buckets(tracker, thread_sharding):
+    """Test that functions with buckets of their own are exposed with their buckets,
+    next to functions with the buckets of the settings."""
+    init(tracker=tracker, thread_sharding=thread_sharding)
+    suffix = f"{tracker}_{thread_sharding}"
+    objective = Objective(
+        "batch", latency=(ObjectiveLatency.Ms10000, ObjectivePercentile.P99)
+    )
+
+    def cache_lookup():
+        pass
+
+    def slow_lookup():
+        pass
+
+    cache_lookup.__qualname__ = f"cache_lookup_{suffix}"
+    slow_lookup.__qualname__ = f"slow_lookup_{suffix}"
+    try:
+        autometrics(buckets=[0.0001, 0.001])(cache_lookup)()
+        # The latency threshold of the objective is added to the buckets
+        autometrics(buckets=[1.0, 100.0], objective=objective)(slow_lookup)()
+        with track(f"slow_block_{suffix}", objective=objective, buckets=[1.0]):
+            pass
+        with track(f"batch_job_{suffix}", objective=objective):
+            pass
+        with track(f"handler_{suffix}"):
+            pass
+
+        assert get_bounds(f"cache_lookup_{suffix}") == [0.0001, 0.001, float("inf")]
+        assert get_bounds(f"slow_lookup_{suffix}") == [1.0, 10.0, 100.0, float("inf")]
+        assert get_bounds(f"slow_block_{suffix}") == [1.0, 10.0, float("inf")]
+        assert get_bounds(f"batch_job_{suffix}") == [
+            *objective_buckets(10.0),
+            float("inf"),
+        ]
+        assert get_bounds(f"handler_{suffix}") == [
+            *[float(latency.value) for latency in ObjectiveLatency],
+            float("inf"),
+        ]
+    finally:
+        use_collector(None)
+
+
+def test_live_series_are_kept():
+    """Test that the empty series of a function with other buckets is only dropped once
+    no function metrics hold it anymore."""
+    init(tracker="prometheus")
+    try:
+        tracker = get_tracker()
+        default = tracker.register_function("held_series", __name__)
+        own = tracker.register_function("held_series", __name__, buckets=(1.0,))
+        own.finish(0.1, "", "")
+        # The empty series is still held by metrics that are alive, which can record on it
+        assert get_bounds("held_series").count(float("inf")) == 2
+        default.finish(0.1, "", "")
+
+        unused = tracker.register_function("dropped_series", __name__)
+        tracker.register_function("dropped_series", __name__, buckets=(1.0,))
+        assert get_bounds("dropped_series").count(float("inf")) == 2
+        del unused
+        tracker._functions.clear()
+        gc.collect()
+        assert get_bounds("dropped_series") == [1.0, float("inf")]
+    finally:
+        use_collector(None)
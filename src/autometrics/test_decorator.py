@@ -3,13 +3,22 @@ import time
 import asyncio
 from typing import Optional, Coroutine
 from prometheus_client.exposition import generate_latest
+from prometheus_client.utils import floatToGoString
 import pytest
 from requests import HTTPError, Response
 
-from .decorator import autometrics
+from .decorator import (
+    autometrics,
+    caller_function_var,
+    caller_module_var,
+    caller_var,
+    observe_many,
+    track,
+)
 from .initialization import init
 from .objectives import ObjectiveLatency, Objective, ObjectivePercentile
-from .tracker import TrackerType
+from .tracker import Result, TrackerType
+from .tracker.prometheus import PrometheusTracker
 from .utils import get_function_name, get_module_name
 
 HTTP_ERROR_TEXT = "This is an http error"
@@ -163,10 +172,11 @@ class TestDecoratorClass:
         total_count = f"""function_calls_total{{caller_function="",caller_module="",function="{function_name}",module="autometrics.test_decorator",objective_name="{objective_name}",objective_percentile="{success_rate.value}",result="ok",service_name="autometrics"}} 1.0"""
         assert total_count in data
 
-        # Check the latency buckets
-        for objective in ObjectiveLatency:
-            count = 0 if float(objective.value) <= sleep_duration else 1
-            query = f"""function_calls_duration_seconds_bucket{{function="{function_name}",le="{objective.value}",module="autometrics.test_decorator",objective_latency_threshold="{latency[0].value}",objective_name="{objective_name}",objective_percentile="{latency[1].value}",service_name="autometrics"}} {count}"""
+        # Check the latency buckets, which are derived from the latency threshold
+        assert objective.buckets is not None
+        for bound in objective.buckets:
+            count = 0 if bound <= sleep_duration else 1
+            query = f"""function_calls_duration_seconds_bucket{{function="{function_name}",le="{floatToGoString(bound)}",module="autometrics.test_decorator",objective_latency_threshold="{latency[0].value}",objective_name="{objective_name}",objective_percentile="{latency[1].value}",service_name="autometrics"}} {count}"""
             assert query in data
 
         duration_count = f"""function_calls_duration_seconds_count{{function="{function_name}",module="autometrics.test_decorator",objective_latency_threshold="{latency[0].value}",objective_name="{objective_name}",objective_percentile="{latency[1].value}",service_name="autometrics"}}"""
@@ -202,10 +212,11 @@ class TestDecoratorClass:
         total_count = f"""function_calls_total{{caller_function="",caller_module="",function="basic_async_function",module="autometrics.test_decorator",objective_name="{objective_name}",objective_percentile="{success_rate.value}",result="ok",service_name="autometrics"}} 1.0"""
         assert total_count in data
 
-        # Check the latency buckets
-        for objective in ObjectiveLatency:
-            count = 0 if float(objective.value) <= sleep_duration else 1
-            query = f"""function_calls_duration_seconds_bucket{{function="basic_async_function",le="{objective.value}",module="autometrics.test_decorator",objective_latency_threshold="{latency[0].value}",objective_name="{objective_name}",objective_percentile="{latency[1].value}",service_name="autometrics"}} {count}"""
+        # Check the latency buckets, which are derived from the latency threshold
+        assert objective.buckets is not None
+        for bound in objective.buckets:
+            count = 0 if bound <= sleep_duration else 1
+            query = f"""function_calls_duration_seconds_bucket{{function="basic_async_function",le="{floatToGoString(bound)}",module="autometrics.test_decorator",objective_latency_threshold="{latency[0].value}",objective_name="{objective_name}",objective_percentile="{latency[1].value}",service_name="autometrics"}} {count}"""
             assert query in data
 
         duration_count = f"""function_calls_duration_seconds_count{{function="basic_async_function",module="autometrics.test_decorator",objective_latency_threshold="{latency[0].value}",objective_name="{objective_name}",objective_percentile="{latency[1].value}",service_name="autometrics"}}"""
@@ -454,3 +465,247 @@ class TestDecoratorClass:
 
         total_count_error = f"""function_calls_total{{caller_function="",caller_module="",function="never_called_async_function",module="autometrics.test_decorator",objective_name="{objective_name}",objective_percentile="{success_rate.value}",result="error",service_name="autometrics"}} 0.0"""
         assert total_count_error in data
+
+
+def test_deprecated_caller_vars():
+    """Test that the former caller variables still read and set the caller, with a
+    deprecation warning."""
+
+    @autometrics
+    def caller_of_deprecated_vars():
+        return caller_module_var.get(), caller_function_var.get()
+
+    with pytest.deprecated_call():
+        module, function = caller_of_deprecated_vars()
+    assert (module, function) == (
+        "autometrics.test_decorator",
+        "test_deprecated_caller_vars.<locals>.caller_of_deprecated_vars",
+    )
+
+    with pytest.deprecated_call():
+        module_token = caller_module_var.set("module")
+        function_token = caller_function_var.set("function")
+        assert caller_var.get() == ("module", "function")
+        caller_function_var.reset(function_token)
+        caller_module_var.reset(module_token)
+    assert caller_var.get() == ("", "")
+
+    # Resetting a part only restores that part, in whatever order they are reset
+    with pytest.deprecated_call():
+        module_token = caller_module_var.set("module")
+        function_token = caller_function_var.set("function")
+        caller_module_var.reset(module_token)
+        assert caller_var.get() == ("", "function")
+        caller_function_var.reset(function_token)
+        assert caller_var.get() == ("", "")
+        with pytest.raises(RuntimeError):
+            caller_module_var.reset(module_token)
+        with pytest.raises(ValueError):
+            caller_function_var.reset(caller_module_var.set("module"))
+    caller_var.set(("", ""))
+
+
+@pytest.mark.parametrize("record_error_if", [None, lambda result: result is False])
+@pytest.mark.parametrize("record_success_if", [None, lambda exception: False])
+def test_wrapper_variants(record_error_if, record_success_if):
+    """Test that every specialized wrapper records results and restores the caller."""
+    init(tracker="prometheus")
+
+    def variant_function(fail: bool = False):
+        assert caller_var.get() == (
+            "autometrics.test_decorator",
+            "test_wrapper_variants.<locals>.variant_function",
+        )
+        if fail:
+            raise RuntimeError("This is a test error")
+        return True
+
+    wrapped_function = autometrics(
+        record_error_if=record_error_if,
+        record_success_if=record_success_if,
+    )(variant_function)
+
+    assert wrapped_function() is True
+    with pytest.raises(RuntimeError):
+        wrapped_function(fail=True)
+    assert caller_var.get() == ("", "")
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    for result in ["ok", "error"]:
+        total_count = f"""function_calls_total{{caller_function="",caller_module="",function="test_wrapper_variants.<locals>.variant_function",module="autometrics.test_decorator",objective_name="",objective_percentile="",result="{result}",service_name="autometrics"}}"""
+        assert total_count in data
+
+
+def test_sample_rate(monkeypatch):
+    """Test that calls that are not sampled are still counted, but not timed."""
+    init(tracker="prometheus")
+    # Every call draws a number above the sample rate, so no call is sampled
+    monkeypatch.setattr("autometrics.decorator.random", lambda: 0.99)
+
+    def sampled_function():
+        return True
+
+    wrapped_function = autometrics(sample_rate=0.5)(sampled_function)
+    for _ in range(3):
+        wrapped_function()
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    total_count = """function_calls_total{caller_function="",caller_module="",function="test_sample_rate.<locals>.sampled_function",module="autometrics.test_decorator",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 3.0"""
+    assert total_count in data
+
+    duration_count = """function_calls_duration_seconds_count{function="test_sample_rate.<locals>.sampled_function",module="autometrics.test_decorator",objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"} 0.0"""
+    assert duration_count in data
+
+
+def test_invalid_sample_rate():
+    """Test that a sample rate outside of (0, 1] is rejected."""
+    with pytest.raises(ValueError):
+        autometrics(sample_rate=0)(basic_function)
+    with pytest.raises(ValueError):
+        autometrics(sample_rate=1.5)(basic_function)
+
+
+def test_observe_many():
+    """Test that a batch of items is recorded with the labels of the decorated function."""
+    init(tracker="prometheus")
+
+    @autometrics
+    def batch_function():
+        return True
+
+    observe_many(batch_function, [0.001, 0.002, None], [True, False, Result.OK])
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    labels = """function="test_observe_many.<locals>.batch_function",module="autometrics.test_decorator\""""
+    ok_count = f"""function_calls_total{{caller_function="",caller_module="",{labels},objective_name="",objective_percentile="",result="ok",service_name="autometrics"}} 2.0"""
+    assert ok_count in data
+    error_count = f"""function_calls_total{{caller_function="",caller_module="",{labels},objective_name="",objective_percentile="",result="error",service_name="autometrics"}} 1.0"""
+    assert error_count in data
+    duration_count = f"""function_calls_duration_seconds_count{{{labels},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 2.0"""
+    assert duration_count in data
+
+
+def test_observe_many_concurrency_function():
+    """Test that a batch of a function that tracks concurrency is recorded with a handle
+    that is created once, with the buckets and sample rate of the function, and does not
+    change the concurrency gauge."""
+    init(tracker="prometheus")
+
+    @autometrics(track_concurrency=True, sample_rate=1.0, buckets=[0.01, 0.1])
+    def concurrent_batch_function():
+        return True
+
+    batch_handle = concurrent_batch_function._autometrics_batch_handle  # type: ignore
+    assert batch_handle is not concurrent_batch_function._autometrics_handle  # type: ignore
+    assert not batch_handle.track_concurrency
+    assert (batch_handle.sample_rate, batch_handle.buckets) == (1.0, (0.01, 0.1))
+
+    concurrent_batch_function()
+    observe_many(concurrent_batch_function, [0.001, 0.05])
+    observe_many(concurrent_batch_function, [0.2])
+    assert concurrent_batch_function._autometrics_batch_handle is batch_handle  # type: ignore
+
+    data = generate_latest().decode("utf-8")
+    labels = """function="test_observe_many_concurrency_function.<locals>.concurrent_batch_function",module="autometrics.test_decorator\""""
+    bucket = f"""function_calls_duration_seconds_bucket{{{labels.replace(',module', ',le="0.1",module')},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 3.0"""
+    assert bucket in data
+    concurrency = (
+        f"""function_calls_concurrent{{{labels},service_name="autometrics"}} 0.0"""
+    )
+    assert concurrency in data
+    # The gauge outlives the tracker, other tests expect only their own functions in it
+    PrometheusTracker.prom_gauge_concurrency.remove(
+        "test_observe_many_concurrency_function.<locals>.concurrent_batch_function",
+        "autometrics.test_decorator",
+        "autometrics",
+    )
+
+
+def test_observe_many_numpy():
+    """Test that NumPy arrays of durations and results are recorded."""
+    numpy = pytest.importorskip("numpy")
+    init(tracker="prometheus")
+
+    def numpy_function():
+        return True
+
+    observe_many(
+        numpy_function,
+        numpy.array([0.001, 0.5, numpy.nan, 20.0]),
+        numpy.array([True, True, False, True]),
+    )
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    labels = """function="test_observe_many_numpy.<locals>.numpy_function",module="autometrics.test_decorator\""""
+    ok_count = f"""function_calls_total{{caller_function="",caller_module="",{labels},objective_name="",objective_percentile="",result="ok",service_name="autometrics"}} 3.0"""
+    assert ok_count in data
+    bucket = f"""function_calls_duration_seconds_bucket{{{labels.replace(',module', ',le="0.5",module')},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 2.0"""
+    assert bucket in data
+    duration_count = f"""function_calls_duration_seconds_count{{{labels},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 3.0"""
+    assert duration_count in data
+
+
+def test_track_block():
+    """Test that a tracked block is recorded like a function, and is the caller of the functions it calls."""
+    init(tracker="prometheus")
+
+    @autometrics
+    def callee_in_block():
+        return True
+
+    block = track("tracked_block")
+    assert track("tracked_block") is block
+
+    with block:
+        assert caller_var.get() == ("autometrics.test_decorator", "tracked_block")
+        callee_in_block()
+    with pytest.raises(RuntimeError):
+        with block:
+            raise RuntimeError("failed")
+    assert caller_var.get() == ("", "")
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    ok_count = """function_calls_total{caller_function="",caller_module="",function="tracked_block",module="autometrics.test_decorator",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 1.0"""
+    assert ok_count in data
+    error_count = """function_calls_total{caller_function="",caller_module="",function="tracked_block",module="autometrics.test_decorator",objective_name="",objective_percentile="",result="error",service_name="autometrics"} 1.0"""
+    assert error_count in data
+    callee_count = """function_calls_total{caller_function="tracked_block",caller_module="autometrics.test_decorator",function="test_track_block.<locals>.callee_in_block",module="autometrics.test_decorator",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 1.0"""
+    assert callee_count in data
+    duration_count = """function_calls_duration_seconds_count{function="tracked_block",module="autometrics.test_decorator",objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"} 2.0"""
+    assert duration_count in data
+
+
+@pytest.mark.asyncio
+async def test_track_block_async():
+    """Test that a tracked block can be shared by concurrent tasks."""
+    init(tracker="prometheus")
+    block = track("async_tracked_block", module="test_module")
+
+    async def task():
+        async with block:
+            await asyncio.sleep(0.01)
+            assert caller_var.get() == ("test_module", "async_tracked_block")
+
+    await asyncio.gather(task(), task(), task())
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    ok_count = """function_calls_total{caller_function="",caller_module="",function="async_tracked_block",module="test_module",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 3.0"""
+    assert ok_count in data
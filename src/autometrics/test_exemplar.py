@@ -0,0 +1,215 @@
+import time
+
+import pytest
+
+from typing import Any, Dict, Sequence, Tuple
+
+from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+from opentelemetry.sdk.trace import TracerProvider
+from prometheus_client import REGISTRY
+from prometheus_client.openmetrics.exposition import generate_latest
+
+from .constants import COUNTER_NAME, HISTOGRAM_NAME
+from .decorator import autometrics
+from .exemplar import ExemplarLabels, TailExemplarReservoir, get_exemplar
+from .initialization import init
+from .reload import update_settings
+from .tracker import get_tracker
+from .tracker.prometheus import use_collector
+from .tracker.types import Result
+
+tracer = TracerProvider().get_tracer(__name__)
+
+
+@autometrics
+def traced_function():
+    pass
+
+
+def test_exemplar_labels_are_formatted_when_read():
+    """Test that the trace and span ids are only formatted as hex when they are read."""
+    labels = ExemplarLabels(0x1234, 0xABC)
+    assert labels._labels is None
+    assert dict(labels) == {
+        "trace_id": "00000000000000000000000000001234",
+        "span_id": "0000000000000abc",
+    }
+
+
+def test_no_exemplar_outside_of_a_span():
+    assert get_exemplar() is None
+
+
+def test_exemplars_are_rate_limited():
+    """Test that the exemplar of a series is only replaced once per refresh interval."""
+    init(tracker="prometheus", enable_exemplars=True)
+    with tracer.start_as_current_span("first") as first_span:
+        traced_function()
+    with tracer.start_as_current_span("second"):
+        traced_function()
+
+    metrics = get_tracker().register_function("traced_function", __name__)
+    histogram = metrics._histogram
+    exemplars = [
+        bucket.get_exemplar()
+        for bucket in histogram._buckets
+        if bucket.get_exemplar() is not None
+    ]
+    assert len(exemplars) == 1
+    assert exemplars[0].labels.span_id == first_span.get_span_context().span_id
+
+    data = generate_latest(REGISTRY).decode("utf-8")
+    span_id = f"{first_span.get_span_context().span_id:016x}"
+    assert f'span_id="{span_id}"' in data
+
+
+def get_exemplars(reader: InMemoryMetricReader):
+    """Get the exemplars of the data points, by function, metric and result."""
+    exemplars: Dict[Tuple[Any, str, Any], Sequence[Any]] = {}
+    metrics_data = reader.get_metrics_data()
+    assert metrics_data is not None
+    for resource_metrics in metrics_data.resource_metrics:
+        for scope_metrics in resource_metrics.scope_metrics:
+            for metric in scope_metrics.metrics:
+                for point in metric.data.data_points:
+                    attributes = point.attributes or {}
+                    key = (
+                        attributes.get("function"),
+                        metric.name,
+                        attributes.get("result"),
+                    )
+                    exemplars[key] = point.exemplars
+    return exemplars
+
+
+def test_opentelemetry_exemplars():
+    """Test that the OpenTelemetry tracker keeps a bounded number of exemplars per series."""
+    reader = InMemoryMetricReader()
+    init(
+        tracker="opentelemetry",
+        enable_exemplars=True,
+        exemplar_reservoir_size=2,
+        exporter={"type": "otel-custom", "exporter": reader},
+    )
+    with tracer.start_as_current_span("traced") as span:
+        for _ in range(5):
+            traced_function()
+
+    exemplars = get_exemplars(reader)
+    assert 0 < len(exemplars["traced_function", COUNTER_NAME, "ok"]) <= 2
+    assert 0 < len(exemplars["traced_function", HISTOGRAM_NAME, None]) <= 2
+    span_id = span.get_span_context().span_id
+    assert all(
+        exemplar.span_id == span_id
+        for exemplar in exemplars["traced_function", HISTOGRAM_NAME, None]
+    )
+
+    update_settings(enable_exemplars=False)
+    with tracer.start_as_current_span("untraced"):
+        traced_function()
+    exemplars = get_exemplars(reader)
+    assert (
+        not exemplars["traced_function", COUNTER_NAME, "ok"]
+        and not exemplars["traced_function", HISTOGRAM_NAME, None]
+    )
+
+
+def test_opentelemetry_exemplars_are_exposed_to_prometheus():
+    """Test that the Prometheus reader attaches the exemplars to the matching samples."""
+    init(tracker="opentelemetry", enable_exemplars=True)
+    with tracer.start_as_current_span("traced") as span:
+        traced_function()
+
+    data = generate_latest(REGISTRY).decode("utf-8")
+    span_id = f'span_id="{span.get_span_context().span_id:016x}"'
+    samples = [line for line in data.splitlines() if span_id in line]
+    assert any(line.startswith("function_calls_total{") for line in samples)
+    assert any(
+        line.startswith("function_calls_duration_seconds_bucket{") for line in samples
+    )
+
+
+@autometrics
+def sleeping_function(duration: float):
+    time.sleep(duration)
+
+
+@autometrics
+def failing_function():
+    raise ValueError("failed")
+
+
+def test_tail_exemplar_reservoir():
+    """Test that the reservoir keeps the slowest calls and the most recent error."""
+    reservoir = TailExemplarReservoir[str](2)
+    for value, exemplar in [(1.0, "a"), (3.0, "b"), (2.0, "c"), (0.5, "d")]:
+        if reservoir.accepts(value):
+            reservoir.add(value, exemplar)
+    assert not reservoir.accepts(1.5)
+    reservoir.add(0.1, "error", error=True)
+    reservoir.add(0.2, "last error", error=True)
+
+    assert reservoir.collect() == (["b", "c"], "last error")
+    assert reservoir.collect() == ([], None)
+
+
+def test_prometheus_tail_exemplars():
+    """Test that the slowest call and the last error since the last scrape are linked."""
+    init(
+        tracker="prometheus",
+        enable_exemplars=True,
+        tail_exemplars=True,
+        exemplar_reservoir_size=1,
+    )
+    metrics = get_tracker().register_function("tail_function", __name__)
+    spans = {}
+    for name, duration, result in [
+        ("fast", 0.001, Result.OK),
+        ("slow", 3.0, Result.OK),
+        ("faster", 0.002, Result.OK),
+        ("error", 0.001, Result.ERROR),
+    ]:
+        with tracer.start_as_current_span(name) as span:
+            metrics.finish(duration, "", "", result)
+        spans[name] = f'span_id="{span.get_span_context().span_id:016x}"'
+
+    try:
+        data = generate_latest(REGISTRY).decode("utf-8")
+    finally:
+        use_collector(None)
+    samples = [line for line in data.splitlines() if "tail_function" in line]
+    assert any('le="5.0"' in line and spans["slow"] in line for line in samples)
+    assert any('result="ok"' in line and spans["slow"] in line for line in samples)
+    assert any('result="error"' in line and spans["error"] in line for line in samples)
+    assert not any(spans["fast"] in line or spans["faster"] in line for line in samples)
+
+
+def test_opentelemetry_tail_exemplars():
+    """Test that the OpenTelemetry tracker keeps the slowest call and the last error."""
+    reader = InMemoryMetricReader()
+    init(
+        tracker="opentelemetry",
+        enable_exemplars=True,
+        tail_exemplars=True,
+        exemplar_reservoir_size=1,
+        exporter={"type": "otel-custom", "exporter": reader},
+    )
+    with tracer.start_as_current_span("fast"):
+        sleeping_function(0)
+    with tracer.start_as_current_span("slow") as slow_span:
+        sleeping_function(0.05)
+    with tracer.start_as_current_span("fast"):
+        sleeping_function(0)
+    with tracer.start_as_current_span("error") as error_span:
+        with pytest.raises(ValueError):
+            failing_function()
+
+    exemplars = get_exemplars(reader)
+    histogram = exemplars["sleeping_function", HISTOGRAM_NAME, None]
+    assert [exemplar.span_id for exemplar in histogram] == [
+        slow_span.get_span_context().span_id
+    ]
+    errors = exemplars["failing_function", COUNTER_NAME, "error"]
+    assert [exemplar.span_id for exemplar in errors] == [
+        error_span.get_span_context().span_id
+    ]
@@ -1,5 +1,10 @@
+import os
+import subprocess
+import sys
+
 import pytest
 
+import autometrics
 from autometrics import init
 from autometrics.exposition import PrometheusExporterOptions
 from autometrics.tracker.opentelemetry import OpenTelemetryTracker
@@ -30,7 +35,23 @@ def test_init():
             7.5,
             10.0,
         ],
+        "exponential_histograms": False,
+        "histogram_max_scale": 20,
+        "histogram_max_buckets": 160,
+        "warmup_calls": None,
+        "warmup_seconds": None,
+        "bucket_relative_error": 0.1,
+        "bucket_cache_file": None,
         "enable_exemplars": False,
+        "exemplar_reservoir_size": None,
+        "tail_exemplars": False,
+        "sample_rate": 1.0,
+        "overhead_budget": None,
+        "thread_sharding": False,
+        "background_tracking": False,
+        "multiprocess_dir": None,
+        "preload": False,
+        "track_callers": True,
         "tracker": TrackerType.OPENTELEMETRY,
         "exporter": None,
         "service_name": "autometrics",
@@ -50,6 +71,7 @@ def test_init_custom():
         tracker="prometheus",
         service_name="test",
         enable_exemplars=True,
+        sample_rate=0.5,
         version="1.0.0",
         commit="123456",
         branch="main",
@@ -72,7 +94,23 @@ def test_init_custom():
             7.5,
             10.0,
         ],
+        "exponential_histograms": False,
+        "histogram_max_scale": 20,
+        "histogram_max_buckets": 160,
+        "warmup_calls": None,
+        "warmup_seconds": None,
+        "bucket_relative_error": 0.1,
+        "bucket_cache_file": None,
         "enable_exemplars": True,
+        "exemplar_reservoir_size": None,
+        "tail_exemplars": False,
+        "sample_rate": 0.5,
+        "overhead_budget": None,
+        "thread_sharding": False,
+        "background_tracking": False,
+        "multiprocess_dir": None,
+        "preload": False,
+        "track_callers": True,
         "tracker": TrackerType.PROMETHEUS,
         "exporter": None,
         "service_name": "test",
@@ -114,7 +152,23 @@ def test_init_env_vars(monkeypatch):
             7.5,
             10.0,
         ],
+        "exponential_histograms": False,
+        "histogram_max_scale": 20,
+        "histogram_max_buckets": 160,
+        "warmup_calls": None,
+        "warmup_seconds": None,
+        "bucket_relative_error": 0.1,
+        "bucket_cache_file": None,
         "enable_exemplars": True,
+        "exemplar_reservoir_size": None,
+        "tail_exemplars": False,
+        "sample_rate": 1.0,
+        "overhead_budget": None,
+        "thread_sharding": False,
+        "background_tracking": False,
+        "multiprocess_dir": None,
+        "preload": False,
+        "track_callers": True,
         "tracker": TrackerType.PROMETHEUS,
         "exporter": None,
         "service_name": "test",
@@ -159,7 +213,23 @@ def test_init_with_exporter():
             7.5,
             10.0,
         ],
+        "exponential_histograms": False,
+        "histogram_max_scale": 20,
+        "histogram_max_buckets": 160,
+        "warmup_calls": None,
+        "warmup_seconds": None,
+        "bucket_relative_error": 0.1,
+        "bucket_cache_file": None,
         "enable_exemplars": False,
+        "exemplar_reservoir_size": None,
+        "tail_exemplars": False,
+        "sample_rate": 1.0,
+        "overhead_budget": None,
+        "thread_sharding": False,
+        "background_tracking": False,
+        "multiprocess_dir": None,
+        "preload": False,
+        "track_callers": True,
         "tracker": TrackerType.PROMETHEUS,
         "exporter": PrometheusExporterOptions(type="prometheus"),
         "service_name": "autometrics",
@@ -183,8 +253,58 @@ def test_init_exporter_validation():
         )
 
 
+def test_init_sample_rate_validation():
+    with pytest.raises(ValueError):
+        init(sample_rate=0)
+
+
 def test_init_repo_meta_suppress_detection():
     init(repository_url="", repository_provider="")
     settings = get_settings()
     assert settings["repository_provider"] is ""
     assert settings["repository_url"] is ""
+
+
+def test_import_does_not_load_backends():
+    """Test that importing autometrics does not import the tracker backends and their dependencies."""
+    code = "\n".join(
+        [
+            "import sys",
+            "import autometrics",
+            "heavy = ['opentelemetry', 'prometheus_client', 'pydantic', 'dotenv']",
+            "print([name for name in sys.modules if name.split('.')[0] in heavy])",
+        ]
+    )
+    src_path = os.path.dirname(os.path.dirname(autometrics.__file__))
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": src_path},
+        text=True,
+    ).stdout
+    assert output.strip() == "[]"
+
+
+def test_trackers_do_not_load_multiprocess():
+    """Test that the trackers can be used without the multiprocess files, which need
+    fcntl (and are not available on Windows)."""
+    code = "\n".join(
+        [
+            "import sys",
+            "sys.modules['fcntl'] = None",
+            "from autometrics import init",
+            "from autometrics.tracker import opentelemetry, prometheus",
+            "init(tracker='prometheus')",
+            "print('autometrics.tracker.multiprocess' in sys.modules)",
+        ]
+    )
+    src_path = os.path.dirname(os.path.dirname(autometrics.__file__))
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": src_path},
+        text=True,
+    ).stdout
+    assert output.strip() == "False"
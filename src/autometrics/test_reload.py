@@ -0,0 +1,144 @@
+import os
+import signal
+import time
+
+import pytest
+
+from prometheus_client import REGISTRY
+
+from .decorator import autometrics
+from .initialization import init
+from .reload import SettingsWatcher, update_settings
+from .settings import get_settings
+from .tracker import get_tracker
+
+
+@autometrics
+def reloaded_function():
+    pass
+
+
+@autometrics(sample_rate=1.0)
+def fully_sampled_function():
+    pass
+
+
+@autometrics
+def reloaded_caller():
+    reloaded_function()
+
+
+def get_calls(caller_function: str):
+    return REGISTRY.get_sample_value(
+        "function_calls_total",
+        {
+            "function": "reloaded_function",
+            "module": __name__,
+            "service_name": "autometrics",
+            "result": "ok",
+            "caller_module": __name__ if caller_function else "",
+            "caller_function": caller_function,
+            "objective_name": "",
+            "objective_percentile": "",
+        },
+    )
+
+
+def get_build_info(sample_rate: str):
+    return REGISTRY.get_sample_value(
+        "build_info",
+        {
+            "commit": "reloaded",
+            "version": "",
+            "branch": "",
+            "service_name": "autometrics",
+            "repository_url": get_settings().repository_url,
+            "repository_provider": get_settings().repository_provider,
+            "autometrics_version": "1.0.0",
+            "autometrics_sample_rate": sample_rate,
+        },
+    )
+
+
+def test_settings_snapshot():
+    """Test that the settings can be read as attributes and keys, but not changed."""
+    settings = get_settings()
+    assert settings.sample_rate == settings["sample_rate"]
+    assert settings.build_info_labels[-1] == str(settings.sample_rate)
+    with pytest.raises(AttributeError):
+        settings.sample_rate = 0.5  # type: ignore
+
+
+def test_update_settings():
+    """Test that the tracker picks up settings that are changed at runtime."""
+    init(tracker="prometheus", commit="reloaded", version="", branch="")
+    reloaded_function()
+    fully_sampled_function()
+    assert get_build_info("1.0") == 1
+
+    previous_settings = get_settings()
+    settings = update_settings(enable_exemplars=True, sample_rate=0.5)
+    assert get_settings() is settings
+    assert settings.enable_exemplars and settings.sample_rate == 0.5
+    assert previous_settings.sample_rate == 1.0
+
+    metrics = {metrics.sample_rate for metrics in get_tracker().function_metrics()}
+    # The function with a sample rate of its own keeps it
+    assert metrics == {0.5, 1.0}
+    assert reloaded_function._autometrics_handle.metrics().sample_rate == 0.5
+    assert reloaded_function._autometrics_handle.metrics()._enable_exemplars
+    assert get_build_info("1.0") is None
+    assert get_build_info("0.5") == 1
+
+
+def test_update_settings_rejects_other_settings():
+    """Test that only the runtime settings can be changed, and they are validated."""
+    init(tracker="prometheus")
+    with pytest.raises(ValueError):
+        update_settings(service_name="other")  # type: ignore
+    with pytest.raises(ValueError):
+        update_settings(sample_rate=2.0)
+    assert get_settings().sample_rate == 1.0
+
+
+def test_toggle_caller_tracking():
+    """Test that calls are recorded without a caller while caller tracking is off."""
+    init(tracker="prometheus")
+    reloaded_caller()
+    calls = get_calls("reloaded_caller")
+    calls_without_caller = get_calls("") or 0
+
+    update_settings(track_callers=False)
+    reloaded_caller()
+    assert get_calls("reloaded_caller") == calls
+    assert get_calls("") == calls_without_caller + 1
+
+    update_settings(track_callers=True)
+    reloaded_caller()
+    assert get_calls("reloaded_caller") == calls + 1
+
+
+def test_settings_watcher(tmp_path):
+    """Test that the settings are reloaded when the file changes, and on a signal."""
+    init(tracker="prometheus")
+    path = tmp_path / "autometrics.env"
+    path.write_text("AUTOMETRICS_SAMPLE_RATE=0.5\n")
+    watcher = SettingsWatcher(str(path), interval=None, signum=signal.SIGUSR1)
+    watcher.start()
+    try:
+        assert get_settings().sample_rate == 0.5
+
+        path.write_text("AUTOMETRICS_EXEMPLARS=true\nAUTOMETRICS_SAMPLE_RATE=0.25\n")
+        assert watcher.check()
+        assert not watcher.check()
+        assert get_settings().enable_exemplars
+        assert get_settings().sample_rate == 0.25
+
+        update_settings(enable_exemplars=False)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        deadline = time.monotonic() + 5
+        while not get_settings().enable_exemplars and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert get_settings().enable_exemplars
+    finally:
+        watcher.stop()
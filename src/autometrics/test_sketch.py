@@ -0,0 +1,147 @@
+"""Tests for the quantile sketches."""
+from random import Random
+
+import pytest
+
+from prometheus_client import REGISTRY
+
+from . import settings as settings_module, sketch as sketch_module
+from .decorator import autometrics
+from .initialization import init
+from .settings import init_settings
+from .sketch import DDSketch, QuantileSketch, quantiles
+from .tracker.prometheus import use_collector
+
+
+@autometrics(quantiles={"quantiles": [0.5, 0.99]})
+def with_quantiles(duration: float):
+    pass
+
+
+@autometrics
+def without_quantiles():
+    pass
+
+
+def get_quantiles(function: str, metric_type: str):
+    """Get the exposed quantiles of a function, by quantile."""
+    return {
+        sample.labels["quantile"]: sample.value
+        for metric in REGISTRY.collect()
+        if metric.type == metric_type
+        for sample in metric.samples
+        if sample.name == "function_calls_duration_quantiles_seconds"
+        and sample.labels["function"] == function
+    }
+
+
+def test_sketch_relative_accuracy():
+    """Test that the quantiles are within the relative accuracy of the exact ones."""
+    durations = Random(0)
+    values = sorted(durations.lognormvariate(-6, 1.5) for _ in range(10000))
+    sketch = DDSketch(relative_accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+
+    qs = [0.0, 0.25, 0.5, 0.9, 0.99, 0.999, 1.0]
+    for quantile, value in zip(qs, sketch.quantiles(qs)):
+        exact = values[int(quantile * (len(values) - 1))]
+        assert value == pytest.approx(exact, rel=0.01)
+    assert sketch.count == len(values) and sketch.sum == pytest.approx(sum(values))
+    assert DDSketch().quantiles([0.5]) == [None]
+    with pytest.raises(ValueError):
+        sketch.quantiles([1.5])
+
+
+def test_sketch_merge_and_collapse():
+    """Test that merged sketches are the sketch of all values, and that the lowest bins
+    collapse once there are too many."""
+    first, second = DDSketch(max_bins=8), DDSketch(max_bins=8)
+    for value in [0.0, 0.001, 0.002]:
+        first.add(value)
+    for value in [0.004, 0.008]:
+        second.add(value)
+    first.merge(second)
+    assert first.count == 5 and first.zero_count == 1
+    assert first.quantiles([1.0]) == [pytest.approx(0.008, rel=0.01)]
+
+    for index in range(20):
+        first.add(0.01 * 1.5**index)
+    assert len(first.bins) == 8
+    assert first.quantiles([1.0]) == [pytest.approx(0.01 * 1.5**19, rel=0.01)]
+    with pytest.raises(ValueError):
+        first.merge(DDSketch(relative_accuracy=0.05))
+
+
+def test_sketch_window(monkeypatch):
+    """Test that the quantiles follow the durations of the last windows."""
+    now = [0.0]
+    monkeypatch.setattr(sketch_module, "monotonic", lambda: now[0])
+    sketch = QuantileSketch("function", "module", window=10.0)
+    sketch.observe(1.0)
+    now[0] = 15.0
+    sketch.observe(2.0)
+    # The previous window is kept
+    assert sketch.sketch().count == 2
+    now[0] = 25.0
+    assert sketch.sketch().quantiles([0.0, 1.0]) == [
+        pytest.approx(2.0, rel=0.01),
+        pytest.approx(2.0, rel=0.01),
+    ]
+    now[0] = 60.0
+    assert sketch.sketch().count == 0
+
+
+@pytest.mark.parametrize("tracker", ["prometheus", "opentelemetry"])
+def test_quantiles(tracker):
+    """Test that the quantiles of a decorated function can be queried and are exported."""
+    init(tracker=tracker)
+    try:
+        sketch = with_quantiles._autometrics_quantiles  # type: ignore
+        sketch.clear()
+        for _ in range(10):
+            with_quantiles(0)
+        p50, p99 = quantiles(with_quantiles)
+        assert p50 is not None and p99 is not None and p50 <= p99 < 1.0
+        [maximum] = quantiles(with_quantiles, [1.0])
+        assert maximum is not None and p99 <= maximum
+
+        if tracker == "prometheus":
+            assert get_quantiles("with_quantiles", "summary") == {
+                "0.5": p50,
+                "0.99": p99,
+            }
+        else:
+            exported = get_quantiles("with_quantiles", "gauge")
+            assert exported == {"0.5": pytest.approx(p50), "0.99": pytest.approx(p99)}
+    finally:
+        use_collector(None)
+
+
+def test_quantiles_service_name(monkeypatch):
+    """Test that the quantiles are exported with the service name of the tracker, not
+    with the settings that are current when they are collected."""
+    init(tracker="prometheus", service_name="quantile-service")
+    monkeypatch.setattr(
+        settings_module, "settings", init_settings(service_name="other-service")
+    )
+    try:
+        with_quantiles(0)
+        service_names = {
+            sample.labels["service_name"]
+            for metric in REGISTRY.collect()
+            if metric.type == "summary"
+            for sample in metric.samples
+            if sample.name.startswith("function_calls_duration_quantiles_seconds")
+            and sample.labels["function"] == "with_quantiles"
+        }
+        assert service_names == {"quantile-service"}
+    finally:
+        use_collector(None)
+
+
+def test_quantiles_without_quantiles():
+    with pytest.raises(ValueError):
+        quantiles(without_quantiles)
+    with pytest.raises(ValueError):
+        autometrics(quantiles={"window": 0})(without_quantiles)
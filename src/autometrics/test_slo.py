@@ -0,0 +1,116 @@
+"""Tests for the in-process evaluation of objectives."""
+import pytest
+
+from prometheus_client import REGISTRY
+
+from . import slo as slo_module
+from .decorator import autometrics, observe_many, track
+from .initialization import init
+from .objectives import Objective, ObjectiveLatency, ObjectivePercentile
+from .slo import objective_status
+from .tracker.prometheus import use_collector
+from .tracker.types import Result
+
+
+def get_gauges(name: str, objective: str):
+    """Get the exposed values of a gauge of an objective, by indicator and window."""
+    return {
+        (sample.labels["indicator"], sample.labels.get("window", "")): sample.value
+        for metric in REGISTRY.collect()
+        for sample in metric.samples
+        if sample.name == name and sample.labels["objective_name"] == objective
+    }
+
+
+def test_burn_rates(monkeypatch):
+    """Test that the burn rates follow the calls of their windows, and that the error
+    budget follows the calls of the budget window."""
+    now = [0.0]
+    monkeypatch.setattr(slo_module, "monotonic", lambda: now[0])
+    objective = Objective(
+        "burn",
+        success_rate=ObjectivePercentile.P99,
+        latency=(ObjectiveLatency.Ms100, ObjectivePercentile.P90),
+        evaluate={"windows": [60, 600], "budget_window": 3600, "slots": 6},
+    )
+    evaluator = objective.evaluator
+    assert evaluator is not None
+    for _ in range(98):
+        evaluator.record(0.05)
+    evaluator.record(0.5, Result.ERROR)
+    evaluator.record(None, Result.ERROR)
+
+    status = objective_status(objective)
+    short, long = status.burn_rates
+    assert short.window == 60 and long.window == 600
+    assert short.success_rate == pytest.approx(2.0)
+    assert short.latency == pytest.approx(1 / 99 / 0.1)
+    assert long == (600, short.success_rate, short.latency)
+    assert status.success_rate_budget == pytest.approx(-1.0)
+
+    # The calls leave the short window first, then the long one
+    now[0] = 120.0
+    evaluator.record(0.05)
+    short, long = objective_status(objective).burn_rates
+    assert short == (60, 0.0, 0.0)
+    assert long.success_rate == pytest.approx(2 / 101 / 0.01)
+    now[0] = 4000.0
+    status = objective_status(objective)
+    assert status.burn_rates[1] == (600, None, None)
+    assert status.success_rate_budget is None and status.latency_budget is None
+
+
+def test_evaluate_validation():
+    with pytest.raises(ValueError):
+        Objective("nothing", evaluate=True)
+    with pytest.raises(ValueError):
+        Objective(
+            "nothing", success_rate=ObjectivePercentile.P99, evaluate={"windows": []}
+        )
+    with pytest.raises(ValueError):
+        objective_status(
+            Objective("not-evaluated", success_rate=ObjectivePercentile.P99)
+        )
+
+
+@pytest.mark.parametrize("tracker", ["prometheus", "opentelemetry"])
+def test_objective_status(tracker):
+    """Test that the calls of decorated functions, tracked blocks and batches are counted
+    for their objective, and that its status is exported and passed to callbacks."""
+    init(tracker=tracker)
+    name = f"evaluated-{tracker}"
+    objective = Objective(
+        name, success_rate=ObjectivePercentile.P90, evaluate={"windows": [60]}
+    )
+
+    @autometrics(objective=objective)
+    def evaluated(fail: bool):
+        if fail:
+            raise RuntimeError()
+
+    statuses = []
+    assert objective.evaluator is not None
+    objective.evaluator.subscribe(statuses.append)
+    try:
+        evaluated(False)
+        with pytest.raises(RuntimeError):
+            evaluated(True)
+        with track(f"evaluated_block_{tracker}", objective=objective):
+            pass
+        observe_many(evaluated, [0.1, 0.1], [True, True])
+
+        # The calls only flush once a slot is over
+        assert not statuses
+        objective.evaluator.flush()
+        status = objective_status(objective)
+        assert status.burn_rates[0].success_rate == pytest.approx(1 / 5 / 0.1)
+        assert status.burn_rates[0].latency is None
+        assert statuses == [status]
+        objective.evaluator.unsubscribe(statuses.append)
+
+        burn_rates = get_gauges("objective_burn_rate", name)
+        assert burn_rates == {("success_rate", "60"): pytest.approx(2.0)}
+        budgets = get_gauges("objective_error_budget_remaining", name)
+        assert budgets == {("success_rate", ""): pytest.approx(-1.0)}
+    finally:
+        use_collector(None)
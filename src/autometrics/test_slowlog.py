@@ -0,0 +1,122 @@
+"""Tests for the slow log."""
+import asyncio
+import time
+
+from random import Random
+
+import pytest
+
+from .decorator import autometrics
+from .initialization import init
+from .objectives import Objective, ObjectiveLatency, ObjectivePercentile
+from .slowlog import SlowLog, slow_calls
+
+SLOW_OBJECTIVE = Objective(
+    "slow log",
+    latency=(ObjectiveLatency.Ms10, ObjectivePercentile.P99),
+)
+
+
+@autometrics(objective=SLOW_OBJECTIVE, slow_log={"capture_stack": True})
+def sometimes_slow(duration: float, payload: str = ""):
+    time.sleep(duration)
+
+
+@autometrics(slow_log={"threshold": 0.01})
+async def sometimes_slow_async(duration: float):
+    await asyncio.sleep(duration)
+
+
+@autometrics
+def slow_caller():
+    sometimes_slow(0.02, payload="x" * 1000)
+
+
+@autometrics
+def without_slow_log():
+    pass
+
+
+class Metrics:
+    timed_calls = 0
+
+
+def test_slow_log_objective_threshold():
+    """Test that calls slower than the latency objective are recorded with their context."""
+    init()
+    sometimes_slow(0)
+    slow_caller()
+
+    calls = slow_calls(sometimes_slow)
+    assert len(calls) == 1
+    call = calls[0]
+    assert call.function == "sometimes_slow" and call.module == __name__
+    assert call.duration >= 0.02
+    assert call.arguments.startswith("0.02, payload='xxx")
+    assert len(call.arguments) < 100
+    assert (call.caller_module, call.caller_function) == (__name__, "slow_caller")
+    assert call.stack is not None and "in slow_caller" in call.stack.splitlines()[-2]
+
+
+@pytest.mark.asyncio
+async def test_slow_log_async():
+    """Test that slow calls of an async function are recorded."""
+    init()
+    await sometimes_slow_async(0)
+    await sometimes_slow_async(0.02)
+
+    calls = slow_calls(sometimes_slow_async)
+    assert [call.arguments for call in calls] == ["0.02"]
+    assert calls[0].stack is None
+
+
+def test_slow_log_without_slow_log():
+    with pytest.raises(ValueError):
+        slow_calls(without_slow_log)
+
+
+def test_slow_log_keeps_slowest_calls():
+    """Test that the log keeps the slowest calls once it is full."""
+    slow_log = SlowLog("function", "module", size=2, threshold=1.0)
+    for duration in [2.0, 4.0, 3.0, 1.5]:
+        slow_log.record(duration, Metrics(), (duration,), {}, "", "")
+    assert [call.duration for call in slow_log.calls()] == [4.0, 3.0]
+    slow_log.clear()
+    assert slow_log.calls() == []
+
+
+def test_slow_log_p99_multiple():
+    """Test that the log follows the p99 of the function, and records the outliers."""
+    slow_log = SlowLog("function", "module", p99_multiple=3.0)
+    metrics = Metrics()
+    durations = Random(0)
+    for call in range(20_000):
+        metrics.timed_calls += 1
+        # The calls take between 1 and 2ms, and 1 in 5000 takes a second
+        duration = 1.0 if call % 5000 == 4999 else durations.uniform(0.001, 0.002)
+        if duration > slow_log.threshold:
+            slow_log.record(duration, metrics, (), {}, "", "")
+
+    assert slow_log.p99 is not None and 0.0015 <= slow_log.p99 <= 0.003
+    assert [call.duration for call in slow_log.calls()] == [1.0] * 4
+
+
+def test_slow_log_p99_with_latency_threshold():
+    """Test that the calls above a latency threshold that is lower than the p99 are
+    recorded, without moving the p99 estimate."""
+    slow_log = SlowLog("function", "module", threshold=0.001, p99_multiple=3.0)
+    metrics = Metrics()
+    metrics.timed_calls = 1
+    slow_log.record(0.5, metrics, (), {}, "", "")
+    assert (slow_log.p99, slow_log.threshold) == (0.5, 0.001)
+
+    for _ in range(1000):
+        metrics.timed_calls += 1
+        slow_log.record(0.01, metrics, (), {}, "", "")
+    assert slow_log.p99 == 0.5
+    assert len(slow_log.calls()) == slow_log.size
+
+    # 1000 calls in between is more than expected for the p99, so it is lowered
+    metrics.timed_calls += 1
+    slow_log.record(0.6, metrics, (), {}, "", "")
+    assert slow_log.p99 is not None and slow_log.p99 < 0.5
@@ -0,0 +1,181 @@
+import logging
+import threading
+
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, Optional
+
+from .types import FunctionMetrics, TrackMetrics
+
+
+class DetailLevel(Enum):
+    """The level of detail that is recorded for the calls of a function."""
+
+    FULL = "full"
+    """Every call is counted, the duration is recorded for the configured sample rate."""
+    SAMPLED = "sampled"
+    """Every call is counted, the duration is recorded for a fraction of the configured sample rate."""
+    COUNTERS = "counters"
+    """Every call is counted, no durations are recorded."""
+
+
+LEVELS = list(DetailLevel)
+# The share of the overhead of a timed call that counting the call takes, when the
+# overhead of a call that is only counted is not given
+CALL_OVERHEAD_SHARE = 0.5
+
+
+@dataclass
+class FunctionState:
+    """The state the controller keeps for a single function."""
+
+    sample_rate: float
+    """The sample rate the function was configured with."""
+    level: DetailLevel = DetailLevel.FULL
+    calls: int = 0
+    timed_calls: int = 0
+    timed_duration: float = 0.0
+    mean_duration: Optional[float] = None
+    """The mean duration of the timed calls in the last interval that had any."""
+
+
+class OverheadController:
+    """Lowers the level of detail for hot functions when the overhead of instrumenting them is too high.
+
+    Every interval, the controller looks at the call rate and mean duration of every function
+    registered with the tracker. When a function is called at least `min_call_rate` times per
+    second and the estimated instrumentation overhead per call is more than `overhead_budget`
+    times its mean duration, the controller lowers its detail level by one step. The
+    overhead per call is `call_overhead` (counting the call, which every level does) plus
+    `overhead` (the cost of a timed call) times the sample rate of the level:
+    full -> sampled histogram -> counters only. When the call rate drops below half of
+    `min_call_rate`, or the overhead of the higher level is back within half of the budget,
+    the detail level is raised again by one step.
+
+    Functions that were decorated with an explicit `sample_rate=1.0` always record every call.
+    """
+
+    def __init__(
+        self,
+        tracker: TrackMetrics,
+        overhead_budget: float = 0.05,
+        min_call_rate: float = 100.0,
+        interval: float = 10.0,
+        sampled_fraction: float = 0.1,
+        overhead: Optional[float] = None,
+        call_overhead: Optional[float] = None,
+    ):
+        self.tracker = tracker
+        self.overhead_budget = overhead_budget
+        self.min_call_rate = min_call_rate
+        self.interval = interval
+        self.sampled_fraction = sampled_fraction
+        self.overhead = tracker.estimate_overhead() if overhead is None else overhead
+        self.call_overhead = (
+            self.overhead * CALL_OVERHEAD_SHARE
+            if call_overhead is None
+            else call_overhead
+        )
+        self._functions: Dict[FunctionMetrics, FunctionState] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def level(self, metrics: FunctionMetrics) -> DetailLevel:
+        """Get the current detail level of a function."""
+        state = self._functions.get(metrics)
+        return DetailLevel.FULL if state is None else state.level
+
+    def sample_rate_for(self, state: FunctionState, level: DetailLevel) -> float:
+        """Get the sample rate that is used for a function at the given detail level."""
+        if level == DetailLevel.FULL:
+            return state.sample_rate
+        if level == DetailLevel.SAMPLED:
+            return state.sample_rate * self.sampled_fraction
+        return 0.0
+
+    def overhead_ratio(self, state: FunctionState, level: DetailLevel) -> float:
+        """Get the estimated overhead per call of a function at the given detail level,
+        relative to its mean duration."""
+        overhead = self.call_overhead + self.overhead * self.sample_rate_for(
+            state, level
+        )
+        return overhead / state.mean_duration  # type: ignore
+
+    def evaluate(self, elapsed: Optional[float] = None):
+        """Look at the calls since the last evaluation and adjust the detail levels."""
+        elapsed = self.interval if elapsed is None else elapsed
+        for metrics in self.tracker.function_metrics():
+            state = self._functions.get(metrics)
+            if state is None:
+                state = self._functions[metrics] = FunctionState(
+                    sample_rate=metrics.sample_rate,
+                    calls=metrics.calls,
+                    timed_calls=metrics.timed_calls,
+                    timed_duration=metrics.timed_duration,
+                )
+                continue
+            if metrics.sample_rate != self.sample_rate_for(state, state.level):
+                # The sample rate was changed from outside (e.g. with update_settings),
+                # which is the rate the function is configured with from now on
+                state.sample_rate = metrics.sample_rate
+                state.level = DetailLevel.FULL
+
+            calls = metrics.calls - state.calls
+            timed_calls = metrics.timed_calls - state.timed_calls
+            timed_duration = metrics.timed_duration - state.timed_duration
+            state.calls = metrics.calls
+            state.timed_calls = metrics.timed_calls
+            state.timed_duration = metrics.timed_duration
+            if timed_calls > 0:
+                state.mean_duration = timed_duration / timed_calls
+
+            level = self.next_level(state, calls / elapsed)
+            if level != state.level:
+                logging.getLogger(__name__).debug(
+                    "Changing the detail level of %s from %s to %s",
+                    metrics,
+                    state.level.value,
+                    level.value,
+                )
+                state.level = level
+                metrics.sample_rate = self.sample_rate_for(state, level)
+
+    def next_level(self, state: FunctionState, call_rate: float) -> DetailLevel:
+        """Decide the detail level of a function, moving at most one step at a time."""
+        index = LEVELS.index(state.level)
+        if state.mean_duration is None or state.mean_duration <= 0:
+            return state.level
+
+        if call_rate < self.min_call_rate / 2:
+            return LEVELS[max(index - 1, 0)]
+
+        ratio = self.overhead_ratio(state, state.level)
+        if call_rate >= self.min_call_rate and ratio > self.overhead_budget:
+            return LEVELS[min(index + 1, len(LEVELS) - 1)]
+
+        if index > 0:
+            higher_ratio = self.overhead_ratio(state, LEVELS[index - 1])
+            if higher_ratio < self.overhead_budget / 2:
+                return LEVELS[index - 1]
+        return state.level
+
+    def start(self):
+        """Evaluate the detail levels every interval, on a background thread."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="autometrics-overhead-controller", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.evaluate()
@@ -0,0 +1,417 @@
+import atexit
+import logging
+import threading
+
+from collections import deque
+from time import perf_counter_ns
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from .types import BatchResult, FunctionMetrics, Result, TrackMetrics
+from ..objectives import Objective
+
+if TYPE_CHECKING:
+    from ..settings import SettingsSnapshot
+
+# A queued call: either the function metrics followed by the arguments of `finish`,
+# or a method to call followed by its arguments
+CallRecord = Tuple[Any, ...]
+
+
+class BackgroundTracker:
+    """A tracker that queues calls and records them on another tracker from a background thread.
+
+    Recording a call only appends a tuple to a bounded queue, the metrics are updated
+    by a background thread that drains the queue every `interval` seconds. Exemplars
+    are not recorded, since the trace context of the call is not available on that thread. When the queue is full, new calls are dropped and counted in `dropped`.
+    A call of a function that tracks concurrency is dropped as a whole: the finish of a
+    call whose start was queued is always queued, and a dropped start drops a finish of
+    the same function, so the concurrency gauge stays balanced.
+    The queue is flushed when the tracker is shut down, which happens at exit."""
+
+    def __init__(
+        self,
+        tracker: TrackMetrics,
+        capacity: int = 65536,
+        interval: float = 0.05,
+    ):
+        self.tracker = tracker
+        self.capacity = capacity
+        self.interval = interval
+        self.dropped = 0
+        """The number of calls that were dropped because the queue was full."""
+        self._queue: Deque[CallRecord] = deque()
+        # The number of starts that were dropped per (function, module), whose finish
+        # should be dropped too
+        self._dropped_starts: Dict[Tuple[str, str], int] = {}
+        self._dropped_lock = threading.Lock()
+        self._functions: Dict[
+            Tuple[
+                str,
+                str,
+                Optional[Objective],
+                bool,
+                Optional[float],
+                Optional[Tuple[float, ...]],
+            ],
+            BackgroundFunctionMetrics,
+        ] = {}
+        self._drain_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="autometrics-background-tracker", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def set_build_info(self, commit: str, version: str, branch: str):
+        """Observe the build info. Should only be called once per tracker instance"""
+        self.tracker.set_build_info(commit, version, branch)
+
+    def start(
+        self, function: str, module: str, track_concurrency: Optional[bool] = False
+    ):
+        """Start tracking metrics for a function call."""
+        self.register_function(
+            function, module, track_concurrency=track_concurrency
+        ).start()
+
+    def finish(
+        self,
+        duration: Optional[float],
+        function: str,
+        module: str,
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+    ):
+        """Finish tracking metrics for a function call."""
+        self.register_function(function, module, objective, track_concurrency).finish(
+            duration, caller_module, caller_function, result
+        )
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        function: str,
+        module: str,
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+    ):
+        """Finish tracking metrics for a batch of calls to a function from the same caller."""
+        self.register_function(
+            function, module, objective, track_concurrency
+        ).finish_many(durations, caller_module, caller_function, results)
+
+    def initialize_counters(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+    ):
+        """Initialize (counter) metrics for a function at zero."""
+        self.tracker.initialize_counters(function, module, objective)
+
+    def register_function(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ) -> "BackgroundFunctionMetrics":
+        """Initialize (counter) metrics for a function at zero and return a handle to its metrics."""
+        key = (
+            function,
+            module,
+            objective,
+            bool(track_concurrency),
+            sample_rate,
+            buckets,
+        )
+        metrics = self._functions.get(key)
+        if metrics is None:
+            metrics = self._functions.setdefault(
+                key,
+                BackgroundFunctionMetrics(
+                    self,
+                    function,
+                    module,
+                    bool(track_concurrency),
+                    self.tracker.register_function(
+                        function,
+                        module,
+                        objective,
+                        track_concurrency,
+                        sample_rate,
+                        buckets,
+                    ),
+                ),
+            )
+        return metrics
+
+    def function_metrics(self) -> List[FunctionMetrics]:
+        """Get the metrics of all the functions registered with this tracker."""
+        return list(self._functions.values())
+
+    def estimate_overhead(self, calls: int = 1000) -> float:
+        """Estimate the time (in seconds) it takes to record a timed call.
+
+        Only the cost on the calling thread is measured, which is queueing the call."""
+        queue: Deque[CallRecord] = deque()
+        start_time = perf_counter_ns()
+        for _ in range(calls):
+            if len(queue) < self.capacity:
+                queue.append((None, 0.0, "", "", Result.OK))
+        return (perf_counter_ns() - start_time) / calls / 1e9
+
+    def reset_after_fork(self):
+        """Drop the calls queued before the process was forked, the parent records them."""
+        self._queue.clear()
+        self._dropped_starts.clear()
+        self._drain_lock = threading.Lock()
+        self._dropped_lock = threading.Lock()
+        self.tracker.reset_after_fork()
+
+    def close_after_fork(self):
+        """Drop the values the underlying tracker inherited from the parent process."""
+        self.tracker.close_after_fork()
+
+    def apply_settings(self, settings: "SettingsSnapshot"):
+        """Apply settings that were changed at runtime to the underlying tracker."""
+        self.tracker.apply_settings(settings)
+
+    def append(self, record: CallRecord, force: bool = False) -> bool:
+        """Queue a call, or drop it when the queue is full (unless `force` is set).
+        Returns whether the call was queued."""
+        if force or len(self._queue) < self.capacity:
+            self._queue.append(record)
+            return True
+        self._drop()
+        return False
+
+    def _drop(self):
+        if self.dropped == 0:
+            logging.warning(
+                "Autometrics background queue is full, calls are dropped. Consider raising its capacity."
+            )
+        self.dropped += 1
+
+    def drop_start(self, callee: Tuple[str, str]):
+        """Count a dropped start of a function, a finish of that function is dropped in
+        its place."""
+        with self._dropped_lock:
+            self._dropped_starts[callee] = self._dropped_starts.get(callee, 0) + 1
+
+    def drop_finish(self, callee: Tuple[str, str]) -> bool:
+        """Drop a finish of a function if one of its starts was dropped. Returns whether
+        the finish was dropped."""
+        with self._dropped_lock:
+            count = self._dropped_starts.get(callee)
+            if not count:
+                return False
+            if count == 1:
+                del self._dropped_starts[callee]
+            else:
+                self._dropped_starts[callee] = count - 1
+        self._drop()
+        return True
+
+    def flush(self) -> None:
+        """Record all the queued calls on the tracker.
+
+        The finished calls are recorded as one batch per function and caller."""
+        with self._drain_lock:
+            batches: Dict[
+                Tuple[FunctionMetrics, str, str],
+                Tuple[List[Optional[float]], List[Result]],
+            ] = {}
+            popleft = self._queue.popleft
+            for _ in range(len(self._queue)):
+                record = popleft()
+                if callable(record[0]):
+                    self._call(record[0], *record[1:])
+                    continue
+                metrics, duration, caller_module, caller_function, result = record
+                durations, results = batches.setdefault(
+                    (metrics, caller_module, caller_function), ([], [])
+                )
+                durations.append(duration)
+                results.append(result)
+            for (metrics, caller_module, caller_function), (
+                durations,
+                results,
+            ) in batches.items():
+                self._call(
+                    metrics.finish_many,
+                    durations,
+                    caller_module,
+                    caller_function,
+                    results,
+                )
+
+    def _call(self, method: Callable, *args: Any):
+        try:
+            method(*args)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Failed to record a queued call")
+
+    def shutdown(self):
+        """Stop the background thread and record the calls that are still queued."""
+        atexit.unregister(self.shutdown)
+        self._stop_event.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.flush()
+
+
+class BackgroundFunctionMetrics:
+    """Metrics of a single function, queued on a background tracker.
+
+    The sample rate and call statistics are those of the metrics on the underlying
+    tracker, which are updated when the queue is drained."""
+
+    __slots__ = (
+        "_metrics",
+        "_tracker",
+        "_callee",
+        "_track_concurrency",
+        "_dropped_starts",
+        "_append",
+        "_start",
+        "_finish_many",
+        "_add_bucketed",
+    )
+
+    def __init__(
+        self,
+        tracker: BackgroundTracker,
+        function: str,
+        module: str,
+        track_concurrency: bool,
+        metrics: FunctionMetrics,
+    ):
+        self._metrics = metrics
+        self._tracker = tracker
+        self._callee = (function, module)
+        self._track_concurrency = track_concurrency
+        self._dropped_starts = tracker._dropped_starts
+        self._append: Callable[..., bool] = tracker.append
+        self._start = metrics.start
+        self._finish_many = metrics.finish_many
+        self._add_bucketed = metrics.add_bucketed
+
+    @property
+    def sample_rate(self) -> float:
+        return self._metrics.sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, sample_rate: float):
+        self._metrics.sample_rate = sample_rate
+
+    @property
+    def calls(self) -> int:
+        return self._metrics.calls
+
+    @calls.setter
+    def calls(self, calls: int):
+        self._metrics.calls = calls
+
+    @property
+    def timed_calls(self) -> int:
+        return self._metrics.timed_calls
+
+    @timed_calls.setter
+    def timed_calls(self, timed_calls: int):
+        self._metrics.timed_calls = timed_calls
+
+    @property
+    def timed_duration(self) -> float:
+        return self._metrics.timed_duration
+
+    @timed_duration.setter
+    def timed_duration(self, timed_duration: float):
+        self._metrics.timed_duration = timed_duration
+
+    def start(self):
+        """Start tracking metrics for a function call."""
+        if not self._append((self._start,)):
+            self._tracker.drop_start(self._callee)
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Finish tracking metrics for a function call."""
+        record = (self._metrics, duration, caller_module, caller_function, result)
+        if not self._track_concurrency:
+            self._append(record)
+        elif not (self._dropped_starts and self._tracker.drop_finish(self._callee)):
+            # The start of the call was queued, so its finish is queued even when the
+            # queue is full
+            self._append(record, True)
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Finish tracking metrics for a batch of calls to the function from the same caller."""
+        self._append(
+            (
+                self._finish_many,
+                durations,
+                caller_module,
+                caller_function,
+                results,
+            ),
+            self._track_concurrency,
+        )
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls that were already counted in histogram buckets."""
+        self._append(
+            (
+                self._add_bucketed,
+                caller_module,
+                caller_function,
+                result,
+                untimed,
+                bounds,
+                bucket_counts,
+                bucket_sums,
+            )
+        )
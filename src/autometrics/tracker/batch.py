@@ -0,0 +1,157 @@
+import sys
+
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .types import BatchResult, Result
+
+
+def is_numpy_array(value: Any) -> bool:
+    """Check if a value is a NumPy array, without importing NumPy."""
+    return type(value).__module__ == "numpy" and hasattr(value, "dtype")
+
+
+class DurationBatch(float):
+    """The durations of the timed calls of a batch, recorded on a histogram as one measurement.
+
+    Its value is the longest duration, which the SDK checks like any other measurement
+    and offers to the exemplar reservoir. The aggregations of the OpenTelemetry tracker
+    add all the durations to their buckets in a single update. With `counts`, every
+    duration stands for that many calls."""
+
+    __slots__ = ("durations", "total", "counts", "shortest")
+
+    durations: Sequence[float]
+    total: float
+    counts: Optional[Sequence[int]]
+    shortest: float
+
+    def __new__(
+        cls,
+        durations: Sequence[float],
+        total: float,
+        counts: Optional[Sequence[int]] = None,
+    ) -> "DurationBatch":
+        array: Any = durations
+        if is_numpy_array(durations):
+            longest, shortest = float(array.max()), float(array.min())
+        else:
+            longest, shortest = max(durations), min(durations)
+        batch = super().__new__(cls, longest)
+        batch.durations = durations
+        batch.total = total
+        batch.counts = counts
+        batch.shortest = shortest
+        return batch
+
+
+def summarize_batch(
+    durations: Sequence[Optional[float]],
+    results: Optional[Sequence[BatchResult]] = None,
+) -> Tuple[Dict[Result, int], Sequence[float], float]:
+    """Count the calls of a batch per result, and collect the durations (and their total) of the timed calls.
+
+    Without results, all the calls are counted as successful. NumPy arrays of durations
+    (where NaN marks a call that was not timed) and of boolean results are summarized
+    without iterating over them in Python."""
+    if results is not None and len(results) != len(durations):
+        raise ValueError(
+            f"Got {len(durations)} durations but {len(results)} results, they should have the same length."
+        )
+
+    counts: Dict[Result, int] = {}
+    array: Any = results
+    if results is None:
+        counts[Result.OK] = len(durations)
+    elif is_numpy_array(results) and array.dtype.kind == "b":
+        successes = int(array.sum())
+        counts[Result.OK] = successes
+        counts[Result.ERROR] = len(results) - successes
+    else:
+        for result in results:
+            if not isinstance(result, Result):
+                result = Result.OK if result else Result.ERROR
+            counts[result] = counts.get(result, 0) + 1
+
+    if is_numpy_array(durations):
+        array = durations
+        timed_array = array[array == array]  # NaN is not equal to itself
+        return counts, timed_array, float(timed_array.sum())
+    timed = [duration for duration in durations if duration is not None]
+    return counts, timed, sum(timed)
+
+
+def bucket_counts(
+    bounds: Sequence[float],
+    durations: Sequence[float],
+    counts: Optional[Sequence[int]] = None,
+) -> List[int]:
+    """Count the durations per histogram bucket.
+
+    A duration is counted in the first bucket whose (inclusive) upper bound it does not
+    exceed, the last count is for the durations above all the bounds. With `counts`,
+    every duration stands for that many calls."""
+    if is_numpy_array(durations):
+        # pylint: disable=import-outside-toplevel
+        import numpy
+
+        indices = numpy.searchsorted(bounds, durations, side="left")
+        return (
+            numpy.bincount(indices, weights=counts, minlength=len(bounds) + 1)
+            .astype(int)
+            .tolist()
+        )
+
+    bucketed = [0] * (len(bounds) + 1)
+    if counts is None:
+        for duration in durations:
+            bucketed[bisect_left(bounds, duration)] += 1
+    else:
+        for duration, count in zip(durations, counts):
+            bucketed[bisect_left(bounds, duration)] += count
+    return bucketed
+
+
+def bucket_means(
+    bounds: Sequence[float], counts: Sequence[int], sums: Sequence[float]
+) -> Tuple[List[float], List[int]]:
+    """Get the mean duration and the number of calls of the buckets of a histogram that
+    have calls.
+
+    Rounding should not move a mean out of its bucket, so a mean that ends up outside of
+    it is replaced by the upper bound of the bucket (or a duration just above the last
+    bound, for the last bucket)."""
+    means: List[float] = []
+    weights: List[int] = []
+    for index, count in enumerate(counts):
+        if not count:
+            continue
+        mean = sums[index] / count
+        if index < len(bounds) and not mean <= bounds[index]:
+            mean = bounds[index]
+        elif index > 0 and not mean > bounds[index - 1]:
+            mean = (
+                bounds[index]
+                if index < len(bounds)
+                else bounds[-1] * (1 + 2 * sys.float_info.epsilon)
+            )
+        means.append(mean)
+        weights.append(count)
+    return means, weights
+
+
+def rebucket(
+    bounds: Sequence[float],
+    counts: Sequence[int],
+    sums: Sequence[float],
+    target: Sequence[float],
+) -> List[int]:
+    """Count the calls of the buckets of a histogram in the buckets with the `target`
+    bounds (with a last bucket for the calls above all of them).
+
+    With other bounds, the calls of a bucket are counted in the target bucket of their
+    mean duration."""
+    if tuple(bounds) == tuple(target):
+        return list(counts)
+    means, weights = bucket_means(bounds, counts, sums)
+    return bucket_counts(target, means, weights)
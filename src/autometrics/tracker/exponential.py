@@ -0,0 +1,205 @@
+"""Histograms with exponential buckets, and the fixed exponential buckets that they are
+exposed to Prometheus with."""
+import threading
+
+from itertools import repeat
+from math import ceil, frexp, ldexp, log
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+LN_2 = log(2)
+MIN_SCALE = -10
+MAX_SCALE = 20
+DEFAULT_MAX_SCALE = 20
+DEFAULT_MAX_BUCKETS = 160
+# The durations (in seconds) that a fixed layout covers: shorter durations are counted
+# in its first bucket, longer ones in the +Inf bucket
+LAYOUT_LOWEST = 1e-5
+LAYOUT_HIGHEST = 100.0
+# The coarsest scale of a fixed layout, at which its range fits in 2 buckets (with
+# finite bounds)
+LAYOUT_MIN_SCALE = -5
+
+
+def upper_bound(index: int, scale: int) -> float:
+    """Get the upper bound of the bucket with the given index, at the given scale.
+
+    The buckets grow by a factor of `2 ** (2 ** -scale)`: bucket `index` holds the values
+    in `(base ** index, base ** (index + 1)]`, like the buckets of OpenTelemetry's
+    exponential histograms and Prometheus' native histograms."""
+    if scale <= 0:
+        return ldexp(1.0, (index + 1) << -scale)
+    return 2.0 ** ((index + 1) / (1 << scale))
+
+
+def bucket_index(value: float, scale: int) -> int:
+    """Get the index of the bucket that holds a (positive) value at the given scale."""
+    mantissa, exponent = frexp(value)
+    if mantissa == 0.5:
+        # Exact powers of two are the upper bound of their bucket
+        if scale <= 0:
+            return (exponent - 2) >> -scale
+        return ((exponent - 1) << scale) - 1
+    if scale <= 0:
+        return (exponent - 1) >> -scale
+    return ceil(log(value) * (1 << scale) / LN_2) - 1
+
+
+class ExponentialLayout(NamedTuple):
+    """Exponential buckets with fixed bounds: the buckets `first` to `last` at `scale`,
+    followed by the +Inf bucket."""
+
+    scale: int
+    first: int
+    last: int
+
+    @property
+    def bounds(self) -> Tuple[float, ...]:
+        """The upper bounds of the buckets, without +Inf."""
+        return tuple(
+            upper_bound(index, self.scale) for index in range(self.first, self.last + 1)
+        )
+
+    def position(self, index: int, scale: int) -> int:
+        """Get the position in the layout of the bucket with the given index at the
+        given scale.
+
+        At a finer scale, every bucket lies within a bucket of the layout. At a coarser
+        scale, the bucket goes into the bucket of the layout with the same upper bound.
+        """
+        if scale >= self.scale:
+            index >>= scale - self.scale
+        else:
+            index = ((index + 1) << (self.scale - scale)) - 1
+        return min(max(index - self.first, 0), self.last - self.first + 1)
+
+    def rebucket(self, zero_count: int, scale: int, counts: Iterable[Tuple[int, int]]):
+        """Count the (index, count) pairs of exponential buckets at the given scale in the
+        buckets of the layout (values of zero go into the first one)."""
+        bucket_counts = [0] * (self.last - self.first + 2)
+        bucket_counts[0] += zero_count
+        for index, count in counts:
+            if count:
+                bucket_counts[self.position(index, scale)] += count
+        return bucket_counts
+
+
+def fixed_layout(max_scale: int, max_buckets: int) -> ExponentialLayout:
+    """Get exponential buckets from `LAYOUT_LOWEST` to `LAYOUT_HIGHEST` seconds, at the
+    finest scale (up to `max_scale`) at which they fit in `max_buckets` buckets.
+
+    The Prometheus client library cannot expose native histograms, so exponential
+    histograms are exposed to Prometheus with these buckets, which are the same on every
+    scrape and for every function."""
+    scale = max(max_scale, LAYOUT_MIN_SCALE)
+    while True:
+        first = bucket_index(LAYOUT_LOWEST, scale)
+        last = bucket_index(LAYOUT_HIGHEST, scale)
+        if last - first + 1 <= max_buckets or scale <= LAYOUT_MIN_SCALE:
+            return ExponentialLayout(scale, first, last)
+        scale -= 1
+
+
+def sparse_buckets(
+    scale: int, zero_count: int, counts: Iterable[Tuple[int, int]]
+) -> Tuple[List[float], List[int]]:
+    """Convert the (index, count) pairs of exponential buckets, in order, to the upper
+    bounds and counts of the buckets that are not empty, followed by the count of the
+    +Inf bucket (which is empty).
+
+    Values of zero are counted in a bucket with an upper bound of 0."""
+    bounds: List[float] = []
+    bucket_counts: List[int] = []
+    if zero_count:
+        bounds.append(0.0)
+        bucket_counts.append(zero_count)
+    for index, count in counts:
+        if count:
+            bounds.append(upper_bound(index, scale))
+            bucket_counts.append(count)
+    bucket_counts.append(0)
+    return bounds, bucket_counts
+
+
+class ExponentialHistogram:
+    """A histogram of durations with exponential buckets, which only keeps the buckets
+    that have values.
+
+    The histogram starts at `max_scale` (the finest resolution). When more than
+    `max_buckets` buckets have values, the scale is lowered and neighbouring buckets are
+    merged, so the memory (and the number of series when it is exposed) stays bounded.
+    """
+
+    __slots__ = ("scale", "max_buckets", "counts", "zero_count", "sum", "_lock")
+
+    def __init__(
+        self, max_scale: int = DEFAULT_MAX_SCALE, max_buckets: int = DEFAULT_MAX_BUCKETS
+    ):
+        self.scale = max_scale
+        self.max_buckets = max_buckets
+        self.counts: Dict[int, int] = {}
+        self.zero_count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def bucket_index(self, value: float) -> int:
+        """Get the index of the bucket that holds a (positive) value at the current scale."""
+        return bucket_index(value, self.scale)
+
+    def observe(self, value: float):
+        """Observe a duration in seconds."""
+        with self._lock:
+            self.sum += value
+            if value <= 0.0:
+                self.zero_count += 1
+                return
+            index = self.bucket_index(value)
+            counts = self.counts
+            counts[index] = counts.get(index, 0) + 1
+            if len(counts) > self.max_buckets:
+                self._downscale()
+
+    def observe_many(
+        self,
+        values: Sequence[float],
+        total: float,
+        weights: Optional[Sequence[int]] = None,
+    ):
+        """Observe a batch of durations that add up to `total`, under a single
+        acquisition of the lock. With `weights`, every duration is observed that many
+        times."""
+        with self._lock:
+            self.sum += total
+            counts = self.counts
+            for value, weight in zip(values, repeat(1) if weights is None else weights):
+                if value <= 0.0:
+                    self.zero_count += weight
+                    continue
+                index = bucket_index(value, self.scale)
+                counts[index] = counts.get(index, 0) + weight
+                if len(counts) > self.max_buckets:
+                    self._downscale()
+                    counts = self.counts
+
+    def _downscale(self) -> None:
+        """Merge pairs of neighbouring buckets until the buckets fit."""
+        counts = self.counts
+        while len(counts) > self.max_buckets and self.scale > MIN_SCALE:
+            merged: Dict[int, int] = {}
+            for index, count in counts.items():
+                merged[index >> 1] = merged.get(index >> 1, 0) + count
+            counts = merged
+            self.scale -= 1
+        self.counts = counts
+
+    def buckets(self) -> Tuple[List[float], List[int]]:
+        """Get the upper bounds and counts of the buckets that have values, see `sparse_buckets`."""
+        with self._lock:
+            scale, zero_count, counts = self.scale, self.zero_count, dict(self.counts)
+        return sparse_buckets(scale, zero_count, sorted(counts.items()))
+
+    def clear(self):
+        """Drop the observed values."""
+        with self._lock:
+            self.counts = {}
+            self.zero_count = 0
+            self.sum = 0.0
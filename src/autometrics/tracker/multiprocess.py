@@ -0,0 +1,526 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import weakref
+
+from array import array
+from bisect import bisect_left
+from operator import add
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from .batch import bucket_counts, rebucket, summarize_batch
+from .sharded import CounterKey, HistogramKey, Shard
+from .types import BatchResult, Result
+
+VALUE = struct.Struct("d")
+INDEX_FILE = "series.idx"
+LOCK_FILE = "merge.lock"
+RETIRED_FILE = "retired.db"
+WORKER_PREFIX = "worker_"
+WORKER_SUFFIX = ".db"
+# The values at the start of a worker file, before the series: its number of writes
+HEADER_SIZE = 1
+
+# ("counter", *CounterKey) or ("histogram", *HistogramKey)
+SeriesKey = Tuple[str, ...]
+
+
+class SeriesIndex:
+    """The offsets of the series in the value files of the workers.
+
+    The series are appended to a file that all processes share, so every process assigns
+    the same offset (in values) to a series. A counter takes one value, a histogram takes
+    one value per bucket (including +Inf) followed by the sum."""
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, INDEX_FILE)
+        self.offsets: Dict[SeriesKey, int] = {}
+        self.size = 0
+        """The number of values of all the series."""
+        self._position = 0
+        self._lock = threading.Lock()
+
+    def offset(self, key: SeriesKey, width: int) -> int:
+        """Get the offset of a series, adding it to the index if it is new."""
+        offset = self.offsets.get(key)
+        if offset is not None:
+            return offset
+        with self._lock, open(self.path, "ab+") as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            self._read(index_file)
+            if key not in self.offsets:
+                index_file.write(json.dumps([width, *key]).encode("utf-8") + b"\n")
+                index_file.flush()
+                self._read(index_file)
+        return self.offsets[key]
+
+    def refresh(self):
+        """Read the series that other processes added to the index."""
+        if not os.path.exists(self.path):
+            return
+        with self._lock, open(self.path, "rb") as index_file:
+            self._read(index_file)
+
+    def _read(self, index_file):
+        index_file.seek(self._position)
+        for line in index_file:
+            if not line.endswith(b"\n"):
+                # Still being written
+                break
+            self._position += len(line)
+            width, *key = json.loads(line)
+            self.offsets[tuple(key)] = self.size
+            self.size += width
+
+
+class WorkerValues:
+    """The values of all the series written by one process, in a memory-mapped file.
+
+    The process holds a lock on the file for as long as it runs, which tells the merging
+    processes that it is alive. The file starts with the number of writes, so they can
+    skip the files that did not change since they last read them."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = lock_worker_file(path)
+        self._mmap: Optional[mmap.mmap] = None
+        self._capacity = 0
+        # A dead process with the same pid may have left writes in the file
+        header = os.pread(self._fd, VALUE.size, 0)
+        self._writes = VALUE.unpack(header)[0] if len(header) == VALUE.size else 0.0
+
+    def reserve(self, size: int):
+        """Make sure the file has room for the given number of values."""
+        if size + HEADER_SIZE > self._capacity:
+            capacity = max((size + HEADER_SIZE) * 2, mmap.PAGESIZE // VALUE.size)
+            os.ftruncate(self._fd, capacity * VALUE.size)
+            previous = self._mmap
+            self._mmap = mmap.mmap(self._fd, capacity * VALUE.size)
+            self._capacity = capacity
+            if previous is not None:
+                previous.close()
+
+    def add(self, offset: int, amount: float):
+        """Add an amount to a value. The file should have room for it."""
+        assert self._mmap is not None
+        position = (offset + HEADER_SIZE) * VALUE.size
+        (value,) = VALUE.unpack_from(self._mmap, position)
+        VALUE.pack_into(self._mmap, position, value + amount)
+        self._writes += 1
+        VALUE.pack_into(self._mmap, 0, self._writes)
+
+    def add_many(self, offset: int, amounts: Sequence[float]):
+        """Add amounts to a run of consecutive values, with one read and one write.
+        The file should have room for them."""
+        assert self._mmap is not None
+        run = _runs.get(len(amounts))
+        if run is None:
+            run = _runs.setdefault(len(amounts), struct.Struct(f"{len(amounts)}d"))
+        position = (offset + HEADER_SIZE) * VALUE.size
+        values = run.unpack_from(self._mmap, position)
+        run.pack_into(self._mmap, position, *map(add, values, amounts))
+        self._writes += 1
+        VALUE.pack_into(self._mmap, 0, self._writes)
+
+    def close(self):
+        """Unmap and close the file, which releases the lock of this process on it."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        os.close(self._fd)
+
+
+# The structs of runs of values, by length
+_runs: Dict[int, struct.Struct] = {}
+
+
+def lock_worker_file(path: str) -> int:
+    """Open the file of a worker, and lock it for as long as the process runs.
+
+    A merge that retired the file of a dead process with the same pid may have unlinked
+    it while waiting for the lock, then the file is created again."""
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def is_locked(fd: int) -> bool:
+    """Check if the process of a worker file still holds its lock, otherwise take it."""
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    return False
+
+
+def read_values(path: str, size: int) -> array:
+    """Read the values of a file, padded or truncated to the given number of values."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return read_fd(fd, size)
+    finally:
+        os.close(fd)
+
+
+def read_fd(fd: int, size: int, start: int = 0) -> array:
+    """Read `size` values of an open file from the value at `start`, padded with zeros if
+    the file is shorter."""
+    values = array("d")
+    data = os.pread(fd, size * VALUE.size, start * VALUE.size)
+    values.frombytes(data[: len(data) - len(data) % VALUE.size])
+    if len(values) < size:
+        values.frombytes(bytes((size - len(values)) * VALUE.size))
+    return values
+
+
+def read_writes(fd: int) -> float:
+    """Read the number of writes of a worker file."""
+    return read_fd(fd, 1)[0]
+
+
+_accumulators: "weakref.WeakSet[MultiprocessAccumulator]" = weakref.WeakSet()
+
+
+class MultiprocessAccumulator:
+    """Accumulates counts and histogram buckets in a directory shared by several processes.
+
+    Every process writes to its own memory-mapped file, in which every series has the same
+    offset, so merging the files is a matter of adding up arrays of values. The totals are
+    kept between merges, and only the files that were written since the last merge are
+    read again. The values of processes that have exited are folded into a single retired
+    file when the metrics are merged, so the files of dead workers do not pile up."""
+
+    def __init__(self, directory: str, buckets: Sequence[float]):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        self.lock = threading.Lock()
+        """Held while writing to the file of this process."""
+        self._index = SeriesIndex(directory)
+        self._values: Optional[WorkerValues] = None
+        # The state of the last merge: the totals, the values of the retired file (and
+        # the status of the file they were read from) and, per worker file, its number of
+        # writes and values
+        self._total = array("d")
+        self._retired = array("d")
+        self._retired_status: Optional[Tuple[int, int, int]] = None
+        self._workers: Dict[str, Tuple[float, array]] = {}
+        _accumulators.add(self)
+
+    def counter_offset(self, key: CounterKey) -> int:
+        """Get the offset of a counter, initializing it at zero if it is new."""
+        return self._index.offset(("counter", *key), 1)
+
+    def histogram_offset(self, key: HistogramKey) -> int:
+        """Get the offset of a histogram, initializing it at zero if it is new."""
+        return self._index.offset(("histogram", *key), len(self.buckets) + 2)
+
+    def buckets_for(self, key: HistogramKey) -> Tuple[float, ...]:
+        """Get the buckets of a histogram, all histograms have the same buckets."""
+        return self.buckets
+
+    def values(self) -> WorkerValues:
+        """Get the values of this process. Should be called while holding the lock."""
+        values = self._values
+        if values is None:
+            values = self._values = WorkerValues(
+                os.path.join(
+                    self.directory, f"{WORKER_PREFIX}{os.getpid()}{WORKER_SUFFIX}"
+                )
+            )
+        values.reserve(self._index.size)
+        return values
+
+    def merged(self) -> Shard:
+        """Merge the values of all processes into a new shard."""
+        with open(
+            os.path.join(self.directory, LOCK_FILE), "a", encoding="utf-8"
+        ) as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._index.refresh()
+            size = self._index.size
+            total = self._total
+            for values in [total, self._retired] + [
+                values for _, values in self._workers.values()
+            ]:
+                if len(values) < size:
+                    values.frombytes(bytes((size - len(values)) * VALUE.size))
+
+            paths = {
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.startswith(WORKER_PREFIX) and name.endswith(WORKER_SUFFIX)
+            }
+            # Another process retired these files, their values are in the retired file
+            for path in set(self._workers) - paths:
+                add_values(
+                    total,
+                    array("d", bytes(size * VALUE.size)),
+                    self._workers.pop(path)[1],
+                )
+            self._merge_retired(size)
+
+            dead = []
+            try:
+                for path in sorted(paths):
+                    fd = os.open(path, os.O_RDONLY)
+                    alive = is_locked(fd)
+                    writes = read_writes(fd)
+                    previous = self._workers.get(path)
+                    if previous is None or previous[0] != writes or not alive:
+                        values = read_fd(fd, size, HEADER_SIZE)
+                        add_values(
+                            total, values, None if previous is None else previous[1]
+                        )
+                        self._workers[path] = (writes, values)
+                    if alive:
+                        os.close(fd)
+                    else:
+                        # Keep the lock until the file is unlinked
+                        dead.append((path, fd))
+                if dead:
+                    for path, _ in dead:
+                        add_values(self._retired, self._workers.pop(path)[1])
+                    self._write_retired()
+                    for path, _ in dead:
+                        os.unlink(path)
+            finally:
+                for _, fd in dead:
+                    os.close(fd)
+            total = array("d", total)
+
+        shard = Shard()
+        for key, offset in self._index.offsets.items():
+            kind, *labels = key
+            if kind == "counter":
+                shard.counts[tuple(labels)] = total[offset]  # type: ignore
+            else:
+                shard.histograms[tuple(labels)] = total[  # type: ignore
+                    offset : offset + len(self.buckets) + 2
+                ].tolist()
+        return shard
+
+    def _merge_retired(self, size: int):
+        """Read the retired file again if another process changed it. Should be called
+        while holding the merge lock."""
+        path = os.path.join(self.directory, RETIRED_FILE)
+        try:
+            status = os.stat(path)
+        except FileNotFoundError:
+            return
+        key = (status.st_ino, status.st_mtime_ns, status.st_size)
+        if key != self._retired_status:
+            retired = read_values(path, size)
+            add_values(self._total, retired, self._retired)
+            self._retired = retired
+            self._retired_status = key
+
+    def _write_retired(self):
+        """Replace the retired file with the retired values. Should be called while
+        holding the merge lock."""
+        path = os.path.join(self.directory, RETIRED_FILE)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as retired_file:
+            self._retired.tofile(retired_file)
+        os.replace(temporary_path, path)
+        status = os.stat(path)
+        self._retired_status = (status.st_ino, status.st_mtime_ns, status.st_size)
+
+    def _after_fork(self):
+        # The child writes to a file of its own, and should not keep the lock on the file
+        # of the parent, which would keep it alive
+        self.lock = threading.Lock()
+        if self._values is not None:
+            self._values.close()
+        self._values = None
+
+
+def add_values(total: array, values: array, previous: Optional[array] = None):
+    """Add the values of one file to the total in place, less the `previous` values of
+    that file that were already added. Only the values that changed are updated."""
+    if previous is None:
+        for index, value in enumerate(values):
+            if value:
+                total[index] += value
+    else:
+        for index, value in enumerate(values):
+            change = value - previous[index]
+            if change:
+                total[index] += change
+
+
+def _after_fork_in_child():
+    for accumulator in list(_accumulators):
+        accumulator._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class MultiprocessFunctionMetrics:
+    """Metrics of a single function that are accumulated in a directory shared by several processes."""
+
+    def __init__(
+        self,
+        accumulator: MultiprocessAccumulator,
+        counter_labels: Tuple[str, str, str, str, str],
+        histogram_key: HistogramKey,
+        sample_rate: float,
+        concurrency_inc: Optional[Callable[[], None]] = None,
+        concurrency_dec: Optional[Callable[[], None]] = None,
+    ):
+        self.sample_rate = sample_rate
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+        self._accumulator = accumulator
+        self._buckets = accumulator.buckets
+        self._counter_labels = counter_labels
+        self._counter_offsets: Dict[Tuple[str, str, Result], int] = {}
+        self._histogram_offset = accumulator.histogram_offset(histogram_key)
+        self._concurrency_inc = concurrency_inc
+        self._concurrency_dec = concurrency_dec
+
+        for result in Result:
+            self._counter_offset_for("", "", result)
+
+    def _counter_offset_for(
+        self, caller_module: str, caller_function: str, result: Result
+    ) -> int:
+        """Look up (and cache) the offset of the counter for the given caller and result."""
+        key = (caller_module, caller_function, result)
+        offset = self._counter_offsets.get(key)
+        if offset is None:
+            (
+                function,
+                module,
+                service_name,
+                objective_name,
+                percentile,
+            ) = self._counter_labels
+            offset = self._counter_offsets.setdefault(
+                key,
+                self._accumulator.counter_offset(
+                    (
+                        function,
+                        module,
+                        service_name,
+                        result.value,
+                        caller_module,
+                        caller_function,
+                        objective_name,
+                        percentile,
+                    )
+                ),
+            )
+        return offset
+
+    def start(self):
+        """Start tracking metrics for a function call."""
+        if self._concurrency_inc is not None:
+            self._concurrency_inc()
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Finish tracking metrics for a function call."""
+        counter_offset = self._counter_offsets.get(
+            (caller_module, caller_function, result)
+        )
+        if counter_offset is None:
+            counter_offset = self._counter_offset_for(
+                caller_module, caller_function, result
+            )
+
+        self.calls += 1
+        with self._accumulator.lock:
+            values = self._accumulator.values()
+            values.add(counter_offset, 1)
+            if duration is not None:
+                self.timed_calls += 1
+                self.timed_duration += duration
+                values.add(
+                    self._histogram_offset + bisect_left(self._buckets, duration), 1
+                )
+                values.add(self._histogram_offset + len(self._buckets) + 1, duration)
+
+        if self._concurrency_dec is not None:
+            self._concurrency_dec()
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Finish tracking metrics for a batch of calls to the function from the same caller."""
+        counts, timed, total = summarize_batch(durations, results)
+        counter_offsets = [
+            (self._counter_offset_for(caller_module, caller_function, result), count)
+            for result, count in counts.items()
+        ]
+
+        self.calls += len(durations)
+        with self._accumulator.lock:
+            values = self._accumulator.values()
+            for counter_offset, count in counter_offsets:
+                values.add(counter_offset, count)
+            if len(timed):
+                self.timed_calls += len(timed)
+                self.timed_duration += total
+                # The buckets and the sum of the histogram are consecutive values
+                values.add_many(
+                    self._histogram_offset,
+                    [*bucket_counts(self._buckets, timed), total],
+                )
+
+        if self._concurrency_dec is not None:
+            for _ in durations:
+                self._concurrency_dec()
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls that were already counted in histogram buckets."""
+        timed = sum(bucket_counts)
+        counter_offset = self._counter_offset_for(
+            caller_module, caller_function, result
+        )
+
+        self.calls += untimed + timed
+        with self._accumulator.lock:
+            values = self._accumulator.values()
+            values.add(counter_offset, untimed + timed)
+            if timed:
+                total = sum(bucket_sums)
+                self.timed_calls += timed
+                self.timed_duration += total
+                values.add_many(
+                    self._histogram_offset,
+                    [
+                        *rebucket(bounds, bucket_counts, bucket_sums, self._buckets),
+                        total,
+                    ],
+                )
@@ -1,22 +1,81 @@
-import time
-from typing import Dict, Optional, Mapping
+import logging
 
+from bisect import bisect_right
+from time import perf_counter_ns
+from dataclasses import replace
+from functools import partial
+from itertools import repeat
+from operator import mul
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Mapping,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from opentelemetry.context import Context
 from opentelemetry.exporter.prometheus import PrometheusMetricReader
 from opentelemetry.metrics import (
+    CallbackOptions,
     Counter,
     Histogram,
+    Observation,
     UpDownCounter,
     set_meter_provider,
 )
 from opentelemetry.semconv.resource import ResourceAttributes
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.view import View, ExplicitBucketHistogramAggregation
-from opentelemetry.sdk.metrics.export import MetricReader
+from opentelemetry.sdk.metrics import (
+    Exemplar,
+    ExemplarReservoir,
+    MeterProvider,
+    SimpleFixedSizeExemplarReservoir,
+)
+from opentelemetry.sdk.metrics.view import (
+    ExplicitBucketHistogramAggregation,
+    ExponentialBucketHistogramAggregation,
+    View,
+)
+from opentelemetry.sdk.metrics.export import (
+    ExponentialHistogram,
+    ExponentialHistogramDataPoint,
+    Histogram as HistogramData,
+    HistogramDataPoint,
+    InMemoryMetricReader,
+    Metric as MetricData,
+    MetricReader,
+    MetricsData,
+)
 from opentelemetry.sdk.resources import Resource
-from opentelemetry.util.types import AttributeValue
+from opentelemetry.util.types import AttributeValue, Attributes as MeasurementAttributes
+from prometheus_client.metrics_core import Metric
+from prometheus_client.samples import Exemplar as PrometheusExemplar
 
-from ..exemplar import get_exemplar
-from .types import Result
+from ..buckets import function_buckets
+from ..exemplar import (
+    DEFAULT_TAIL_EXEMPLARS,
+    ExemplarLabels,
+    TailExemplarReservoir,
+    get_trace_context,
+)
+from .batch import (
+    DurationBatch,
+    bucket_counts,
+    bucket_means,
+    is_numpy_array,
+    summarize_batch,
+)
+from .exponential import ExponentialLayout, fixed_layout
+from .sharded import ShardedAccumulator, ShardedFunctionMetrics
+from .types import BatchResult, FunctionMetrics, Result
+from .warmup import create_warmup
 from ..objectives import Objective, ObjectiveLatency
 from ..constants import (
     AUTOMETRICS_VERSION,
@@ -30,27 +89,269 @@ from ..constants import (
     BUILD_INFO_DESCRIPTION,
     REPOSITORY_PROVIDER,
     REPOSITORY_URL,
+    SAMPLE_RATE,
     SERVICE_NAME,
     OBJECTIVE_NAME,
     OBJECTIVE_PERCENTILE,
     OBJECTIVE_LATENCY_THRESHOLD,
-    SPEC_VERSION,
+    QUANTILES_DESCRIPTION,
+    QUANTILES_NAME,
+    OBJECTIVE_BUDGET_DESCRIPTION,
+    OBJECTIVE_BUDGET_NAME,
+    OBJECTIVE_BURN_RATE_DESCRIPTION,
+    OBJECTIVE_BURN_RATE_NAME,
 )
-from ..settings import get_settings
+from ..settings import get_settings, SettingsSnapshot
+from ..sketch import function_sketches
+from ..slo import objective_evaluators, status_gauges
+
+if TYPE_CHECKING:
+    from .multiprocess import MultiprocessAccumulator
 
 LabelValue = AttributeValue
 Attributes = Dict[str, LabelValue]
 
 
 def get_resource_attrs() -> Attributes:
+    settings = get_settings()
     attrs: Attributes = {}
-    if get_settings()["service_name"] is not None:
-        attrs[ResourceAttributes.SERVICE_NAME] = get_settings()["service_name"]
-    if get_settings()["version"] is not None:
-        attrs[ResourceAttributes.SERVICE_VERSION] = get_settings()["version"]
+    if settings.service_name is not None:
+        attrs[ResourceAttributes.SERVICE_NAME] = settings.service_name
+    if settings.version is not None:
+        attrs[ResourceAttributes.SERVICE_VERSION] = settings.version
     return attrs
 
 
+def get_objective_attributes(
+    objective: Optional[Objective],
+) -> Tuple[str, str, str, str]:
+    """Get the objective name, success rate percentile, latency percentile and latency threshold attributes."""
+    objective_name = "" if objective is None else objective.name
+    success_percentile = (
+        ""
+        if objective is None or objective.success_rate is None
+        else objective.success_rate.value
+    )
+    latency = None if objective is None else objective.latency
+    latency_percentile = ""
+    threshold = ""
+    if latency is not None:
+        threshold = latency[0].value
+        latency_percentile = latency[1].value
+    return objective_name, success_percentile, latency_percentile, threshold
+
+
+class ExemplarFilter:
+    """Makes the measurements of sampled traces eligible as exemplars, while exemplars are enabled.
+
+    This is the trace based exemplar filter of the SDK, which can be switched on and off
+    at runtime (see `update_settings`)."""
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+
+    def should_sample(
+        self,
+        value: float,
+        time_unix_nano: int,
+        attributes: Any,
+        context: Optional[Context],
+    ) -> bool:
+        """Check if a measurement can be an exemplar."""
+        return self.enabled and get_trace_context(context) is not None
+
+
+class FunctionBucketAggregation(ExplicitBucketHistogramAggregation):
+    """Aggregates the durations of every function in explicit buckets, with the buckets
+    of the function if it has any.
+
+    A view applies one aggregation to all the series of an instrument, the aggregation of
+    every series is created (from its attributes) when its first value is recorded."""
+
+    def __init__(
+        self,
+        boundaries: Sequence[float],
+        layouts: Mapping[Tuple[str, str], Tuple[float, ...]],
+    ):
+        super().__init__(boundaries=boundaries)
+        self.layouts = layouts
+        """The buckets of the functions that have their own, by function and module."""
+
+    def _create_aggregation(self, instrument: Any, attributes: Any, *args: Any) -> Any:
+        series = attributes or {}
+        layout = self.layouts.get(
+            (series.get("function", ""), series.get("module", ""))
+        )
+        aggregation: Any
+        if layout is None:
+            aggregation = super()._create_aggregation(instrument, attributes, *args)
+        else:
+            # The arguments differ between versions of the SDK
+            # pylint: disable=protected-access
+            aggregation = ExplicitBucketHistogramAggregation(
+                boundaries=layout
+            )._create_aggregation(instrument, attributes, *args)
+        aggregation.aggregate = partial(
+            aggregate_buckets, aggregation, aggregation.aggregate
+        )
+        # Batches of durations are added in a single update of the aggregation
+        return aggregation
+
+
+class FunctionExponentialAggregation(ExponentialBucketHistogramAggregation):
+    """Aggregates the durations of every function in exponential buckets, and the batches
+    of durations in as many updates as they fill buckets."""
+
+    def _create_aggregation(self, instrument: Any, attributes: Any, *args: Any) -> Any:
+        aggregation: Any = super()._create_aggregation(instrument, attributes, *args)
+        aggregation.aggregate = partial(
+            aggregate_exponential_buckets, aggregation, aggregation.aggregate
+        )
+        return aggregation
+
+
+# pylint: disable=protected-access
+def aggregate_buckets(
+    aggregation: Any,
+    aggregate: Callable[..., None],
+    measurement: Any,
+    should_sample_exemplar: bool = True,
+):
+    """Add a measurement to an explicit bucket aggregation of the SDK, and all the
+    durations of a `DurationBatch` at once, under a single acquisition of its lock."""
+    batch = measurement.value
+    if type(batch) is not DurationBatch:
+        aggregate(measurement, should_sample_exemplar)
+        return
+
+    counts = bucket_counts(aggregation._boundaries, batch.durations, batch.counts)
+    with aggregation._lock:
+        if aggregation._value is None:
+            aggregation._value = aggregation._get_empty_bucket_counts()
+        value = aggregation._value
+        for index, count in enumerate(counts):
+            if count:
+                value[index] += count
+        aggregation._sum += batch.total
+        if aggregation._record_min_max:
+            aggregation._min = min(aggregation._min, batch.shortest)
+            aggregation._max = max(aggregation._max, float(batch))
+    aggregation._sample_exemplar(
+        replace(measurement, value=float(batch)), should_sample_exemplar
+    )
+
+
+def aggregate_exponential_buckets(
+    aggregation: Any,
+    aggregate: Callable[..., None],
+    measurement: Any,
+    should_sample_exemplar: bool = True,
+):
+    """Add a measurement to an exponential bucket aggregation of the SDK, and the
+    durations of a `DurationBatch` bucket by bucket, see `_aggregate_run`."""
+    batch = measurement.value
+    if type(batch) is not DurationBatch:
+        aggregate(measurement, should_sample_exemplar)
+        return
+
+    durations: Any = batch.durations
+    if is_numpy_array(durations):
+        durations = durations.tolist()
+    counts: Any = batch.counts
+    if counts is None:
+        durations = sorted(durations)
+    else:
+        order = sorted(range(len(durations)), key=durations.__getitem__)
+        durations = [durations[index] for index in order]
+        counts = [counts[index] for index in order]
+    start = 0
+    while start < len(durations):
+        first = durations[start]
+        if first == 0:
+            end = bisect_right(durations, 0.0, start)
+        else:
+            mapping = aggregation._mapping
+            upper = mapping.get_lower_boundary(mapping.map_to_index(first) + 1)
+            end = max(bisect_right(durations, upper, start), start + 1)
+        _aggregate_run(
+            aggregation,
+            aggregate,
+            measurement,
+            durations[start:end],
+            None if counts is None else counts[start:end],
+        )
+        start = end
+    aggregation._sample_exemplar(
+        replace(measurement, value=float(batch)), should_sample_exemplar
+    )
+
+
+def _aggregate_run(
+    aggregation: Any,
+    aggregate: Callable[..., None],
+    measurement: Any,
+    durations: Sequence[float],
+    counts: Optional[Sequence[int]],
+):
+    """Add sorted durations (that stand for `counts` calls each) that fall into a single
+    bucket of an exponential aggregation.
+
+    The first duration goes through the aggregation of the SDK, which grows or rescales
+    the buckets for it, the others are added to the count of its bucket. If a concurrent
+    measurement or collection changed the buckets in between, every duration goes through
+    the aggregation of the SDK instead."""
+    first = durations[0]
+    aggregate(replace(measurement, value=first), False)
+    if counts is None:
+        count, total = len(durations) - 1, sum(durations) - first
+    else:
+        count, total = sum(counts) - 1, sum(map(mul, durations, counts)) - first
+    if not count or _add_to_bucket(aggregation, first, durations[-1], count, total):
+        return
+    remaining = list(zip(durations, repeat(1) if counts is None else counts))
+    remaining[0] = (first, remaining[0][1] - 1)
+    for duration, count in remaining:
+        while count:
+            aggregate(replace(measurement, value=duration), False)
+            count -= 1
+            if count and _add_to_bucket(
+                aggregation, duration, duration, count, duration * count
+            ):
+                break
+
+
+def _add_to_bucket(
+    aggregation: Any, first: float, last: float, count: int, total: float
+) -> bool:
+    """Add `count` durations from `first` to `last` that add up to `total` to the bucket
+    of an exponential aggregation that `first` was just added to, if they all still fall
+    into it."""
+    with aggregation._lock:
+        positive = aggregation._value_positive
+        if positive is None:
+            return False
+        if first == 0:
+            aggregation._zero_count += count
+        else:
+            mapping = aggregation._mapping
+            index = mapping.map_to_index(first)
+            if (
+                mapping.map_to_index(last) != index
+                or not positive.index_start <= index <= positive.index_end
+            ):
+                return False
+            bucket_index = index - positive.index_base
+            if bucket_index < 0:
+                bucket_index += len(positive.counts)
+            positive.increment_bucket(bucket_index, count)
+            aggregation._sum += total
+            # Exponential aggregations always record the maximum before SDK 1.44
+            if getattr(aggregation, "_record_min_max", True):
+                aggregation._max = max(aggregation._max, last)
+        aggregation._count += count
+    return True
+
+
 class OpenTelemetryTracker:
     """Tracker for OpenTelemetry."""
 
@@ -60,26 +361,84 @@ class OpenTelemetryTracker:
     __up_down_counter_concurrency_instance: UpDownCounter
 
     def __init__(self, reader: Optional[MetricReader] = None):
-        view = View(
-            name=HISTOGRAM_NAME,
-            description=HISTOGRAM_DESCRIPTION,
-            instrument_name=HISTOGRAM_NAME,
-            aggregation=ExplicitBucketHistogramAggregation(
-                boundaries=get_settings()["histogram_buckets"]
-            ),
-        )
+        self._settings = settings = get_settings()
+        # Exemplars are kept by the reservoirs of the SDK, for the measurements that the
+        # exemplar filter lets through
+        self._exemplar_filter = ExemplarFilter(settings.enable_exemplars)
+        # The buckets of the functions that have their own, see `FunctionBucketAggregation`
+        self._layouts: Dict[Tuple[str, str], Tuple[float, ...]] = {}
+        self._warmup = create_warmup(settings)
+        view_options: Dict[str, Any] = {}
+        provider_options: Dict[str, Any] = {}
+        provider_options["exemplar_filter"] = self._exemplar_filter
+        if settings.tail_exemplars:
+            view_options["exemplar_reservoir_factory"] = partial(
+                tail_reservoir_factory,
+                settings.exemplar_reservoir_size or DEFAULT_TAIL_EXEMPLARS,
+            )
+        elif settings.exemplar_reservoir_size is not None:
+            view_options["exemplar_reservoir_factory"] = partial(
+                fixed_size_reservoir_factory, settings.exemplar_reservoir_size
+            )
+        views = [
+            View(
+                name=HISTOGRAM_NAME,
+                description=HISTOGRAM_DESCRIPTION,
+                instrument_name=HISTOGRAM_NAME,
+                aggregation=(
+                    FunctionExponentialAggregation(
+                        max_size=settings.histogram_max_buckets,
+                        max_scale=settings.histogram_max_scale,
+                    )
+                    if settings.exponential_histograms
+                    else FunctionBucketAggregation(
+                        settings.histogram_buckets, self._layouts
+                    )
+                ),
+                **view_options,
+            )
+        ]
+        if view_options:
+            views.append(View(instrument_name=COUNTER_NAME, **view_options))
         resource = Resource.create(get_resource_attrs())
-        readers = [reader or PrometheusMetricReader()]
+        readers = [reader or PrometheusExemplarReader()]
         meter_provider = MeterProvider(
-            views=[view],
+            views=views,
             resource=resource,
             metric_readers=readers,
+            **provider_options,
         )
         set_meter_provider(meter_provider)
+        self._meter_provider = meter_provider
         meter = meter_provider.get_meter(name="autometrics")
-        self.__counter_instance = meter.create_counter(
-            name=COUNTER_NAME, description=COUNTER_DESCRIPTION
-        )
+        self._accumulator: Optional[
+            Union[ShardedAccumulator, "MultiprocessAccumulator"]
+        ] = None
+        multiprocess_dir = settings.multiprocess_dir
+        if multiprocess_dir:
+            # The calls of all processes are merged when the metrics are collected, which
+            # can only be exposed in the Prometheus format.
+            # pylint: disable=import-outside-toplevel
+            from .multiprocess import MultiprocessAccumulator
+            from .prometheus import ShardedPrometheusCollector, use_collector
+
+            self._accumulator = MultiprocessAccumulator(
+                multiprocess_dir, settings.histogram_buckets
+            )
+            use_collector(ShardedPrometheusCollector(self._accumulator))
+        elif settings.thread_sharding:
+            # The calls are counted in per-thread shards, which are merged when the
+            # reader collects the observable counter.
+            self._accumulator = ShardedAccumulator(settings.histogram_buckets)
+            meter.create_observable_counter(
+                name=COUNTER_NAME,
+                callbacks=[self._observe_counters],
+                description=COUNTER_DESCRIPTION,
+            )
+        else:
+            self.__counter_instance = meter.create_counter(
+                name=COUNTER_NAME, description=COUNTER_DESCRIPTION
+            )
         self.__histogram_instance = meter.create_histogram(
             name=HISTOGRAM_NAME,
             description=HISTOGRAM_DESCRIPTION,
@@ -93,82 +452,109 @@ class OpenTelemetryTracker:
             name=CONCURRENCY_NAME,
             description=CONCURRENCY_DESCRIPTION,
         )
-        self._has_set_build_info = False
-
-    def __count(
-        self,
-        function: str,
-        module: str,
-        caller_module: str,
-        caller_function: str,
-        objective: Optional[Objective],
-        exemplar: Optional[dict],
-        result: Result,
-        inc_by: int = 1,
-    ):
-        objective_name = "" if objective is None else objective.name
-        percentile = (
-            ""
-            if objective is None or objective.success_rate is None
-            else objective.success_rate.value
+        # OpenTelemetry has no summaries, the quantiles are gauges with a quantile attribute
+        meter.create_observable_gauge(
+            name=QUANTILES_NAME,
+            callbacks=[self._observe_quantiles],
+            description=QUANTILES_DESCRIPTION,
+            unit="seconds",
         )
-        self.__counter_instance.add(
-            inc_by,
-            attributes={
-                "function": function,
-                "module": module,
-                "result": result.value,
-                "caller.module": caller_module,
-                "caller.function": caller_function,
-                OBJECTIVE_NAME: objective_name,
-                OBJECTIVE_PERCENTILE: percentile,
-                SERVICE_NAME: get_settings()["service_name"],
-            },
+        meter.create_observable_gauge(
+            name=OBJECTIVE_BURN_RATE_NAME,
+            callbacks=[partial(self._observe_objectives, "burn_rate")],
+            description=OBJECTIVE_BURN_RATE_DESCRIPTION,
         )
-
-    def __histogram(
-        self,
-        function: str,
-        module: str,
-        duration: float,
-        objective: Optional[Objective],
-        exemplar: Optional[dict],
-    ):
-        objective_name = "" if objective is None else objective.name
-        latency = None if objective is None else objective.latency
-        percentile = ""
-        threshold = ""
-
-        if latency is not None:
-            threshold = latency[0].value
-            percentile = latency[1].value
-
-        self.__histogram_instance.record(
-            duration,
-            attributes={
-                "function": function,
-                "module": module,
-                SERVICE_NAME: get_settings()["service_name"],
-                OBJECTIVE_NAME: objective_name,
-                OBJECTIVE_PERCENTILE: percentile,
-                OBJECTIVE_LATENCY_THRESHOLD: threshold,
-            },
+        meter.create_observable_gauge(
+            name=OBJECTIVE_BUDGET_NAME,
+            callbacks=[partial(self._observe_objectives, "error_budget_remaining")],
+            description=OBJECTIVE_BUDGET_DESCRIPTION,
         )
+        self._build_info: Optional[Tuple[str, ...]] = None
+        self._functions: Dict[
+            Tuple[
+                str,
+                str,
+                Optional[Objective],
+                bool,
+                Optional[float],
+                Optional[Tuple[float, ...]],
+            ],
+            FunctionMetrics,
+        ] = {}
+
+    def _observe_counters(self, options: CallbackOptions) -> Iterable[Observation]:
+        """Report the merged call counts of all threads."""
+        assert self._accumulator is not None
+        for (
+            function,
+            module,
+            service_name,
+            result,
+            caller_module,
+            caller_function,
+            objective_name,
+            percentile,
+        ), count in self._accumulator.merged().counts.items():
+            yield Observation(
+                count,
+                {
+                    "function": function,
+                    "module": module,
+                    SERVICE_NAME: service_name,
+                    "result": result,
+                    "caller.module": caller_module,
+                    "caller.function": caller_function,
+                    OBJECTIVE_NAME: objective_name,
+                    OBJECTIVE_PERCENTILE: percentile,
+                },
+            )
+
+    def _observe_quantiles(self, options: CallbackOptions) -> Iterable[Observation]:
+        """Report the quantiles of the functions decorated with `quantiles`."""
+        service_name = self._settings.service_name
+        for function_sketch in function_sketches():
+            values = function_sketch.sketch().quantiles(function_sketch.quantiles)
+            for quantile, value in zip(function_sketch.quantiles, values):
+                if value is not None:
+                    yield Observation(
+                        value,
+                        {
+                            "function": function_sketch.function,
+                            "module": function_sketch.module,
+                            SERVICE_NAME: service_name,
+                            "quantile": str(quantile),
+                        },
+                    )
+
+    def _observe_objectives(
+        self, name: str, options: CallbackOptions
+    ) -> Iterable[Observation]:
+        """Report the burn rates or remaining error budgets of the objectives that are
+        evaluated in-process."""
+        for evaluator in objective_evaluators():
+            status = evaluator.status()
+            for (gauge, indicator), values in status_gauges(status).items():
+                if gauge != name:
+                    continue
+                for window, value in values:
+                    attributes = {
+                        OBJECTIVE_NAME: status.objective,
+                        "indicator": indicator,
+                    }
+                    if window:
+                        attributes["window"] = window
+                    yield Observation(value, attributes)
 
     def set_build_info(self, commit: str, version: str, branch: str):
-        if not self._has_set_build_info:
-            self._has_set_build_info = True
+        if self._build_info is None:
+            self._build_info = (
+                commit,
+                version,
+                branch,
+                *self._settings.build_info_labels,
+            )
             self.__up_down_counter_build_info_instance.add(
-                1.0,
-                attributes={
-                    "commit": commit,
-                    "version": version,
-                    "branch": branch,
-                    SERVICE_NAME: get_settings()["service_name"],
-                    REPOSITORY_URL: get_settings()["repository_url"],
-                    REPOSITORY_PROVIDER: get_settings()["repository_provider"],
-                    AUTOMETRICS_VERSION: SPEC_VERSION,
-                },
+                1.0, attributes=build_info_attributes(self._build_info)
             )
 
     def start(
@@ -184,13 +570,13 @@ class OpenTelemetryTracker:
                 attributes={
                     "function": function,
                     "module": module,
-                    SERVICE_NAME: get_settings()["service_name"],
+                    SERVICE_NAME: self._settings.service_name,
                 },
             )
 
     def finish(
         self,
-        duration: float,
+        duration: Optional[float],
         function: str,
         module: str,
         caller_module: str,
@@ -200,57 +586,658 @@ class OpenTelemetryTracker:
         track_concurrency: Optional[bool] = False,
     ):
         """Finish tracking metrics for a function call."""
-        exemplar = None
-        # Currently, exemplars are only supported by prometheus-client
-        # https://github.com/autometrics-dev/autometrics-py/issues/41
-        # if get_settings()["exemplars"]:
-        #     exemplar = get_exemplar()
-        self.__count(
+        self.register_function(function, module, objective, track_concurrency).finish(
+            duration, caller_module, caller_function, result
+        )
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        function: str,
+        module: str,
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+    ):
+        """Finish tracking metrics for a batch of calls to a function from the same caller."""
+        self.register_function(
+            function, module, objective, track_concurrency
+        ).finish_many(durations, caller_module, caller_function, results)
+
+    def register_function(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ) -> FunctionMetrics:
+        """Initialize the metrics for a function at zero and return a handle to them.
+
+        The buckets of a function are used for all of its series, the first buckets
+        registered for a function and module win."""
+        key = (
             function,
             module,
-            caller_module,
-            caller_function,
             objective,
-            exemplar,
-            result,
+            bool(track_concurrency),
+            sample_rate,
+            buckets,
         )
-        self.__histogram(function, module, duration, objective, exemplar)
-        if track_concurrency:
-            self.__up_down_counter_concurrency_instance.add(
-                -1.0,
-                attributes={
-                    "function": function,
-                    "module": module,
-                    SERVICE_NAME: get_settings()["service_name"],
-                },
+        metrics = self._functions.get(key)
+        if metrics is None:
+            create = partial(
+                self._create_metrics,
+                function,
+                module,
+                objective,
+                track_concurrency,
+                sample_rate,
             )
+            layout = function_buckets(objective, buckets)
+            new_metrics: FunctionMetrics
+            if layout is None and self._warmup is not None:
+                new_metrics = self._warmup.function_metrics(function, module, create)
+            else:
+                new_metrics = create(layout)
+            metrics = self._functions.setdefault(key, new_metrics)
+        return metrics
 
-    def initialize_counters(
+    def _create_metrics(
         self,
         function: str,
         module: str,
-        objective: Optional[Objective] = None,
-    ):
-        """Initialize tracking metrics for a function call at zero."""
-        caller_module = ""
-        caller_function = ""
-        self.__count(
+        objective: Optional[Objective],
+        track_concurrency: Optional[bool],
+        sample_rate: Optional[float],
+        buckets: Optional[Tuple[float, ...]],
+    ) -> FunctionMetrics:
+        """Create the metrics of a function, with the given buckets."""
+        if buckets is not None:
+            if self._settings.multiprocess_dir:
+                logging.warning(
+                    f"The histogram buckets of {module}.{function} are not supported with a multiprocess directory, the buckets of the settings are used."
+                )
+            else:
+                self._layouts.setdefault((function, module), buckets)
+        if self._accumulator is not None:
+            return self._sharded_metrics(
+                self._accumulator,
+                function,
+                module,
+                objective,
+                track_concurrency,
+                sample_rate,
+            )
+        return OpenTelemetryFunctionMetrics(
+            self.__counter_instance,
+            self.__histogram_instance,
+            self.__up_down_counter_concurrency_instance,
             function,
             module,
-            caller_module,
-            caller_function,
             objective,
-            None,
-            Result.OK,
-            0,
+            track_concurrency,
+            sample_rate,
+            self._settings,
         )
-        self.__count(
+
+    def _sharded_metrics(
+        self,
+        accumulator: Union[ShardedAccumulator, "MultiprocessAccumulator"],
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+    ) -> FunctionMetrics:
+        """Create the metrics of a function that counts its calls in per-thread shards,
+        or in the files of a multiprocess directory.
+
+        The OpenTelemetry API has no asynchronous histogram, so with per-thread shards
+        durations are still recorded on the histogram with the attributes computed up front.
+        """
+        settings = self._settings
+        service_name = settings.service_name
+        (
+            objective_name,
+            success_percentile,
+            latency_percentile,
+            threshold,
+        ) = get_objective_attributes(objective)
+        histogram_attributes: Attributes = {
+            "function": function,
+            "module": module,
+            SERVICE_NAME: service_name,
+            OBJECTIVE_NAME: objective_name,
+            OBJECTIVE_PERCENTILE: latency_percentile,
+            OBJECTIVE_LATENCY_THRESHOLD: threshold,
+        }
+        concurrency_inc = concurrency_dec = None
+        if track_concurrency:
+            concurrency_attributes: Attributes = {
+                "function": function,
+                "module": module,
+                SERVICE_NAME: service_name,
+            }
+            concurrency_add = self.__up_down_counter_concurrency_instance.add
+            concurrency_inc = partial(concurrency_add, 1.0, concurrency_attributes)
+            concurrency_dec = partial(concurrency_add, -1.0, concurrency_attributes)
+        counter_labels = (
             function,
             module,
-            caller_module,
-            caller_function,
-            objective,
-            None,
-            Result.ERROR,
-            0,
+            service_name,
+            objective_name,
+            success_percentile,
         )
+        histogram_key = (
+            function,
+            module,
+            service_name,
+            objective_name,
+            latency_percentile,
+            threshold,
+        )
+        if not isinstance(accumulator, ShardedAccumulator):
+            # pylint: disable=import-outside-toplevel
+            from .multiprocess import MultiprocessFunctionMetrics
+
+            return MultiprocessFunctionMetrics(
+                accumulator,
+                counter_labels,
+                histogram_key,
+                settings.sample_rate if sample_rate is None else sample_rate,
+                concurrency_inc=concurrency_inc,
+                concurrency_dec=concurrency_dec,
+            )
+        return ShardedFunctionMetrics(
+            accumulator,
+            counter_labels,
+            histogram_key,
+            settings.sample_rate if sample_rate is None else sample_rate,
+            concurrency_inc=concurrency_inc,
+            concurrency_dec=concurrency_dec,
+            record_duration=partial(
+                self.__histogram_instance.record, attributes=histogram_attributes
+            ),
+        )
+
+    def initialize_counters(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+    ):
+        """Initialize tracking metrics for a function call at zero."""
+        self.register_function(function, module, objective)
+
+    def estimate_overhead(self, calls: int = 1000) -> float:
+        """Estimate the time (in seconds) it takes to record a timed call.
+
+        This uses a separate meter provider with an in-memory reader, so nothing is exported.
+        """
+        meter_provider = MeterProvider(metric_readers=[InMemoryMetricReader()])
+        meter = meter_provider.get_meter(name="autometrics.calibration")
+        counter = meter.create_counter(name=COUNTER_NAME)
+        histogram = meter.create_histogram(name=HISTOGRAM_NAME, unit="seconds")
+        attributes: Attributes = {
+            "function": "calibration",
+            "module": "autometrics",
+            "result": Result.OK.value,
+            "caller.module": "",
+            "caller.function": "",
+            OBJECTIVE_NAME: "",
+            OBJECTIVE_PERCENTILE: "",
+            SERVICE_NAME: self._settings.service_name,
+        }
+        start_time = perf_counter_ns()
+        for _ in range(calls):
+            call_start_time = perf_counter_ns()
+            counter.add(1, attributes)
+            histogram.record((perf_counter_ns() - call_start_time) / 1e9, attributes)
+        overhead = (perf_counter_ns() - start_time) / calls / 1e9
+        meter_provider.shutdown()
+        return overhead
+
+    def function_metrics(self) -> List[FunctionMetrics]:
+        """Get the metrics of all the functions registered with this tracker."""
+        return list(self._functions.values())
+
+    def reset_after_fork(self):
+        """Nothing to swap in, the meter provider is shut down by `close_after_fork`."""
+        pass
+
+    def close_after_fork(self):
+        """Shut down the meter provider inherited from the parent process.
+
+        The threads of the readers did not survive the fork, so nothing is exported from
+        this process, the parent exports the values that were recorded before the fork.
+        """
+        self._meter_provider.shutdown()
+
+    def apply_settings(self, settings: SettingsSnapshot):
+        """Apply settings that were changed at runtime.
+
+        Functions without a sample rate of their own get the new sample rate, and the
+        build info is reported with the new sample rate."""
+        self._settings = settings
+        self._exemplar_filter.enabled = settings.enable_exemplars
+        for (_, _, _, _, sample_rate, _), metrics in list(self._functions.items()):
+            if sample_rate is None:
+                metrics.sample_rate = settings.sample_rate
+        if self._build_info is not None:
+            build_info = (*self._build_info[:3], *settings.build_info_labels)
+            if build_info != self._build_info:
+                build_info_counter = self.__up_down_counter_build_info_instance
+                build_info_counter.add(
+                    -1.0, attributes=build_info_attributes(self._build_info)
+                )
+                build_info_counter.add(
+                    1.0, attributes=build_info_attributes(build_info)
+                )
+                self._build_info = build_info
+
+
+def fixed_size_reservoir_factory(size: int, aggregation_type: type) -> Any:
+    """Keep (at most) the given number of exemplars per series, for every aggregation."""
+    return partial(fixed_size_reservoir, size)
+
+
+def fixed_size_reservoir(size: int, **kwargs) -> Any:
+    # The bucket boundaries passed to the reservoirs of histograms are not needed
+    return SimpleFixedSizeExemplarReservoir(size=size)
+
+
+def tail_reservoir_factory(size: int, aggregation_type: type) -> Any:
+    """Keep the slowest calls and most recent error of every series."""
+    return partial(TailReservoir, size)
+
+
+class TailReservoir(ExemplarReservoir):
+    """An exemplar reservoir of the SDK that keeps the slowest measurements of a series,
+    and the most recent error, in every export interval (see `TailExemplarReservoir`).
+    """
+
+    def __init__(self, size: int, **kwargs) -> None:
+        self._reservoir: TailExemplarReservoir[
+            Tuple[float, int, int, int]
+        ] = TailExemplarReservoir(size)
+
+    def offer(
+        self,
+        value: Union[int, float],
+        time_unix_nano: int,
+        attributes: MeasurementAttributes,
+        context: Context,
+    ) -> None:
+        error = attributes is not None and attributes.get("result") == "error"
+        if self._reservoir.accepts(value, error):
+            trace_context = get_trace_context(context)
+            if trace_context is not None:
+                self._reservoir.add(
+                    value, (value, time_unix_nano, *trace_context), error
+                )
+
+    def collect(self, point_attributes: MeasurementAttributes) -> List["Exemplar"]:
+        slowest, error = self._reservoir.collect()
+        if error is not None and error not in slowest:
+            slowest.append(error)
+        return [
+            Exemplar(None, value, time_unix_nano, span_id, trace_id)
+            for value, time_unix_nano, trace_id, span_id in slowest
+        ]
+
+
+def explicit_histograms(
+    metrics_data: MetricsData, layout: ExponentialLayout
+) -> MetricsData:
+    """Convert the exponential histograms in the metrics data, see `explicit_histogram`."""
+    if not any(
+        isinstance(metric.data, ExponentialHistogram)
+        for resource_metrics in metrics_data.resource_metrics
+        for scope_metrics in resource_metrics.scope_metrics
+        for metric in scope_metrics.metrics
+    ):
+        return metrics_data
+    return replace(
+        metrics_data,
+        resource_metrics=[
+            replace(
+                resource_metrics,
+                scope_metrics=[
+                    replace(
+                        scope_metrics,
+                        metrics=[
+                            explicit_histogram(metric, layout)
+                            for metric in scope_metrics.metrics
+                        ],
+                    )
+                    for scope_metrics in resource_metrics.scope_metrics
+                ],
+            )
+            for resource_metrics in metrics_data.resource_metrics
+        ],
+    )
+
+
+def explicit_histogram(metric: MetricData, layout: ExponentialLayout) -> MetricData:
+    """Convert an exponential histogram to a histogram with the explicit bounds of a fixed
+    exponential layout, so the buckets are the same on every scrape."""
+    if not isinstance(metric.data, ExponentialHistogram):
+        return metric
+    bounds = layout.bounds
+    data_points = []
+    for point in metric.data.data_points:
+        counts = layout.rebucket(
+            point.zero_count,
+            point.scale,
+            enumerate(point.positive.bucket_counts, point.positive.offset),
+        )
+        data_points.append(
+            HistogramDataPoint(
+                attributes=point.attributes,
+                start_time_unix_nano=point.start_time_unix_nano,
+                time_unix_nano=point.time_unix_nano,
+                count=point.count,
+                sum=point.sum,
+                bucket_counts=counts,
+                explicit_bounds=bounds,
+                min=point.min,
+                max=point.max,
+                **(
+                    {"exemplars": point.exemplars}
+                    if hasattr(point, "exemplars")
+                    else {}
+                ),
+            )
+        )
+    return replace(
+        metric,
+        data=HistogramData(
+            data_points=data_points,
+            aggregation_temporality=metric.data.aggregation_temporality,
+        ),
+    )
+
+
+# The labels of a series without the bucket label, and if it is the series of a histogram
+SeriesKey = Tuple[bool, FrozenSet[Tuple[str, str]]]
+
+
+class PrometheusExemplarReader(PrometheusMetricReader):
+    """A Prometheus reader that also exposes the exemplars of counters and histogram buckets.
+
+    The Prometheus exporter drops the exemplars of the data points, so they are picked up
+    from the collected data and attached to the samples of the matching series. They are
+    only exposed in the OpenMetrics format, like the exemplars of the Prometheus tracker.
+    """
+
+    def __init__(self, disable_target_info: bool = False) -> None:
+        super().__init__(disable_target_info)
+        settings = get_settings()
+        # The buckets that exponential histograms are exposed with
+        self._layout = fixed_layout(
+            settings.histogram_max_scale, settings.histogram_max_buckets
+        )
+        # The bucket boundaries (of histograms) and the exemplars of every series
+        self._exemplars: Dict[SeriesKey, Tuple[Sequence[float], Sequence[Any]]] = {}
+        collect = self._collector.collect
+        # The registry calls the collect method of the (already registered) collector
+        self._collector.collect = lambda: self._attach_exemplars(collect())  # type: ignore
+
+    def _receive_metrics(
+        self,
+        metrics_data: MetricsData,
+        timeout_millis: float = 10_000,
+        **kwargs,
+    ) -> None:
+        if metrics_data is not None:
+            # The Prometheus exporter drops exponential histograms
+            metrics_data = explicit_histograms(metrics_data, self._layout)
+            self._exemplars = {}
+            for resource_metrics in metrics_data.resource_metrics:
+                for scope_metrics in resource_metrics.scope_metrics:
+                    for metric in scope_metrics.metrics:
+                        for point in metric.data.data_points:
+                            exemplars = getattr(point, "exemplars", None)
+                            if exemplars:
+                                self._exemplars[self._series_key(point)] = (
+                                    getattr(point, "explicit_bounds", ()),
+                                    exemplars,
+                                )
+        super()._receive_metrics(metrics_data, timeout_millis, **kwargs)
+
+    def _series_key(self, point: Any) -> SeriesKey:
+        # pylint: disable=protected-access
+        collector: Any = self._collector
+        return isinstance(point, HistogramDataPoint), frozenset(
+            (collector._sanitize(key), collector._check_value(value))
+            for key, value in point.attributes.items()
+        )
+
+    def _attach_exemplars(self, metrics: Iterable[Metric]) -> Iterable[Metric]:
+        for metric in metrics:
+            if self._exemplars and metric.type in ("counter", "histogram"):
+                metric.samples = [
+                    self._with_exemplar(metric.type == "histogram", sample)
+                    for sample in metric.samples
+                ]
+            yield metric
+
+    def _with_exemplar(self, histogram: bool, sample: Any) -> Any:
+        """Attach the latest exemplar of a series (or the slowest of a bucket) to a sample."""
+        if not sample.name.endswith("_bucket" if histogram else "_total"):
+            return sample
+        labels = {key: value for key, value in sample.labels.items() if key != "le"}
+        series = self._exemplars.get((histogram, frozenset(labels.items())))
+        if series is None:
+            return sample
+        bounds, exemplars = series
+        if histogram:
+            upper_bound = float(sample.labels["le"])
+            lower_bound = max(
+                (bound for bound in bounds if bound < upper_bound),
+                default=float("-inf"),
+            )
+            exemplars = [
+                exemplar
+                for exemplar in exemplars
+                if lower_bound < exemplar.value <= upper_bound
+            ]
+        exemplars = [
+            exemplar for exemplar in exemplars if exemplar.trace_id is not None
+        ]
+        if not exemplars:
+            return sample
+        if histogram:
+            exemplar = max(exemplars, key=lambda exemplar: exemplar.value)
+        else:
+            exemplar = max(exemplars, key=lambda exemplar: exemplar.time_unix_nano)
+        return sample._replace(
+            exemplar=PrometheusExemplar(
+                ExemplarLabels(exemplar.trace_id, exemplar.span_id),  # type: ignore
+                exemplar.value,
+                exemplar.time_unix_nano / 1e9,
+            )
+        )
+
+
+def build_info_attributes(build_info: Tuple[str, ...]) -> Attributes:
+    """Get the attributes of the build info from its label values."""
+    keys = (
+        "commit",
+        "version",
+        "branch",
+        SERVICE_NAME,
+        REPOSITORY_URL,
+        REPOSITORY_PROVIDER,
+        AUTOMETRICS_VERSION,
+        SAMPLE_RATE,
+    )
+    return dict(zip(keys, build_info))
+
+
+class OpenTelemetryFunctionMetrics:
+    """Metrics of a single function, with the OpenTelemetry attribute sets computed up front.
+
+    The attributes that only depend on the function are built once, the counter attributes
+    are built once per caller and result. The same attribute dicts are passed to the SDK on
+    every call, so they must not be mutated."""
+
+    def __init__(
+        self,
+        counter: Counter,
+        histogram: Histogram,
+        concurrency: UpDownCounter,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        settings: Optional[SettingsSnapshot] = None,
+    ):
+        settings = get_settings() if settings is None else settings
+        service_name = settings.service_name
+        self.sample_rate = settings.sample_rate if sample_rate is None else sample_rate
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+
+        (
+            objective_name,
+            success_percentile,
+            latency_percentile,
+            threshold,
+        ) = get_objective_attributes(objective)
+
+        self._counter_add = counter.add
+        self._histogram_record = histogram.record
+        self._concurrency_add = concurrency.add if track_concurrency else None
+
+        self._counter_base_attributes: Attributes = {
+            "function": function,
+            "module": module,
+            OBJECTIVE_NAME: objective_name,
+            OBJECTIVE_PERCENTILE: success_percentile,
+            SERVICE_NAME: service_name,
+        }
+        self._counter_attributes: Dict[Tuple[str, str, Result], Attributes] = {}
+        self._histogram_attributes: Attributes = {
+            "function": function,
+            "module": module,
+            SERVICE_NAME: service_name,
+            OBJECTIVE_NAME: objective_name,
+            OBJECTIVE_PERCENTILE: latency_percentile,
+            OBJECTIVE_LATENCY_THRESHOLD: threshold,
+        }
+        self._concurrency_attributes: Attributes = {
+            "function": function,
+            "module": module,
+            SERVICE_NAME: service_name,
+        }
+
+        # Initialize the counters at zero
+        for result in Result:
+            self._counter_add(0, self._counter_attributes_for("", "", result))
+
+    def _counter_attributes_for(
+        self, caller_module: str, caller_function: str, result: Result
+    ) -> Attributes:
+        """Build (and cache) the counter attributes for the given caller and result."""
+        key = (caller_module, caller_function, result)
+        attributes = self._counter_attributes.get(key)
+        if attributes is None:
+            attributes = self._counter_attributes.setdefault(
+                key,
+                {
+                    **self._counter_base_attributes,
+                    "result": result.value,
+                    "caller.module": caller_module,
+                    "caller.function": caller_function,
+                },
+            )
+        return attributes
+
+    def start(self):
+        """Start tracking metrics for a function call."""
+        if self._concurrency_add is not None:
+            self._concurrency_add(1.0, self._concurrency_attributes)
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Finish tracking metrics for a function call."""
+        # Exemplars are picked up by the SDK, from the context of the measurements
+        attributes = self._counter_attributes.get(
+            (caller_module, caller_function, result)
+        )
+        if attributes is None:
+            attributes = self._counter_attributes_for(
+                caller_module, caller_function, result
+            )
+        self._counter_add(1, attributes)
+        self.calls += 1
+        if duration is not None:
+            self.timed_calls += 1
+            self.timed_duration += duration
+            self._histogram_record(duration, self._histogram_attributes)
+        if self._concurrency_add is not None:
+            self._concurrency_add(-1.0, self._concurrency_attributes)
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Finish tracking metrics for a batch of calls to the function from the same caller."""
+        counts, timed, total = summarize_batch(durations, results)
+        for result, count in counts.items():
+            self._counter_add(
+                count,
+                self._counter_attributes_for(caller_module, caller_function, result),
+            )
+        self.calls += len(durations)
+        self.timed_calls += len(timed)
+        self.timed_duration += total
+        if len(timed):
+            # The aggregation of the tracker adds the whole batch in a single update
+            self._histogram_record(
+                DurationBatch(timed, total), self._histogram_attributes
+            )
+        if self._concurrency_add is not None:
+            self._concurrency_add(-len(durations), self._concurrency_attributes)
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls that were already counted in histogram buckets."""
+        timed = sum(bucket_counts)
+        self._counter_add(
+            untimed + timed,
+            self._counter_attributes_for(caller_module, caller_function, result),
+        )
+        self.calls += untimed + timed
+        if timed:
+            total = sum(bucket_sums)
+            self.timed_calls += timed
+            self.timed_duration += total
+            # The calls of a bucket are recorded with their mean duration
+            means, counts = bucket_means(bounds, bucket_counts, bucket_sums)
+            self._histogram_record(
+                DurationBatch(means, total, counts), self._histogram_attributes
+            )
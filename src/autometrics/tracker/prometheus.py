@@ -1,33 +1,118 @@
-import time
-from typing import Optional
-from prometheus_client import Counter, Histogram, Gauge
+import logging
+import threading
+import weakref
+
+from bisect import bisect_left
+from functools import partial
+from time import perf_counter_ns, time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from prometheus_client import Counter, Histogram, Gauge, REGISTRY, CollectorRegistry
+from prometheus_client.metrics_core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+    Metric,
+    SummaryMetricFamily,
+)
+from prometheus_client.registry import Collector
+from prometheus_client.samples import Exemplar
+from prometheus_client.utils import floatToGoString
 
 from ..constants import (
     AUTOMETRICS_VERSION_PROMETHEUS,
     COUNTER_NAME_PROMETHEUS,
     HISTOGRAM_NAME_PROMETHEUS,
     CONCURRENCY_NAME_PROMETHEUS,
+    QUANTILES_NAME_PROMETHEUS,
+    OBJECTIVE_BUDGET_NAME_PROMETHEUS,
+    OBJECTIVE_BURN_RATE_NAME_PROMETHEUS,
     REPOSITORY_PROVIDER_PROMETHEUS,
     REPOSITORY_URL_PROMETHEUS,
+    SAMPLE_RATE_PROMETHEUS,
     SERVICE_NAME_PROMETHEUS,
     BUILD_INFO_NAME,
     COUNTER_DESCRIPTION,
     HISTOGRAM_DESCRIPTION,
     CONCURRENCY_DESCRIPTION,
+    QUANTILES_DESCRIPTION,
+    OBJECTIVE_BUDGET_DESCRIPTION,
+    OBJECTIVE_BURN_RATE_DESCRIPTION,
     BUILD_INFO_DESCRIPTION,
     OBJECTIVE_NAME_PROMETHEUS,
     OBJECTIVE_PERCENTILE_PROMETHEUS,
     OBJECTIVE_LATENCY_THRESHOLD_PROMETHEUS,
     COMMIT_KEY,
-    SPEC_VERSION,
     VERSION_KEY,
     BRANCH_KEY,
 )
 
-from ..exemplar import get_exemplar
-from .types import Result
+from ..buckets import function_buckets
+from ..exemplar import (
+    DEFAULT_TAIL_EXEMPLARS,
+    EXEMPLAR_REFRESH_INTERVAL,
+    ExemplarLabels,
+    TailExemplarReservoir,
+    get_trace_context,
+)
+from .batch import bucket_counts, rebucket, summarize_batch
+from .exponential import fixed_layout
+from .sharded import ShardedAccumulator, ShardedFunctionMetrics, cumulative_buckets
+from .types import BatchResult, FunctionMetrics, Result
+from .warmup import WarmupFunctionMetrics, create_warmup
 from ..objectives import Objective
-from ..settings import get_settings
+from ..settings import get_settings, SettingsSnapshot
+from ..sketch import function_sketches
+from ..slo import objective_evaluators, status_gauges
+
+if TYPE_CHECKING:
+    from .multiprocess import MultiprocessAccumulator
+
+
+COUNTER_LABELS = [
+    "function",
+    "module",
+    SERVICE_NAME_PROMETHEUS,
+    "result",
+    "caller_module",
+    "caller_function",
+    OBJECTIVE_NAME_PROMETHEUS,
+    OBJECTIVE_PERCENTILE_PROMETHEUS,
+]
+HISTOGRAM_LABELS = [
+    "function",
+    "module",
+    SERVICE_NAME_PROMETHEUS,
+    OBJECTIVE_NAME_PROMETHEUS,
+    OBJECTIVE_PERCENTILE_PROMETHEUS,
+    OBJECTIVE_LATENCY_THRESHOLD_PROMETHEUS,
+]
+
+
+def get_objective_labels(objective: Optional[Objective]) -> Tuple[str, str, str, str]:
+    """Get the objective name, success rate percentile, latency percentile and latency threshold labels."""
+    objective_name = "" if objective is None else objective.name
+    success_percentile = (
+        ""
+        if objective is None or objective.success_rate is None
+        else objective.success_rate.value
+    )
+    latency = None if objective is None else objective.latency
+    latency_percentile = ""
+    threshold = ""
+    if latency is not None:
+        threshold = latency[0].value
+        latency_percentile = latency[1].value
+    return objective_name, success_percentile, latency_percentile, threshold
 
 
 class PrometheusTracker:
@@ -36,29 +121,13 @@ class PrometheusTracker:
     prom_counter = Counter(
         COUNTER_NAME_PROMETHEUS,
         COUNTER_DESCRIPTION,
-        [
-            "function",
-            "module",
-            SERVICE_NAME_PROMETHEUS,
-            "result",
-            "caller_module",
-            "caller_function",
-            OBJECTIVE_NAME_PROMETHEUS,
-            OBJECTIVE_PERCENTILE_PROMETHEUS,
-        ],
+        COUNTER_LABELS,
     )
     prom_histogram = Histogram(
         HISTOGRAM_NAME_PROMETHEUS,
         HISTOGRAM_DESCRIPTION,
-        [
-            "function",
-            "module",
-            SERVICE_NAME_PROMETHEUS,
-            OBJECTIVE_NAME_PROMETHEUS,
-            OBJECTIVE_PERCENTILE_PROMETHEUS,
-            OBJECTIVE_LATENCY_THRESHOLD_PROMETHEUS,
-        ],
-        buckets=get_settings()["histogram_buckets"],
+        HISTOGRAM_LABELS,
+        buckets=get_settings().histogram_buckets,
         unit="seconds",
     )
     prom_gauge_build_info = Gauge(
@@ -72,6 +141,7 @@ class PrometheusTracker:
             REPOSITORY_URL_PROMETHEUS,
             REPOSITORY_PROVIDER_PROMETHEUS,
             AUTOMETRICS_VERSION_PROMETHEUS,
+            SAMPLE_RATE_PROMETHEUS,
         ],
     )
     prom_gauge_concurrency = Gauge(
@@ -85,94 +155,208 @@ class PrometheusTracker:
     )
 
     def __init__(self) -> None:
-        self._has_set_build_info = False
+        self._settings = get_settings()
+        self._build_info: Optional[Tuple[str, ...]] = None
+        self._functions: Dict[
+            Tuple[
+                str,
+                str,
+                Optional[Objective],
+                bool,
+                Optional[float],
+                Optional[Tuple[float, ...]],
+            ],
+            FunctionMetrics,
+        ] = {}
+        # The histograms of the functions with buckets of their own, by bucket layout
+        self._histograms: Dict[Tuple[float, ...], Histogram] = {}
+        # The function metrics that are alive, whose histogram series should be kept
+        self._series_holders: "weakref.WeakSet[PrometheusFunctionMetrics]" = (
+            weakref.WeakSet()
+        )
+        self._series_lock = threading.RLock()
+        self._warmup = create_warmup(self._settings)
+        self._accumulator: Optional[
+            Union[ShardedAccumulator, "MultiprocessAccumulator"]
+        ] = None
+        settings = self._settings
+        # Exponential histograms are exposed with the fixed bounds of an exponential layout
+        self._exponential_buckets = (
+            fixed_layout(
+                settings.histogram_max_scale, settings.histogram_max_buckets
+            ).bounds
+            if settings.exponential_histograms
+            else None
+        )
+        if settings.multiprocess_dir:
+            # The multiprocess files need fcntl, so they are only imported when used
+            # pylint: disable=import-outside-toplevel
+            from .multiprocess import MultiprocessAccumulator
+
+            self._accumulator = MultiprocessAccumulator(
+                settings.multiprocess_dir, settings.histogram_buckets
+            )
+        elif settings.thread_sharding:
+            self._accumulator = ShardedAccumulator(settings.histogram_buckets)
+        collector: Optional[Collector] = None
+        if self._accumulator is not None:
+            collector = ShardedPrometheusCollector(self._accumulator)
+        elif settings.tail_exemplars or settings.exponential_histograms:
+            collector = TrackerCollector(self)
+        use_collector(collector)
+        use_in_process_collectors(self)
 
-    def _count(
+    def set_build_info(self, commit: str, version: str, branch: str):
+        if self._build_info is None:
+            self._build_info = (
+                commit,
+                version,
+                branch,
+                *self._settings.build_info_labels,
+            )
+            self.prom_gauge_build_info.labels(*self._build_info).set(1)
+
+    def register_function(
         self,
-        func_name: str,
-        module_name: str,
-        caller_module: str,
-        caller_function: str,
+        function: str,
+        module: str,
         objective: Optional[Objective] = None,
-        exemplar: Optional[dict] = None,
-        result: Result = Result.OK,
-        inc_by: int = 1,
-    ):
-        """Increment the counter for the function call."""
-        objective_name = "" if objective is None else objective.name
-        percentile = (
-            ""
-            if objective is None or objective.success_rate is None
-            else objective.success_rate.value
-        )
-        service_name = get_settings()["service_name"]
-
-        self.prom_counter.labels(
-            func_name,
-            module_name,
-            service_name,
-            result.value,
-            caller_module,
-            caller_function,
-            objective_name,
-            percentile,
-        ).inc(inc_by, exemplar)
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ) -> FunctionMetrics:
+        """Initialize the metrics for a function at zero and return a handle to them."""
+        key = (
+            function,
+            module,
+            objective,
+            bool(track_concurrency),
+            sample_rate,
+            buckets,
+        )
+        metrics = self._functions.get(key)
+        if metrics is None:
+            create = partial(
+                self._create_metrics,
+                function,
+                module,
+                objective,
+                track_concurrency,
+                sample_rate,
+            )
+            layout = function_buckets(objective, buckets)
+            new_metrics: FunctionMetrics
+            if layout is None and self._warmup is not None:
+                new_metrics = self._warmup.function_metrics(function, module, create)
+            else:
+                new_metrics = create(layout)
+            metrics = self._functions.setdefault(key, new_metrics)
+        return metrics
 
-    def _histogram(
+    def _create_metrics(
         self,
-        func_name: str,
-        module_name: str,
-        duration: float,
+        function: str,
+        module: str,
+        objective: Optional[Objective],
+        track_concurrency: Optional[bool],
+        sample_rate: Optional[float],
+        buckets: Optional[Tuple[float, ...]],
+    ) -> FunctionMetrics:
+        """Create the metrics of a function, with the given buckets."""
+        if self._accumulator is not None:
+            return self._sharded_metrics(
+                self._accumulator,
+                function,
+                module,
+                objective,
+                track_concurrency,
+                sample_rate,
+                buckets,
+            )
+        return PrometheusFunctionMetrics(
+            self, function, module, objective, track_concurrency, sample_rate, buckets
+        )
+
+    def _sharded_metrics(
+        self,
+        accumulator: Union[ShardedAccumulator, "MultiprocessAccumulator"],
+        function: str,
+        module: str,
         objective: Optional[Objective] = None,
-        exemplar: Optional[dict] = None,
-    ):
-        """Observe the duration of the function call."""
-
-        objective_name = "" if objective is None else objective.name
-        latency = None if objective is None else objective.latency
-        percentile = ""
-        threshold = ""
-        if latency is not None:
-            threshold = latency[0].value
-            percentile = latency[1].value
-        service_name = get_settings()["service_name"]
-
-        self.prom_histogram.labels(
-            func_name,
-            module_name,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ) -> FunctionMetrics:
+        """Create the metrics of a function that are accumulated in per-thread shards,
+        or in the files of a multiprocess directory.
+
+        The files of a multiprocess directory have the same buckets for all functions,
+        so the buckets of the function are only used with per-thread shards."""
+        settings = self._settings
+        service_name = settings.service_name
+        (
+            objective_name,
+            success_percentile,
+            latency_percentile,
+            threshold,
+        ) = get_objective_labels(objective)
+        concurrency = (
+            self.prom_gauge_concurrency.labels(function, module, service_name)
+            if track_concurrency
+            else None
+        )
+        counter_labels = (
+            function,
+            module,
             service_name,
             objective_name,
-            percentile,
+            success_percentile,
+        )
+        histogram_key = (
+            function,
+            module,
+            service_name,
+            objective_name,
+            latency_percentile,
             threshold,
-        ).observe(duration, exemplar)
+        )
+        if not isinstance(accumulator, ShardedAccumulator):
+            if buckets is not None:
+                logging.warning(
+                    f"The histogram buckets of {module}.{function} are not supported with a multiprocess directory, the buckets of the settings are used."
+                )
+            # pylint: disable=import-outside-toplevel
+            from .multiprocess import MultiprocessFunctionMetrics
 
-    def set_build_info(self, commit: str, version: str, branch: str):
-        if not self._has_set_build_info:
-            self._has_set_build_info = True
-            service_name = get_settings()["service_name"]
-            repository_url = get_settings()["repository_url"]
-            repository_provider = get_settings()["repository_provider"]
-            self.prom_gauge_build_info.labels(
-                commit,
-                version,
-                branch,
-                service_name,
-                repository_url,
-                repository_provider,
-                SPEC_VERSION,
-            ).set(1)
+            return MultiprocessFunctionMetrics(
+                accumulator,
+                counter_labels,
+                histogram_key,
+                settings.sample_rate if sample_rate is None else sample_rate,
+                concurrency_inc=None if concurrency is None else concurrency.inc,
+                concurrency_dec=None if concurrency is None else concurrency.dec,
+            )
+        return ShardedFunctionMetrics(
+            accumulator,
+            counter_labels,
+            histogram_key,
+            settings.sample_rate if sample_rate is None else sample_rate,
+            concurrency_inc=None if concurrency is None else concurrency.inc,
+            concurrency_dec=None if concurrency is None else concurrency.dec,
+            buckets=buckets,
+        )
 
     def start(
         self, function: str, module: str, track_concurrency: Optional[bool] = False
     ):
         """Start tracking metrics for a function call."""
         if track_concurrency:
-            service_name = get_settings()["service_name"]
+            service_name = self._settings.service_name
             self.prom_gauge_concurrency.labels(function, module, service_name).inc()
 
     def finish(
         self,
-        duration: float,
+        duration: Optional[float],
         function: str,
         module: str,
         caller_module: str,
@@ -182,24 +366,25 @@ class PrometheusTracker:
         track_concurrency: Optional[bool] = False,
     ):
         """Finish tracking metrics for a function call."""
-        exemplar = None
-        if get_settings()["enable_exemplars"]:
-            exemplar = get_exemplar()
-
-        self._count(
-            function,
-            module,
-            caller_module,
-            caller_function,
-            objective,
-            exemplar,
-            result,
+        self.register_function(function, module, objective, track_concurrency).finish(
+            duration, caller_module, caller_function, result
         )
-        self._histogram(function, module, duration, objective, exemplar)
 
-        if track_concurrency:
-            service_name = get_settings()["service_name"]
-            self.prom_gauge_concurrency.labels(function, module, service_name).dec()
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        function: str,
+        module: str,
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+    ):
+        """Finish tracking metrics for a batch of calls to a function from the same caller."""
+        self.register_function(
+            function, module, objective, track_concurrency
+        ).finish_many(durations, caller_module, caller_function, results)
 
     def initialize_counters(
         self,
@@ -208,25 +393,606 @@ class PrometheusTracker:
         objective: Optional[Objective] = None,
     ):
         """Initialize tracking metrics for a function call at zero."""
-        caller_module = ""
-        caller_function = ""
-        self._count(
+        self.register_function(function, module, objective)
+
+    def estimate_overhead(self, calls: int = 1000) -> float:
+        """Estimate the time (in seconds) it takes to record a timed call.
+
+        This uses a counter and histogram that are not registered, so nothing is exported.
+        """
+        counter = Counter(
+            COUNTER_NAME_PROMETHEUS, COUNTER_DESCRIPTION, ["result"], registry=None
+        ).labels(Result.OK.value)
+        histogram = Histogram(
+            HISTOGRAM_NAME_PROMETHEUS,
+            HISTOGRAM_DESCRIPTION,
+            buckets=self._settings.histogram_buckets,
+            registry=None,
+        )
+        start_time = perf_counter_ns()
+        for _ in range(calls):
+            call_start_time = perf_counter_ns()
+            counter.inc(1, None)
+            histogram.observe((perf_counter_ns() - call_start_time) / 1e9, None)
+        return (perf_counter_ns() - start_time) / calls / 1e9
+
+    def function_metrics(self) -> List[FunctionMetrics]:
+        """Get the metrics of all the functions registered with this tracker."""
+        return list(self._functions.values())
+
+    def histogram(self, buckets: Optional[Tuple[float, ...]] = None) -> Histogram:
+        """Get the histogram with the given bucket layout, or the histogram with the
+        buckets of the settings.
+
+        The histograms with other layouts are not registered, they are exposed together
+        with the histogram of the tracker, see `TrackerCollector`."""
+        # pylint: disable=protected-access
+        if buckets is None or buckets == tuple(self.prom_histogram._upper_bounds[:-1]):
+            return self.prom_histogram
+        histogram = self._histograms.get(buckets)
+        if histogram is None:
+            histogram = self._histograms.setdefault(
+                buckets,
+                Histogram(
+                    HISTOGRAM_NAME_PROMETHEUS,
+                    HISTOGRAM_DESCRIPTION,
+                    HISTOGRAM_LABELS,
+                    buckets=buckets,
+                    unit="seconds",
+                    registry=None,
+                ),
+            )
+            if _collector is None:
+                use_collector(TrackerCollector(self))
+        return histogram
+
+    def hold_series(self, labels: Tuple[str, ...], holder: "PrometheusFunctionMetrics"):
+        """Keep the histogram series of function metrics as long as they are alive, and
+        drop the empty series with the same labels in the histograms of the other bucket
+        layouts that no live function metrics hold.
+
+        This drops the series that a function had before it got buckets of its own (like
+        during a warm-up), so it is not exposed with two sets of buckets. A series that is
+        still held when the function gets other buckets is dropped once its function
+        metrics are gone."""
+        with self._series_lock:
+            self._series_holders.add(holder)
+            self.drop_empty_series(labels)
+        weakref.finalize(holder, self.drop_empty_series, labels)
+
+    def drop_empty_series(self, labels: Tuple[str, ...]):
+        """Drop the empty series with the given labels that no live function metrics
+        hold, if a live one does."""
+        # pylint: disable=protected-access
+        with self._series_lock:
+            held = {id(holder._histogram) for holder in list(self._series_holders)}
+            histograms = [self.prom_histogram, *self._histograms.values()]
+            children: List[Any] = [
+                histogram._metrics.get(labels) for histogram in histograms
+            ]
+            if not any(id(child) in held for child in children if child is not None):
+                return
+            for histogram, child in zip(histograms, children):
+                if (
+                    child is not None
+                    and id(child) not in held
+                    and child._sum.get() == 0
+                    and not any(bucket.get() for bucket in child._buckets)
+                ):
+                    histogram.remove(*labels)
+
+    def flush_exemplars(self):
+        """Link the slowest calls (and errors) of every function since the last scrape
+        to their series, see `TrackerCollector`."""
+        for metrics in list(self._functions.values()):
+            if isinstance(metrics, WarmupFunctionMetrics):
+                metrics = metrics.metrics
+            if isinstance(metrics, PrometheusFunctionMetrics):
+                metrics.flush_exemplars()
+
+    def reset_after_fork(self):
+        """Give the metrics new locks, which other threads of the parent may have held."""
+        for metric in self._metrics():
+            metric._lock = threading.Lock()
+
+    def _metrics(self) -> List[Any]:
+        """Get the prometheus-client metrics of the tracker."""
+        return [
+            self.prom_counter,
+            self.prom_histogram,
+            self.prom_gauge_concurrency,
+            self.prom_gauge_build_info,
+            *self._histograms.values(),
+        ]
+
+    def close_after_fork(self):
+        """Drop the values inherited from the parent process, the parent reports them."""
+        self.prom_counter.clear()
+        self.prom_histogram.clear()
+        self.prom_gauge_concurrency.clear()
+        self.prom_gauge_build_info.clear()
+        for histogram in self._histograms.values():
+            histogram.clear()
+
+    def apply_settings(self, settings: SettingsSnapshot):
+        """Apply settings that were changed at runtime.
+
+        Functions without a sample rate of their own get the new sample rate, and the
+        build info is reported with the new sample rate."""
+        self._settings = settings
+        for (_, _, _, _, sample_rate, _), metrics in list(self._functions.items()):
+            if sample_rate is None:
+                metrics.sample_rate = settings.sample_rate
+            if isinstance(metrics, WarmupFunctionMetrics):
+                metrics = metrics.metrics
+            if isinstance(metrics, PrometheusFunctionMetrics):
+                metrics._enable_exemplars = settings.enable_exemplars
+        if self._build_info is not None:
+            build_info = (*self._build_info[:3], *settings.build_info_labels)
+            if build_info != self._build_info:
+                self.prom_gauge_build_info.remove(*self._build_info)
+                self.prom_gauge_build_info.labels(*build_info).set(1)
+                self._build_info = build_info
+
+
+class PrometheusFunctionMetrics:
+    """Metrics of a single function, with the Prometheus label children resolved up front.
+
+    The counter children are resolved once per caller, the first time that caller is seen.
+    The histogram bucket of a duration is found with a binary search over the upper bounds.
+    """
+
+    def __init__(
+        self,
+        tracker: PrometheusTracker,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ):
+        settings = tracker._settings
+        service_name = settings.service_name
+        self._enable_exemplars = settings.enable_exemplars
+        self.sample_rate = settings.sample_rate if sample_rate is None else sample_rate
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+
+        (
+            objective_name,
+            success_percentile,
+            latency_percentile,
+            threshold,
+        ) = get_objective_labels(objective)
+
+        self._counter = tracker.prom_counter
+        self._counter_labels = (
             function,
             module,
-            caller_module,
-            caller_function,
-            objective,
-            None,
-            Result.OK,
-            0,
+            service_name,
+            objective_name,
+            success_percentile,
         )
-        self._count(
+        self._counters: Dict[Tuple[str, str, Result], Any] = {}
+        histogram_labels = (
             function,
             module,
-            caller_module,
-            caller_function,
-            objective,
-            None,
-            Result.ERROR,
-            0,
+            service_name,
+            objective_name,
+            latency_percentile,
+            threshold,
+        )
+        if tracker._exponential_buckets is not None:
+            buckets = tracker._exponential_buckets
+        self._histogram = tracker.histogram(buckets).labels(*histogram_labels)
+        tracker.hold_series(histogram_labels, self)
+        # pylint: disable=protected-access
+        self._upper_bounds = tuple(self._histogram._upper_bounds)
+        self._buckets = tuple(self._histogram._buckets)
+        self._sum = self._histogram._sum
+        self._concurrency = (
+            tracker.prom_gauge_concurrency.labels(function, module, service_name)
+            if track_concurrency
+            else None
+        )
+        # When the exemplar of every histogram bucket and counter was last replaced
+        self._bucket_exemplar_times = [0.0] * len(self._upper_bounds)
+        self._counter_exemplar_times: Dict[Tuple[str, str, Result], float] = {}
+        # The slowest calls and most recent error since the last scrape, with their trace
+        # context, duration, time and counter
+        self._reservoir: Optional[
+            TailExemplarReservoir[Tuple[Tuple[int, int], float, float, Any]]
+        ] = None
+        if settings.tail_exemplars:
+            self._reservoir = TailExemplarReservoir(
+                settings.exemplar_reservoir_size or DEFAULT_TAIL_EXEMPLARS
+            )
+
+        # Initialize the counters at zero
+        for result in Result:
+            self._counter_for("", "", result).inc(0)
+
+    def _counter_for(self, caller_module: str, caller_function: str, result: Result):
+        """Resolve (and cache) the counter child for the given caller and result."""
+        key = (caller_module, caller_function, result)
+        counter = self._counters.get(key)
+        if counter is None:
+            (
+                function,
+                module,
+                service_name,
+                objective_name,
+                percentile,
+            ) = self._counter_labels
+            counter = self._counters.setdefault(
+                key,
+                self._counter.labels(
+                    function,
+                    module,
+                    service_name,
+                    result.value,
+                    caller_module,
+                    caller_function,
+                    objective_name,
+                    percentile,
+                ),
+            )
+        return counter
+
+    def start(self):
+        """Start tracking metrics for a function call."""
+        if self._concurrency is not None:
+            self._concurrency.inc()
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Finish tracking metrics for a function call."""
+        counter = self._counters.get((caller_module, caller_function, result))
+        if counter is None:
+            counter = self._counter_for(caller_module, caller_function, result)
+
+        self.calls += 1
+        if duration is None:
+            counter.inc()
+        else:
+            self.timed_calls += 1
+            self.timed_duration += duration
+            counter.inc()
+            self._buckets[bisect_left(self._upper_bounds, duration)].inc(1)
+            self._sum.inc(duration)
+            if self._enable_exemplars:
+                if self._reservoir is None:
+                    self._set_exemplars(
+                        counter, (caller_module, caller_function, result), duration
+                    )
+                else:
+                    self._offer_exemplar(counter, result, duration)
+
+        if self._concurrency is not None:
+            self._concurrency.dec()
+
+    def _set_exemplars(
+        self, counter: Any, counter_key: Tuple[str, str, Result], duration: float
+    ):
+        """Link the counter and histogram bucket of a call to its trace.
+
+        The exemplar of a series is replaced at most once per refresh interval, and the
+        trace context is only looked up when one of them is due. The labels are kept as
+        integers until they are scraped."""
+        now = time()
+        index = bisect_left(self._upper_bounds, duration)
+        bucket_due = (
+            now - self._bucket_exemplar_times[index] >= EXEMPLAR_REFRESH_INTERVAL
+        )
+        counter_due = (
+            now - self._counter_exemplar_times.get(counter_key, 0.0)
+            >= EXEMPLAR_REFRESH_INTERVAL
+        )
+        if not (bucket_due or counter_due):
+            return
+        trace_context = get_trace_context()
+        if trace_context is None:
+            return
+        # Any mapping works as the labels of an exemplar (prometheus-client types them as a dict)
+        labels: Any = ExemplarLabels(*trace_context)
+        # prometheus-client validates (and so formats) the labels of an exemplar passed
+        # to inc() or observe(), these labels are valid by construction
+        # pylint: disable=protected-access
+        if bucket_due:
+            self._bucket_exemplar_times[index] = now
+            self._buckets[index].set_exemplar(Exemplar(labels, duration, now))
+        if counter_due:
+            self._counter_exemplar_times[counter_key] = now
+            counter._value.set_exemplar(Exemplar(labels, 1, now))
+
+    def _offer_exemplar(self, counter: Any, result: Result, duration: float):
+        """Offer a call to the tail reservoir, which only looks up the trace context of
+        the calls it keeps."""
+        reservoir = self._reservoir
+        error = result is Result.ERROR
+        if reservoir is not None and reservoir.accepts(duration, error):
+            trace_context = get_trace_context()
+            if trace_context is not None:
+                reservoir.add(
+                    duration, (trace_context, duration, time(), counter), error
+                )
+
+    def flush_exemplars(self) -> None:
+        """Link the slowest calls since the last scrape to their histogram buckets and
+        counters, and the most recent error to its counter."""
+        if self._reservoir is None:
+            return
+        slowest, error = self._reservoir.collect()
+        # pylint: disable=protected-access
+        buckets = self._buckets
+        linked_buckets = set()
+        linked_counters = set()
+        # The slowest call of each bucket and counter wins
+        for trace_context, duration, timestamp, counter in slowest:
+            labels: Any = ExemplarLabels(*trace_context)
+            index = bisect_left(self._upper_bounds, duration)
+            if index not in linked_buckets:
+                linked_buckets.add(index)
+                buckets[index].set_exemplar(Exemplar(labels, duration, timestamp))
+            if id(counter) not in linked_counters:
+                linked_counters.add(id(counter))
+                counter._value.set_exemplar(Exemplar(labels, 1, timestamp))
+        if error is not None:
+            trace_context, duration, timestamp, counter = error
+            labels = ExemplarLabels(*trace_context)
+            counter._value.set_exemplar(Exemplar(labels, 1, timestamp))
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Finish tracking metrics for a batch of calls to the function from the same caller."""
+        counts, timed, total = summarize_batch(durations, results)
+        for result, count in counts.items():
+            self._counter_for(caller_module, caller_function, result).inc(count)
+
+        self.calls += len(durations)
+        if len(timed):
+            self.timed_calls += len(timed)
+            self.timed_duration += total
+            observe_many(self._histogram, timed, total)
+
+        if self._concurrency is not None:
+            self._concurrency.dec(len(durations))
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls that were already counted in histogram buckets."""
+        timed = sum(bucket_counts)
+        self._counter_for(caller_module, caller_function, result).inc(untimed + timed)
+
+        self.calls += untimed + timed
+        if timed:
+            total = sum(bucket_sums)
+            self.timed_calls += timed
+            self.timed_duration += total
+            counts = rebucket(
+                bounds, bucket_counts, bucket_sums, self._upper_bounds[:-1]
+            )
+            for bucket, count in zip(self._buckets, counts):
+                if count:
+                    bucket.inc(count)
+            self._sum.inc(total)
+
+
+def observe_many(histogram: Histogram, durations: Sequence[float], total: float):
+    """Observe a batch of durations on a histogram (child), updating each bucket once."""
+    # prometheus-client has no public API to observe many values at once
+    buckets = histogram._buckets  # pylint: disable=protected-access
+    counts = bucket_counts(
+        histogram._upper_bounds, durations
+    )  # pylint: disable=protected-access
+    histogram._sum.inc(total)  # pylint: disable=protected-access
+    for bucket, count in zip(buckets, counts):
+        if count:
+            bucket.inc(count)
+
+
+class ShardedPrometheusCollector(Collector):
+    """Collects the function call counters and histograms from a sharded (or multiprocess) accumulator."""
+
+    def __init__(
+        self, accumulator: Union[ShardedAccumulator, "MultiprocessAccumulator"]
+    ):
+        self.accumulator = accumulator
+
+    def describe(self) -> Iterable[Metric]:
+        # The metrics have the same names as the counter and histogram of the tracker,
+        # which are unregistered while this collector is in use.
+        return []
+
+    def collect(self) -> Iterable[Metric]:
+        total = self.accumulator.merged()
+
+        counter = CounterMetricFamily(
+            COUNTER_NAME_PROMETHEUS, COUNTER_DESCRIPTION, labels=COUNTER_LABELS
+        )
+        for counter_key, count in total.counts.items():
+            counter.add_metric(counter_key, count)
+
+        histogram = HistogramMetricFamily(
+            HISTOGRAM_NAME_PROMETHEUS,
+            HISTOGRAM_DESCRIPTION,
+            labels=HISTOGRAM_LABELS,
+            unit="seconds",
+        )
+        for histogram_key, buckets in total.histograms.items():
+            histogram.add_metric(
+                histogram_key,
+                [
+                    (floatToGoString(bound), count)
+                    for bound, count in cumulative_buckets(
+                        self.accumulator.buckets_for(histogram_key), buckets
+                    )
+                ],
+                buckets[-1],
+            )
+
+        return [counter, histogram]
+
+
+class TrackerCollector(Collector):
+    """Collects the function call counters and histograms of the tracker, when they need
+    more than the counter and histogram of prometheus-client.
+
+    With tail exemplars, the slowest calls since the previous scrape are linked to the
+    series first, every scrape is an interval of the exemplar reservoirs. The histograms
+    of the functions with buckets of their own (or exponential buckets) are exposed with
+    the others.
+    """
+
+    def __init__(self, tracker: PrometheusTracker):
+        self.tracker = tracker
+
+    def describe(self) -> Iterable[Metric]:
+        return []
+
+    def collect(self) -> Iterable[Metric]:
+        tracker = self.tracker
+        tracker.flush_exemplars()
+        histograms: List[Metric] = list(PrometheusTracker.prom_histogram.collect())
+        for layout_histogram in list(tracker._histograms.values()):
+            for metric in layout_histogram.collect():
+                histograms[0].samples.extend(metric.samples)
+        return [*PrometheusTracker.prom_counter.collect(), *histograms]
+
+
+_collector: Optional[Collector] = None
+
+
+def use_collector(
+    collector: Optional[Collector],
+    registry: CollectorRegistry = REGISTRY,
+):
+    """Expose the function call metrics through the given collector,
+    or through the counter and histogram of the tracker when it is None."""
+    global _collector
+    if _collector is None and collector is None:
+        return
+
+    if _collector is not None:
+        registry.unregister(_collector)
+    else:
+        registry.unregister(PrometheusTracker.prom_counter)
+        registry.unregister(PrometheusTracker.prom_histogram)
+
+    if collector is not None:
+        registry.register(collector)
+    else:
+        registry.register(PrometheusTracker.prom_counter)
+        registry.register(PrometheusTracker.prom_histogram)
+    _collector = collector
+
+
+class QuantileCollector(Collector):
+    """Collects the quantiles of the functions decorated with `quantiles` as a summary,
+    with the count and sum of the calls in the window of the quantiles."""
+
+    def __init__(self, tracker: PrometheusTracker):
+        self.tracker = tracker
+
+    def describe(self) -> Iterable[Metric]:
+        return []
+
+    def collect(self) -> Iterable[Metric]:
+        service_name = self.tracker._settings.service_name
+        summary = SummaryMetricFamily(
+            QUANTILES_NAME_PROMETHEUS,
+            QUANTILES_DESCRIPTION,
+            labels=["function", "module", SERVICE_NAME_PROMETHEUS],
+            unit="seconds",
+        )
+        for function_sketch in function_sketches():
+            labels = [function_sketch.function, function_sketch.module, service_name]
+            sketch = function_sketch.sketch()
+            values = sketch.quantiles(function_sketch.quantiles)
+            for quantile, value in zip(function_sketch.quantiles, values):
+                if value is not None:
+                    summary.add_sample(
+                        summary.name,
+                        {
+                            "function": function_sketch.function,
+                            "module": function_sketch.module,
+                            SERVICE_NAME_PROMETHEUS: service_name,
+                            "quantile": floatToGoString(quantile),
+                        },
+                        value,
+                    )
+            summary.add_metric(labels, sketch.count, sketch.sum)
+        return [summary]
+
+
+class ObjectiveCollector(Collector):
+    """Collects the burn rates and remaining error budgets of the objectives that are
+    evaluated in-process."""
+
+    def describe(self) -> Iterable[Metric]:
+        return []
+
+    def collect(self) -> Iterable[Metric]:
+        labels = [OBJECTIVE_NAME_PROMETHEUS, "indicator", "window"]
+        gauges = {
+            "burn_rate": GaugeMetricFamily(
+                OBJECTIVE_BURN_RATE_NAME_PROMETHEUS,
+                OBJECTIVE_BURN_RATE_DESCRIPTION,
+                labels=labels,
+            ),
+            "error_budget_remaining": GaugeMetricFamily(
+                OBJECTIVE_BUDGET_NAME_PROMETHEUS,
+                OBJECTIVE_BUDGET_DESCRIPTION,
+                labels=labels[:2],
+            ),
+        }
+        for evaluator in objective_evaluators():
+            status = evaluator.status()
+            for (name, indicator), values in status_gauges(status).items():
+                for window, value in values:
+                    window_labels = [window] if window else []
+                    gauges[name].add_metric(
+                        [status.objective, indicator, *window_labels], value
+                    )
+        return list(gauges.values())
+
+
+_in_process_collectors: List[Collector] = []
+
+
+def use_in_process_collectors(
+    tracker: PrometheusTracker, registry: CollectorRegistry = REGISTRY
+):
+    """Expose the quantiles of the functions and the status of the objectives, once,
+    with the settings of the given tracker."""
+    if not _in_process_collectors:
+        _in_process_collectors.extend(
+            [QuantileCollector(tracker), ObjectiveCollector()]
         )
+        for collector in _in_process_collectors:
+            registry.register(collector)
+        return
+
+    for collector in _in_process_collectors:
+        if isinstance(collector, QuantileCollector):
+            collector.tracker = tracker
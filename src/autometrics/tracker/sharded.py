@@ -0,0 +1,288 @@
+import threading
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .batch import DurationBatch, bucket_counts, bucket_means, rebucket, summarize_batch
+from .types import BatchResult, Result
+
+# (function, module, service_name, result, caller_module, caller_function, objective_name, objective_percentile)
+CounterKey = Tuple[str, str, str, str, str, str, str, str]
+# (function, module, service_name, objective_name, objective_percentile, objective_latency_threshold)
+HistogramKey = Tuple[str, str, str, str, str, str]
+
+
+class Shard:
+    """The counts and histogram buckets accumulated by a single thread."""
+
+    __slots__ = ("counts", "histograms", "thread")
+
+    def __init__(self, thread: Optional[threading.Thread] = None):
+        self.counts: Dict[CounterKey, int] = {}
+        # One list per series: the count of every bucket (including +Inf), followed by the sum
+        self.histograms: Dict[HistogramKey, List[float]] = {}
+        self.thread = thread
+
+    def merge(self, other: "Shard"):
+        """Add the counts and buckets of another shard to this one."""
+        for counter_key, count in other.counts.copy().items():
+            self.counts[counter_key] = self.counts.get(counter_key, 0) + count
+        for histogram_key, buckets in other.histograms.copy().items():
+            merged = self.histograms.get(histogram_key)
+            if merged is None:
+                self.histograms[histogram_key] = list(buckets)
+            else:
+                for index, value in enumerate(list(buckets)):
+                    merged[index] += value
+
+
+class ShardedAccumulator:
+    """Accumulates counts and histogram buckets in a shard per thread.
+
+    Recording a call only touches the shard of the current thread, so it takes no lock.
+    The shards are merged when the metrics are collected, the totals are exact.
+    The shards of threads that have exited are folded into a single retired shard."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        # The buckets of the histograms that do not use the default buckets
+        self.layouts: Dict[HistogramKey, Tuple[float, ...]] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[Shard] = []
+        self._retired = Shard()
+
+    def shard(self) -> Shard:
+        """Get the shard of the current thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def initialize(self, key: CounterKey):
+        """Initialize a counter at zero."""
+        with self._lock:
+            self._retired.counts.setdefault(key, 0)
+
+    def initialize_histogram(
+        self, key: HistogramKey, buckets: Optional[Tuple[float, ...]] = None
+    ):
+        """Initialize a histogram at zero, with the given buckets or the default ones."""
+        with self._lock:
+            if buckets is not None and key not in self.layouts:
+                self.layouts[key] = buckets
+                # Drop the (empty) histogram the key had with the default buckets
+                self._retired.histograms.pop(key, None)
+            self._retired.histograms.setdefault(
+                key, [0.0] * (len(self.buckets_for(key)) + 2)
+            )
+
+    def buckets_for(self, key: HistogramKey) -> Tuple[float, ...]:
+        """Get the buckets of a histogram."""
+        return self.layouts.get(key, self.buckets)
+
+    def merged(self) -> Shard:
+        """Merge the shards of all threads into a new shard."""
+        with self._lock:
+            alive = []
+            for shard in self._shards:
+                if shard.thread is not None and not shard.thread.is_alive():
+                    self._retired.merge(shard)
+                else:
+                    alive.append(shard)
+            self._shards = alive
+            total = Shard()
+            total.merge(self._retired)
+            for shard in alive:
+                total.merge(shard)
+        return total
+
+
+class ShardedFunctionMetrics:
+    """Metrics of a single function that are accumulated in per-thread shards."""
+
+    def __init__(
+        self,
+        accumulator: ShardedAccumulator,
+        counter_labels: Tuple[str, str, str, str, str],
+        histogram_key: HistogramKey,
+        sample_rate: float,
+        concurrency_inc: Optional[Callable[[], None]] = None,
+        concurrency_dec: Optional[Callable[[], None]] = None,
+        record_duration: Optional[Callable[[float], None]] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ):
+        """Create the metrics of a function.
+
+        If `record_duration` is given, durations are passed to it instead of being
+        accumulated in the histogram buckets of the shard, the durations of a batch as a
+        single `DurationBatch`. With `buckets`, the histogram
+        has buckets of its own."""
+        self.sample_rate = sample_rate
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+        self._accumulator = accumulator
+        self._counter_labels = counter_labels
+        self._counter_keys: Dict[Tuple[str, str, Result], CounterKey] = {}
+        self._histogram_key = histogram_key
+        self._concurrency_inc = concurrency_inc
+        self._concurrency_dec = concurrency_dec
+        self._record_duration = record_duration
+
+        for result in Result:
+            accumulator.initialize(self._counter_key_for("", "", result))
+        if record_duration is None:
+            accumulator.initialize_histogram(histogram_key, buckets)
+        self._buckets = accumulator.buckets_for(histogram_key)
+
+    def _counter_key_for(
+        self, caller_module: str, caller_function: str, result: Result
+    ) -> CounterKey:
+        """Build (and cache) the counter key for the given caller and result."""
+        key = (caller_module, caller_function, result)
+        counter_key = self._counter_keys.get(key)
+        if counter_key is None:
+            (
+                function,
+                module,
+                service_name,
+                objective_name,
+                percentile,
+            ) = self._counter_labels
+            counter_key = self._counter_keys.setdefault(
+                key,
+                (
+                    function,
+                    module,
+                    service_name,
+                    result.value,
+                    caller_module,
+                    caller_function,
+                    objective_name,
+                    percentile,
+                ),
+            )
+        return counter_key
+
+    def start(self):
+        """Start tracking metrics for a function call."""
+        if self._concurrency_inc is not None:
+            self._concurrency_inc()
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Finish tracking metrics for a function call."""
+        shard = self._accumulator.shard()
+        counter_key = self._counter_keys.get((caller_module, caller_function, result))
+        if counter_key is None:
+            counter_key = self._counter_key_for(caller_module, caller_function, result)
+        counts = shard.counts
+        counts[counter_key] = counts.get(counter_key, 0) + 1
+
+        self.calls += 1
+        if duration is not None:
+            self.timed_calls += 1
+            self.timed_duration += duration
+            if self._record_duration is not None:
+                self._record_duration(duration)
+            else:
+                self._observe(shard, duration)
+
+        if self._concurrency_dec is not None:
+            self._concurrency_dec()
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Finish tracking metrics for a batch of calls to the function from the same caller."""
+        counts, timed, total = summarize_batch(durations, results)
+        shard = self._accumulator.shard()
+        for result, count in counts.items():
+            counter_key = self._counter_key_for(caller_module, caller_function, result)
+            shard.counts[counter_key] = shard.counts.get(counter_key, 0) + count
+
+        self.calls += len(durations)
+        if len(timed):
+            self.timed_calls += len(timed)
+            self.timed_duration += total
+            if self._record_duration is not None:
+                self._record_duration(DurationBatch(timed, total))
+            else:
+                histogram = self._histogram(shard)
+                for index, count in enumerate(bucket_counts(self._buckets, timed)):
+                    histogram[index] += count
+                histogram[-1] += total
+
+        if self._concurrency_dec is not None:
+            for _ in durations:
+                self._concurrency_dec()
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls that were already counted in histogram buckets."""
+        timed = sum(bucket_counts)
+        shard = self._accumulator.shard()
+        counter_key = self._counter_key_for(caller_module, caller_function, result)
+        shard.counts[counter_key] = shard.counts.get(counter_key, 0) + untimed + timed
+
+        self.calls += untimed + timed
+        if timed:
+            total = sum(bucket_sums)
+            self.timed_calls += timed
+            self.timed_duration += total
+            if self._record_duration is not None:
+                means, counts = bucket_means(bounds, bucket_counts, bucket_sums)
+                self._record_duration(DurationBatch(means, total, counts))
+            else:
+                histogram = self._histogram(shard)
+                for index, count in enumerate(
+                    rebucket(bounds, bucket_counts, bucket_sums, self._buckets)
+                ):
+                    histogram[index] += count
+                histogram[-1] += total
+
+    def _histogram(self, shard: Shard) -> List[float]:
+        """Get the histogram buckets of the function in the shard."""
+        histogram = shard.histograms.get(self._histogram_key)
+        if histogram is None:
+            histogram = shard.histograms[self._histogram_key] = [0.0] * (
+                len(self._buckets) + 2
+            )
+        return histogram
+
+    def _observe(self, shard: Shard, duration: float):
+        """Add the duration to the histogram buckets of the shard."""
+        histogram = self._histogram(shard)
+        histogram[bisect_left(self._buckets, duration)] += 1
+        histogram[-1] += duration
+
+
+def cumulative_buckets(
+    buckets: Sequence[float], histogram: List[float]
+) -> Iterator[Tuple[float, float]]:
+    """Turn the per-bucket counts of a sharded histogram into cumulative (upper bound, count) pairs."""
+    total = 0.0
+    for bound, count in zip(list(buckets) + [float("inf")], histogram[:-1]):
+        total += count
+        yield bound, total
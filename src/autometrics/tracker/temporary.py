@@ -1,17 +1,48 @@
-import logging
+import threading
 
-from typing import Optional
+from bisect import bisect_left
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
 
-from .types import Result, TrackerMessage, MessageQueue, TrackMetrics
-from ..objectives import Objective
+from ..buckets import function_buckets
+from .batch import bucket_means
+from .types import (
+    BatchResult,
+    FunctionMetrics,
+    Result,
+    TrackMetrics,
+)
+from ..objectives import Objective, ObjectiveLatency
+
+if TYPE_CHECKING:
+    from ..settings import SettingsSnapshot
+
+# The durations of functions without buckets of their own (or from their objective) are
+# aggregated in the default histogram buckets, so unless custom buckets are configured in
+# init(), the calls end up in the same buckets when they are replayed.
+BUCKETS = [float(latency.value) for latency in ObjectiveLatency]
 
 
 class TemporaryTracker:
-    """A tracker that temporarily stores metrics only to hand them off to another tracker."""
+    """A tracker that temporarily aggregates metrics only to hand them off to another tracker.
+
+    Calls are aggregated in place, per function, caller and result, so the memory that is
+    used does not grow with the number of calls. The aggregated calls are replayed on the
+    tracker created by `init()` with one update per histogram bucket."""
 
-    _queue: MessageQueue = []
-    _is_closed: bool = False
-    _new_tracker: Optional[TrackMetrics] = None
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._functions: Dict[
+            Tuple[
+                str,
+                str,
+                Optional[Objective],
+                bool,
+                Optional[float],
+                Optional[Tuple[float, ...]],
+            ],
+            TemporaryFunctionMetrics,
+        ] = {}
+        self._new_tracker: Optional[TrackMetrics] = None
 
     def set_build_info(self, commit: str, version: str, branch: str):
         """Observe the build info. Should only be called once per tracker instance"""
@@ -21,11 +52,13 @@ class TemporaryTracker:
         self, function: str, module: str, track_concurrency: Optional[bool] = False
     ):
         """Start tracking metrics for a function call."""
-        self.append_to_queue(("start", function, module, track_concurrency))
+        self.register_function(
+            function, module, track_concurrency=track_concurrency
+        ).start()
 
     def finish(
         self,
-        duration: float,
+        duration: Optional[float],
         function: str,
         module: str,
         caller_module: str,
@@ -35,20 +68,26 @@ class TemporaryTracker:
         track_concurrency: Optional[bool] = False,
     ):
         """Finish tracking metrics for a function call."""
-        self.append_to_queue(
-            (
-                "finish",
-                duration,
-                function,
-                module,
-                caller_module,
-                caller_function,
-                result,
-                objective,
-                track_concurrency,
-            )
+        self.register_function(function, module, objective, track_concurrency).finish(
+            duration, caller_module, caller_function, result
         )
 
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        function: str,
+        module: str,
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+    ):
+        """Finish tracking metrics for a batch of calls to a function from the same caller."""
+        self.register_function(
+            function, module, objective, track_concurrency
+        ).finish_many(durations, caller_module, caller_function, results)
+
     def initialize_counters(
         self,
         function: str,
@@ -56,27 +95,285 @@ class TemporaryTracker:
         objective: Optional[Objective] = None,
     ):
         """Initialize (counter) metrics for a function at zero."""
-        self.append_to_queue(("initialize_counters", function, module, objective))
-
-    def append_to_queue(self, message: TrackerMessage):
-        """Append a message to the queue."""
-        if not self._is_closed:
-            self._queue.append(message)
-            if len(self._queue) > 999:
-                self._is_closed = True
-        elif self._new_tracker is not None:
-            function_name, *args = message
-            function = getattr(self._new_tracker, function_name)
-            function(*args)
-        else:
-            logging.error(
-                "Temporary tracker queue is filled, this metric will be dropped. Please run init() when your application starts."
+        self.register_function(function, module, objective)
+
+    def register_function(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ) -> FunctionMetrics:
+        """Initialize (counter) metrics for a function at zero and return a handle to its metrics."""
+        key = (
+            function,
+            module,
+            objective,
+            bool(track_concurrency),
+            sample_rate,
+            buckets,
+        )
+        with self._lock:
+            if self._new_tracker is not None:
+                new_tracker = self._new_tracker
+            else:
+                metrics = self._functions.get(key)
+                if metrics is None:
+                    metrics = self._functions[key] = TemporaryFunctionMetrics(
+                        self,
+                        function,
+                        module,
+                        objective,
+                        track_concurrency,
+                        sample_rate,
+                        buckets,
+                    )
+                return metrics
+        return new_tracker.register_function(
+            function, module, objective, track_concurrency, sample_rate, buckets
+        )
+
+    def function_metrics(self) -> List[FunctionMetrics]:
+        """Get the metrics of all the functions registered with this tracker."""
+        # The aggregated calls are only tracked once they are replayed on another tracker
+        return []
+
+    def estimate_overhead(self, calls: int = 1000) -> float:
+        """Estimate the time (in seconds) it takes to record a timed call."""
+        return 0.0
+
+    def reset_after_fork(self):
+        """Drop the calls aggregated before the process was forked, the parent reports them."""
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+        for metrics in self._functions.values():
+            metrics.reset(self._lock)
+
+    def close_after_fork(self):
+        """Nothing to drop, the aggregated calls are dropped when the process is forked."""
+        pass
+
+    def apply_settings(self, settings: "SettingsSnapshot"):
+        """Apply settings that were changed at runtime.
+
+        Nothing is recorded with the settings yet, the tracker that the calls are replayed
+        on reads the current settings."""
+        pass
+
+    def replay(self, tracker: TrackMetrics):
+        """Replay the aggregated calls on a different tracker.
+
+        Calls that are recorded on this tracker afterwards are passed on to the other tracker.
+        """
+        with self._lock:
+            self._new_tracker = tracker
+            functions = list(self._functions.values())
+        for metrics in functions:
+            metrics.replay(tracker)
+
+
+class TemporaryFunctionMetrics:
+    """Metrics of a single function, aggregated on a temporary tracker."""
+
+    def __init__(
+        self,
+        tracker: TemporaryTracker,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ):
+        # The settings are only known after init(), until then use the rate of the function
+        self.sample_rate = 1.0 if sample_rate is None else sample_rate
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+        self._lock = tracker._lock
+        self._function = function
+        self._module = module
+        self._objective = objective
+        self._track_concurrency = track_concurrency
+        self._buckets = buckets
+        # The buckets the calls are aggregated in, the ones the function is recorded with
+        self._layout: Sequence[float] = function_buckets(objective, buckets) or BUCKETS
+        self._requested_sample_rate = sample_rate
+        self._starts = 0
+        # Per caller and result: the number of untimed calls, followed by the number of
+        # timed calls per bucket, followed by the total duration per bucket
+        self._series: Dict[Tuple[str, str, Result], List[float]] = {}
+        self._forward: Optional[FunctionMetrics] = None
+
+    def start(self):
+        """Start tracking metrics for a function call."""
+        with self._lock:
+            forward = self._forward
+            if forward is None:
+                self._starts += 1
+                return
+        forward.start()
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Finish tracking metrics for a function call."""
+        with self._lock:
+            forward = self._forward
+            if forward is None:
+                self._aggregate(duration, caller_module, caller_function, result)
+                return
+        forward.finish(duration, caller_module, caller_function, result)
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Finish tracking metrics for a batch of calls to the function from the same caller."""
+        if results is not None and len(results) != len(durations):
+            raise ValueError(
+                f"Got {len(durations)} durations but {len(results)} results, they should have the same length."
             )
+        with self._lock:
+            forward = self._forward
+            if forward is None:
+                for index, duration in enumerate(durations):
+                    result = Result.OK if results is None else results[index]
+                    if not isinstance(result, Result):
+                        result = Result.OK if result else Result.ERROR
+                    if duration != duration:  # NaN marks a call that was not timed
+                        duration = None
+                    self._aggregate(duration, caller_module, caller_function, result)
+                return
+        forward.finish_many(durations, caller_module, caller_function, results)
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls that were already counted in histogram buckets."""
+        with self._lock:
+            forward = self._forward
+            if forward is None:
+                series = self._series_for(caller_module, caller_function, result)
+                layout = self._layout
+                timed = sum(bucket_counts)
+                self.calls += untimed + timed
+                self.timed_calls += timed
+                self.timed_duration += sum(bucket_sums)
+                series[0] += untimed
+                if tuple(bounds) == tuple(layout):
+                    for index, (count, total) in enumerate(
+                        zip(bucket_counts, bucket_sums)
+                    ):
+                        series[1 + index] += count
+                        series[2 + len(layout) + index] += total
+                else:
+                    # The calls of a bucket go into the bucket of their mean duration
+                    means, counts = bucket_means(bounds, bucket_counts, bucket_sums)
+                    for mean, count in zip(means, counts):
+                        index = bisect_left(layout, mean)
+                        series[1 + index] += count
+                        series[2 + len(layout) + index] += mean * count
+                return
+        forward.add_bucketed(
+            caller_module,
+            caller_function,
+            result,
+            untimed,
+            bounds,
+            bucket_counts,
+            bucket_sums,
+        )
+
+    def _series_for(
+        self, caller_module: str, caller_function: str, result: Result
+    ) -> List[float]:
+        """Get the series of a caller and result. Should be called while holding the lock."""
+        key = (caller_module, caller_function, result)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0.0] * (2 * len(self._layout) + 3)
+        return series
+
+    def _aggregate(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+    ):
+        """Add a call to its series. Should be called while holding the lock."""
+        layout = self._layout
+        series = self._series_for(caller_module, caller_function, result)
+        self.calls += 1
+        if duration is None:
+            series[0] += 1
+        else:
+            self.timed_calls += 1
+            self.timed_duration += duration
+            index = bisect_left(layout, duration)
+            series[1 + index] += 1
+            series[2 + len(layout) + index] += duration
+
+    def reset(self, lock: threading.Lock):
+        """Drop the aggregated calls, and use a new lock."""
+        self._lock = lock
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+        self._starts = 0
+        self._series = {}
+
+    def replay(self, tracker: TrackMetrics):
+        """Replay the aggregated calls on another tracker, and pass on the calls that follow.
+
+        Every series is replayed with `add_bucketed`, which updates each counter and
+        histogram bucket once, so a replay takes one update per bucket however many calls
+        were aggregated. The calls that were started but not finished yet are started on
+        the other tracker, where they finish.
 
-    def replay_queue(self, tracker: TrackMetrics):
-        """Replay a queue of messages on a different tracker."""
-        self._new_tracker = tracker
-        self._is_closed = True
-        for function_name, *args in self._queue:
-            function = getattr(tracker, function_name)
-            function(*args)
+        From the moment the calls are handed off, calls are passed on to the other
+        tracker, so they are replayed without holding the lock."""
+        metrics = tracker.register_function(
+            self._function,
+            self._module,
+            self._objective,
+            self._track_concurrency,
+            self._requested_sample_rate,
+            self._buckets,
+        )
+        with self._lock:
+            series = self._series
+            in_flight = max(0, self._starts - self.calls)
+            self._series = {}
+            self._starts = 0
+            self._forward = metrics
+        for _ in range(in_flight):
+            metrics.start()
+        layout = self._layout
+        for (caller_module, caller_function, result), values in series.items():
+            metrics.add_bucketed(
+                caller_module,
+                caller_function,
+                result,
+                int(values[0]),
+                layout,
+                [int(count) for count in values[1 : len(layout) + 2]],
+                values[len(layout) + 2 :],
+            )
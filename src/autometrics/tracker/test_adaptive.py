@@ -0,0 +1,134 @@
+from typing import List
+
+from .adaptive import DetailLevel, OverheadController
+from .tracker import get_controller
+from ..initialization import init
+
+
+class FakeMetrics:
+    """Function metrics that only keep the call statistics."""
+
+    def __init__(self, sample_rate: float = 1.0):
+        self.sample_rate = sample_rate
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+
+    def record(self, calls: int, duration: float):
+        """Record the given number of calls, and time them according to the sample rate."""
+        timed_calls = int(calls * self.sample_rate)
+        self.calls += calls
+        self.timed_calls += timed_calls
+        self.timed_duration += timed_calls * duration
+
+
+class FakeTracker:
+    def __init__(self, metrics: List[FakeMetrics]):
+        self.metrics = metrics
+
+    def function_metrics(self):
+        return self.metrics
+
+    def estimate_overhead(self, calls: int = 1000) -> float:
+        return 0.00001
+
+
+def test_hot_function_is_degraded_and_restored():
+    """Test that a hot, tiny function steps down to counters only, and back up when load drops."""
+    metrics = FakeMetrics()
+    controller = OverheadController(
+        FakeTracker([metrics]), overhead_budget=0.05, min_call_rate=100, interval=1
+    )
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.FULL
+
+    # 10µs of overhead for a 2µs function is way over budget, and so is the 1µs of a
+    # sampled call (plus the 5µs of counting it)
+    metrics.record(1000, 0.000002)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.SAMPLED
+    assert metrics.sample_rate == 0.1
+
+    metrics.record(1000, 0.000002)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.COUNTERS
+    assert metrics.sample_rate == 0.0
+
+    # Stays at counters only while the load is high
+    metrics.record(1000, 0.000002)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.COUNTERS
+
+    # Load drops, so the detail level is raised step by step
+    metrics.record(10, 0.000002)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.SAMPLED
+    metrics.record(10, 0.000002)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.FULL
+    assert metrics.sample_rate == 1.0
+
+
+def test_slow_function_is_not_degraded():
+    """Test that a hot function that is slow compared to the overhead keeps full detail."""
+    metrics = FakeMetrics(sample_rate=0.5)
+    controller = OverheadController(
+        FakeTracker([metrics]), overhead_budget=0.05, min_call_rate=100, interval=1
+    )
+    controller.evaluate()
+    metrics.record(1000, 0.01)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.FULL
+    assert metrics.sample_rate == 0.5
+
+
+def test_counting_overhead_is_included():
+    """Test that the overhead of counting the calls is part of the overhead of every
+    level, so a function whose sampled durations are cheap enough can still step down.
+    """
+    metrics = FakeMetrics()
+    controller = OverheadController(
+        FakeTracker([metrics]),
+        overhead_budget=0.05,
+        min_call_rate=100,
+        interval=1,
+        call_overhead=0.00001,
+    )
+    controller.evaluate()
+    # 20µs of overhead for a 100µs function is over budget
+    metrics.record(1000, 0.0001)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.SAMPLED
+    # Sampled calls take 1µs of overhead, but counting them takes 10µs
+    metrics.record(1000, 0.0001)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.COUNTERS
+
+
+def test_init_starts_controller():
+    """Test that configuring an overhead budget starts a controller for the tracker."""
+    init(tracker="prometheus", overhead_budget=0.1)
+    controller = get_controller()
+    assert controller is not None
+    assert controller.overhead_budget == 0.1
+    assert controller.overhead > 0
+    controller.stop()
+
+
+def test_sample_rate_changed_from_outside():
+    """Test that a sample rate that is changed from outside becomes the configured rate."""
+    metrics = FakeMetrics()
+    controller = OverheadController(
+        FakeTracker([metrics]), overhead_budget=0.05, min_call_rate=100, interval=1
+    )
+    controller.evaluate()
+    metrics.record(1000, 0.00002)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.SAMPLED
+
+    # e.g. update_settings(sample_rate=0.5)
+    metrics.sample_rate = 0.5
+    metrics.record(10, 0.00002)
+    controller.evaluate()
+    assert controller.level(metrics) == DetailLevel.FULL
+    assert metrics.sample_rate == 0.5
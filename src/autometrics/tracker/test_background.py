@@ -0,0 +1,127 @@
+from prometheus_client.exposition import generate_latest
+
+from .background import BackgroundTracker
+from .tracker import get_tracker
+from .types import Result
+from ..initialization import init
+
+
+class RecordingMetrics:
+    """Function metrics that remember the calls they finished."""
+
+    def __init__(self):
+        self.sample_rate = 1.0
+        self.calls = 0
+        self.timed_calls = 0
+        self.timed_duration = 0.0
+        self.finished = []
+        self.batches = 0
+        self.in_flight = 0
+
+    def start(self):
+        self.in_flight += 1
+
+    def finish(self, duration, caller_module, caller_function, result=Result.OK):
+        self.calls += 1
+        self.in_flight -= 1
+        self.finished.append((duration, caller_module, caller_function, result))
+
+    def finish_many(self, durations, caller_module, caller_function, results=None):
+        self.batches += 1
+        for duration, result in zip(durations, results):
+            self.finish(duration, caller_module, caller_function, result)
+
+    def add_bucketed(self, caller_module, caller_function, result, untimed, *buckets):
+        self.calls += untimed
+
+
+class RecordingTracker:
+    def __init__(self):
+        self.metrics = RecordingMetrics()
+
+    def register_function(self, *args):
+        return self.metrics
+
+
+def test_queued_calls_are_flushed():
+    """Test that the queued calls are recorded on the tracker, in one batch per caller, when the queue is flushed."""
+    inner = RecordingTracker()
+    tracker = BackgroundTracker(inner, interval=60)  # type: ignore
+    metrics = tracker.register_function("function", "module")
+
+    metrics.finish(0.1, "caller_module", "caller_function")
+    metrics.finish(None, "", "", Result.ERROR)
+    metrics.finish(0.2, "caller_module", "caller_function")
+    assert inner.metrics.finished == []
+
+    tracker.flush()
+    assert inner.metrics.finished == [
+        (0.1, "caller_module", "caller_function", Result.OK),
+        (0.2, "caller_module", "caller_function", Result.OK),
+        (None, "", "", Result.ERROR),
+    ]
+    assert inner.metrics.batches == 2
+    assert metrics.calls == 3
+    tracker.shutdown()
+
+
+def test_full_queue_drops_calls():
+    """Test that calls are dropped and counted when the queue is full, and the rest is flushed on shutdown."""
+    inner = RecordingTracker()
+    tracker = BackgroundTracker(inner, capacity=3, interval=60)  # type: ignore
+    metrics = tracker.register_function("function", "module")
+
+    for _ in range(5):
+        metrics.finish(0.1, "", "")
+    assert tracker.dropped == 2
+
+    tracker.shutdown()
+    assert inner.metrics.calls == 3
+
+
+def test_full_queue_keeps_concurrency_balanced():
+    """Test that a full queue drops whole calls of a function that tracks concurrency, so
+    the gauge is back at zero once all calls are finished."""
+    inner = RecordingTracker()
+    tracker = BackgroundTracker(inner, capacity=2, interval=60)  # type: ignore
+    metrics = tracker.register_function("function", "module", track_concurrency=True)
+
+    for _ in range(3):
+        metrics.start()
+    # The third start was dropped, so one finish is dropped too
+    for _ in range(3):
+        metrics.finish(0.1, "", "")
+    assert tracker.dropped == 2
+
+    tracker.flush()
+    assert inner.metrics.in_flight == 0
+    assert inner.metrics.calls == 2
+
+    # The finish of a call whose start was queued is queued even when the queue is full
+    tracker.start("function", "module", track_concurrency=True)
+    tracker.start("function", "module", track_concurrency=True)
+    tracker.finish(None, "function", "module", "", "", track_concurrency=True)
+    tracker.finish(None, "function", "module", "", "", track_concurrency=True)
+    assert len(tracker._queue) == 4
+    assert tracker.dropped == 2
+    tracker.shutdown()
+    assert inner.metrics.in_flight == 0
+    assert inner.metrics.calls == 4
+
+
+def test_background_tracking_prometheus(monkeypatch):
+    """Test that init wraps the tracker when background tracking is enabled."""
+    monkeypatch.setenv("AUTOMETRICS_TRACKER", "prometheus")
+    init(background_tracking=True)
+    tracker = get_tracker()
+    assert isinstance(tracker, BackgroundTracker)
+
+    metrics = tracker.register_function("background_function", "background_module")
+    metrics.finish(0.01, "", "")
+    tracker.shutdown()
+
+    data = generate_latest().decode("utf-8")
+    assert (
+        """function_calls_total{caller_function="",caller_module="",function="background_function",module="background_module",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 1.0"""
+        in data
+    )
@@ -0,0 +1,138 @@
+import pytest
+
+from prometheus_client import REGISTRY
+
+from .exponential import (
+    DEFAULT_MAX_BUCKETS,
+    ExponentialHistogram,
+    bucket_index,
+    fixed_layout,
+    sparse_buckets,
+    upper_bound,
+)
+from .prometheus import use_collector
+from .tracker import get_tracker
+
+from ..initialization import init
+from ..settings import init_settings
+
+
+def get_buckets(function: str):
+    """Get the (upper bound, cumulative count) of the exposed buckets of a function."""
+    buckets = []
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            if (
+                sample.name == "function_calls_duration_seconds_bucket"
+                and sample.labels["function"] == function
+            ):
+                buckets.append((float(sample.labels["le"]), sample.value))
+    return buckets
+
+
+@pytest.mark.parametrize("scale", [-2, 0, 3, 8])
+def test_bucket_index(scale):
+    """Test that every value falls in the bucket that holds it, including the bounds."""
+    histogram = ExponentialHistogram(max_scale=scale)
+    for value in [1e-6, 0.0003, 0.001, 0.25, 1.0, 3.0, 42.0]:
+        index = histogram.bucket_index(value)
+        assert upper_bound(index - 1, scale) < value <= upper_bound(index, scale)
+    for index in [-8, -1, 0, 5]:
+        power_of_two = upper_bound(index * (1 << max(scale, 0)) - 1, scale)
+        assert histogram.bucket_index(power_of_two) == index * (1 << max(scale, 0)) - 1
+
+
+def test_downscale():
+    """Test that the buckets are merged once more buckets than the limit have values."""
+    histogram = ExponentialHistogram(max_scale=8, max_buckets=4)
+    values = [0.0, 0.0001, 0.001, 0.01, 0.1, 1.0]
+    for value in values:
+        histogram.observe(value)
+
+    assert len(histogram.counts) <= 4
+    assert histogram.scale < 8
+    bounds, counts = histogram.buckets()
+    assert bounds[0] == 0.0 and counts[0] == 1
+    assert sum(counts) == len(values)
+    assert histogram.sum == pytest.approx(sum(values))
+
+
+def test_observe_many():
+    """Test that a batch is observed like the same values observed one by one."""
+    values = [0.0, 0.0001, 0.0001, 0.001, 0.01, 0.1, 1.0, 2.5]
+    one_by_one = ExponentialHistogram(max_scale=8, max_buckets=4)
+    for value in values:
+        one_by_one.observe(value)
+    batch = ExponentialHistogram(max_scale=8, max_buckets=4)
+    batch.observe_many(values, sum(values))
+
+    assert batch.scale == one_by_one.scale
+    assert batch.counts == one_by_one.counts
+    assert batch.zero_count == one_by_one.zero_count == 1
+    assert batch.sum == pytest.approx(one_by_one.sum)
+
+
+@pytest.mark.parametrize("max_buckets", [2, 24, DEFAULT_MAX_BUCKETS])
+def test_fixed_layout(max_buckets):
+    """Test that the buckets of a fixed layout fit the limit, and that the exponential
+    buckets of any scale are counted in the bucket of the layout that holds them."""
+    layout = fixed_layout(20, max_buckets)
+    bounds = layout.bounds
+    assert len(bounds) <= max_buckets
+    assert bounds[0] >= 1e-5 and bounds[-1] >= 100.0
+    assert list(bounds) == sorted(bounds)
+    for value in [1e-7, 1e-5, 0.0003, 0.001, 0.25, 1.0, 3.0, 42.0, 1e4]:
+        position = layout.position(bucket_index(value, 20), 20)
+        assert position == len(bounds) or value <= bounds[position]
+        assert position == 0 or bounds[position - 1] < value
+
+    # Values of zero are counted in the first bucket
+    index = bucket_index(42.0, 20)
+    counts = layout.rebucket(3, 20, [(index, 2), (index + 1, 0)])
+    assert len(counts) == len(bounds) + 1
+    assert counts[0] == 3 and counts[layout.position(index, 20)] == 2
+    assert sum(counts) == 5
+
+
+def test_sparse_buckets():
+    assert sparse_buckets(0, 2, [(-1, 1), (0, 0), (3, 4)]) == (
+        [0.0, 1.0, 16.0],
+        [2, 1, 4, 0],
+    )
+
+
+@pytest.mark.parametrize("tracker", ["prometheus", "opentelemetry"])
+def test_exponential_histograms(tracker):
+    """Test that the trackers expose exponential buckets with fixed bounds, which are fine
+    enough to tell sub-millisecond latencies apart."""
+    init(tracker=tracker, exponential_histograms=True, histogram_max_scale=4)
+    function = f"exponential_{tracker}"
+    try:
+        metrics = get_tracker().register_function(function, __name__)
+        for duration in [0.0001, 0.0001, 0.0004, 2.5]:
+            metrics.finish(duration, "", "")
+
+        bounds = [*fixed_layout(4, DEFAULT_MAX_BUCKETS).bounds, float("inf")]
+        buckets = get_buckets(function)
+        assert [bound for bound, _ in buckets] == pytest.approx(bounds)
+
+        def cumulative_count(value: float) -> float:
+            return next(count for bound, count in buckets if value <= bound)
+
+        # The calls under a millisecond are counted in buckets of their own
+        assert cumulative_count(0.0001) == 2
+        assert cumulative_count(0.0004) == 3
+        assert buckets[-1] == (float("inf"), 4)
+
+        # The bounds do not follow the values
+        metrics.finish(60.0, "", "")
+        assert [bound for bound, _ in get_buckets(function)] == pytest.approx(bounds)
+    finally:
+        use_collector(None)
+
+
+def test_exponential_histograms_settings():
+    with pytest.raises(ValueError):
+        init_settings(exponential_histograms=True, thread_sharding=True)
+    with pytest.raises(ValueError):
+        init_settings(exponential_histograms=True, histogram_max_scale=21)
@@ -0,0 +1,136 @@
+import os
+import signal
+import threading
+import time
+import traceback
+
+from prometheus_client import REGISTRY
+
+from .prometheus import PrometheusTracker
+from .temporary import TemporaryTracker
+from . import tracker
+from .tracker import get_tracker
+from ..decorator import autometrics
+from ..initialization import init
+
+
+def run_in_child(check, timeout: float = 10.0):
+    """Fork, run the check in the child and return its exit status.
+
+    A child that does not exit in time (e.g. because it deadlocked) is killed."""
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            check()
+        except BaseException:  # pylint: disable=broad-except
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+    deadline = time.monotonic() + timeout
+    while True:
+        waited_pid, status = os.waitpid(pid, os.WNOHANG)
+        if waited_pid:
+            return os.waitstatus_to_exitcode(status)
+        if time.monotonic() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            return -signal.SIGKILL
+        time.sleep(0.01)
+
+
+@autometrics
+def forked_function():
+    pass
+
+
+@autometrics
+def preloaded_function():
+    pass
+
+
+def get_calls(function: str):
+    return REGISTRY.get_sample_value(
+        "function_calls_total",
+        {
+            "function": function,
+            "module": __name__,
+            "service_name": "autometrics",
+            "result": "ok",
+            "caller_module": "",
+            "caller_function": "",
+            "objective_name": "",
+            "objective_percentile": "",
+        },
+    )
+
+
+def test_child_drops_calls_of_parent():
+    """Test that a forked process gets its own tracker, without the calls of the parent."""
+    init(tracker="prometheus")
+
+    forked_function()
+    parent_tracker = get_tracker()
+    assert get_calls("forked_function") == 1
+
+    def check():
+        # The tracker is only created when it is needed
+        assert isinstance(get_tracker(), tracker.ForkedTracker)
+        # The values of the parent are dropped when the tracker is created
+        forked_function()
+        child_tracker = get_tracker()
+        assert isinstance(child_tracker, PrometheusTracker)
+        assert child_tracker is not parent_tracker
+        assert get_calls("forked_function") == 1
+
+    assert run_in_child(check) == 0
+    assert get_tracker() is parent_tracker
+    assert get_calls("forked_function") == 1
+
+
+def test_preload():
+    """Test that with preload, the tracker is only created in forked processes."""
+    init(tracker="prometheus", preload=True)
+
+    preloaded_function()
+    assert isinstance(get_tracker(), TemporaryTracker)
+
+    def check():
+        assert isinstance(get_tracker(), tracker.ForkedTracker)
+        forked_function()
+        assert isinstance(get_tracker(), PrometheusTracker)
+        # The functions are initialized at zero, without the calls made before the fork
+        assert get_calls("preloaded_function") == 0
+        preloaded_function()
+        assert get_calls("preloaded_function") == 1
+
+    assert run_in_child(check) == 0
+    assert isinstance(get_tracker(), TemporaryTracker)
+
+
+def test_fork_while_a_metric_lock_is_held():
+    """Test that a child forked while another thread holds a lock of the metrics does
+    not deadlock when it creates its tracker."""
+    init(tracker="prometheus")
+    forked_function()
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with PrometheusTracker.prom_counter._lock:
+            locked.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    locked.wait()
+    try:
+
+        def check():
+            forked_function()
+            assert get_calls("forked_function") == 1
+
+        assert run_in_child(check) == 0
+    finally:
+        release.set()
+        thread.join()
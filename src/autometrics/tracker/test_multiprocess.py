@@ -0,0 +1,192 @@
+import os
+import pytest
+
+from prometheus_client.exposition import generate_latest
+
+from . import multiprocess
+from .multiprocess import (
+    HEADER_SIZE,
+    MultiprocessAccumulator,
+    MultiprocessFunctionMetrics,
+    WorkerValues,
+    read_values,
+)
+from .prometheus import PrometheusTracker, use_collector
+from .tracker import get_tracker
+from ..initialization import init
+
+
+def test_workers_are_merged_and_retired(tmp_path):
+    """Test that the calls of forked workers add up, and the files of exited workers are retired."""
+    accumulator = MultiprocessAccumulator(str(tmp_path), [0.1, 1.0])
+    metrics = MultiprocessFunctionMetrics(
+        accumulator,
+        ("function", "module", "service", "", ""),
+        ("function", "module", "service", "", "", ""),
+        1.0,
+    )
+    metrics.finish(0.5, "", "")
+
+    pids = []
+    for _ in range(3):
+        pid = os.fork()
+        if pid == 0:
+            for _ in range(100):
+                metrics.finish(0.05, "", "")
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    total = accumulator.merged()
+    ok = ("function", "module", "service", "ok", "", "", "", "")
+    error = ("function", "module", "service", "error", "", "", "", "")
+    assert total.counts == {ok: 301.0, error: 0.0}
+    assert total.histograms[
+        ("function", "module", "service", "", "", "")
+    ] == pytest.approx([300.0, 1.0, 0.0, 300 * 0.05 + 0.5])
+    # Only the file of this process is left, the others were folded into the retired file
+    assert sorted(os.listdir(tmp_path)) == [
+        "merge.lock",
+        "retired.db",
+        "series.idx",
+        f"worker_{os.getpid()}.db",
+    ]
+    assert accumulator.merged().counts == total.counts
+
+
+def test_worker_values_grow(tmp_path):
+    """Test that the values are kept when the file grows, and the previous map is closed."""
+    path = str(tmp_path / "worker.db")
+    values = WorkerValues(path)
+    values.reserve(4)
+    values.add_many(1, [1.0, 2.0, 3.0])
+    previous = values._mmap
+    values.reserve(10000)
+    assert previous is not None and previous.closed
+    values.add(9999, 5.0)
+    values.add_many(2, [1.0, 1.0])
+    # The file starts with the number of writes
+    assert list(read_values(path, HEADER_SIZE + 5)) == [3.0, 0.0, 1.0, 3.0, 4.0, 0.0]
+    assert read_values(path, HEADER_SIZE + 10000)[HEADER_SIZE + 9999] == 5.0
+    values.close()
+
+
+def test_worker_liveness_is_its_lock(tmp_path):
+    """Test that the file of a worker is only retired once its process no longer holds
+    the lock on it, whatever its name says about the pid."""
+    accumulator = MultiprocessAccumulator(str(tmp_path), [0.1, 1.0])
+    metrics = MultiprocessFunctionMetrics(
+        accumulator,
+        ("function", "module", "service", "", ""),
+        ("function", "module", "service", "", "", ""),
+        1.0,
+    )
+    ok = ("function", "module", "service", "ok", "", "", "", "")
+    metrics.finish(0.5, "", "")
+    started_read, started_write = os.pipe()
+    exit_read, exit_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        metrics.finish(0.5, "", "")
+        os.write(started_write, b"x")
+        os.read(exit_read, 1)
+        os._exit(0)
+    try:
+        os.read(started_read, 1)
+        # The file of a process that exited, named after a process that is alive
+        values = WorkerValues(str(tmp_path / "worker_1.db"))
+        values.reserve(accumulator._index.size)
+        values.add(accumulator.counter_offset(ok), 1.0)
+        values.close()
+
+        assert accumulator.merged().counts[ok] == 3.0
+        assert f"worker_{pid}.db" in os.listdir(tmp_path)
+        assert "worker_1.db" not in os.listdir(tmp_path)
+    finally:
+        os.write(exit_write, b"x")
+        os.waitpid(pid, 0)
+        for fd in [started_read, started_write, exit_read, exit_write]:
+            os.close(fd)
+    assert accumulator.merged().counts[ok] == 3.0
+    assert f"worker_{pid}.db" not in os.listdir(tmp_path)
+
+
+def test_merge_only_reads_changed_files(monkeypatch, tmp_path):
+    """Test that a merge only reads the worker files that were written since the last
+    merge, and keeps the totals."""
+    accumulator = MultiprocessAccumulator(str(tmp_path), [0.1, 1.0])
+    metrics = MultiprocessFunctionMetrics(
+        accumulator,
+        ("function", "module", "service", "", ""),
+        ("function", "module", "service", "", "", ""),
+        1.0,
+    )
+    metrics.finish(0.5, "", "")
+    pid = os.fork()
+    if pid == 0:
+        metrics.finish(0.5, "", "")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    ok = ("function", "module", "service", "ok", "", "", "", "")
+    assert accumulator.merged().counts[ok] == 2.0
+
+    reads = []
+    read_fd = multiprocess.read_fd
+    monkeypatch.setattr(
+        multiprocess,
+        "read_fd",
+        lambda fd, size, start=0: reads.append(start) or read_fd(fd, size, start),
+    )
+    assert accumulator.merged().counts[ok] == 2.0
+    # Only the numbers of writes were read
+    assert reads == [0]
+    metrics.finish(None, "", "")
+    assert accumulator.merged().counts[ok] == 3.0
+    assert reads == [0, 0, HEADER_SIZE]
+
+
+def test_multiprocess_batch(tmp_path):
+    """Test that a batch is written to the buckets and the sum of the histogram."""
+    accumulator = MultiprocessAccumulator(str(tmp_path), [0.1, 1.0])
+    metrics = MultiprocessFunctionMetrics(
+        accumulator,
+        ("function", "module", "service", "", ""),
+        ("function", "module", "service", "", "", ""),
+        1.0,
+    )
+    metrics.finish_many([0.05, 0.5, 2.0, None], "", "", [True, True, True, False])
+    total = accumulator.merged()
+    assert total.histograms[
+        ("function", "module", "service", "", "", "")
+    ] == pytest.approx([1.0, 1.0, 1.0, 2.55])
+    assert sum(total.counts.values()) == 4
+
+
+def test_multiprocess_prometheus_exposition(monkeypatch, tmp_path):
+    """Test that the merged metrics are exposed with the usual names and labels."""
+    monkeypatch.setenv("AUTOMETRICS_TRACKER", "prometheus")
+    init(multiprocess_dir=str(tmp_path))
+    try:
+        tracker = get_tracker()
+        assert isinstance(tracker, PrometheusTracker)
+        metrics = tracker.register_function("multiprocess_function", "module")
+        assert isinstance(metrics, MultiprocessFunctionMetrics)
+        pid = os.fork()
+        if pid == 0:
+            metrics.finish(0.01, "caller_module", "caller_function")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        metrics.finish(0.01, "caller_module", "caller_function")
+
+        data = generate_latest().decode("utf-8")
+        assert (
+            """function_calls_total{caller_function="caller_function",caller_module="caller_module",function="multiprocess_function",module="module",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 2.0"""
+            in data
+        )
+        assert (
+            """function_calls_duration_seconds_count{function="multiprocess_function",module="module",objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"} 2.0"""
+            in data
+        )
+    finally:
+        use_collector(None)
@@ -0,0 +1,80 @@
+import threading
+
+from prometheus_client.exposition import generate_latest
+
+from .prometheus import PrometheusTracker, use_collector
+from .sharded import ShardedAccumulator, ShardedFunctionMetrics, cumulative_buckets
+from .tracker import get_tracker
+from .types import Result
+
+from ..initialization import init
+
+
+def test_sharded_counts_are_exact():
+    """Test that the calls counted by many threads add up when the shards are merged."""
+    accumulator = ShardedAccumulator([0.1, 1.0])
+    metrics = ShardedFunctionMetrics(
+        accumulator,
+        ("function", "module", "service", "", ""),
+        ("function", "module", "service", "", "", ""),
+        1.0,
+    )
+
+    def work():
+        for _ in range(1000):
+            metrics.finish(0.5, "", "")
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # merging while the threads are running should not lose any calls
+    accumulator.merged()
+    for thread in threads:
+        thread.join()
+
+    total = accumulator.merged()
+    ok = ("function", "module", "service", "ok", "", "", "", "")
+    error = ("function", "module", "service", "error", "", "", "", "")
+    assert total.counts == {ok: 8000, error: 0}
+    histogram = total.histograms[("function", "module", "service", "", "", "")]
+    assert list(cumulative_buckets(accumulator.buckets, histogram)) == [
+        (0.1, 0.0),
+        (1.0, 8000.0),
+        (float("inf"), 8000.0),
+    ]
+    assert histogram[-1] == 4000.0
+    # the shards of the threads that exited are retired
+    assert accumulator._shards == []
+
+
+def test_sharded_prometheus_exposition(monkeypatch):
+    """Test that the sharded metrics are exposed with the usual names and labels."""
+    monkeypatch.setenv("AUTOMETRICS_TRACKER", "prometheus")
+    init(thread_sharding=True)
+    try:
+        tracker = get_tracker()
+        assert isinstance(tracker, PrometheusTracker)
+        metrics = tracker.register_function("sharded_function", "sharded_module")
+        assert isinstance(metrics, ShardedFunctionMetrics)
+        metrics.finish(0.01, "caller_module", "caller_function")
+        metrics.finish(None, "", "", Result.ERROR)
+
+        data = generate_latest().decode("utf-8")
+        assert (
+            """function_calls_total{caller_function="caller_function",caller_module="caller_module",function="sharded_function",module="sharded_module",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 1.0"""
+            in data
+        )
+        assert (
+            """function_calls_total{caller_function="",caller_module="",function="sharded_function",module="sharded_module",objective_name="",objective_percentile="",result="error",service_name="autometrics"} 1.0"""
+            in data
+        )
+        assert (
+            """function_calls_duration_seconds_bucket{function="sharded_function",le="+Inf",module="sharded_module",objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"} 1.0"""
+            in data
+        )
+        assert (
+            """function_calls_duration_seconds_count{function="sharded_function",module="sharded_module",objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"} 1.0"""
+            in data
+        )
+    finally:
+        use_collector(None)
@@ -0,0 +1,136 @@
+import threading
+
+import pytest
+
+from prometheus_client import REGISTRY
+from prometheus_client.exposition import generate_latest
+
+from .temporary import BUCKETS, TemporaryTracker
+from .tracker import get_tracker
+from .types import Result
+from ..initialization import init
+from ..objectives import Objective, ObjectiveLatency, ObjectivePercentile
+
+
+def test_calls_before_init_are_aggregated_and_replayed():
+    """Test that calls made from many threads before init() are replayed exactly."""
+    temporary_tracker = get_tracker()
+    assert isinstance(temporary_tracker, TemporaryTracker)
+    metrics = temporary_tracker.register_function(
+        "early_function", "autometrics.tracker.test_temporary"
+    )
+
+    def work():
+        for _ in range(1000):
+            metrics.finish(0.1, "", "")
+            metrics.finish(None, "", "", Result.ERROR)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The calls are aggregated per series instead of queued one by one
+    assert len(metrics._series) == 2  # type: ignore
+
+    init(tracker="prometheus")
+    # Calls after the replay are passed on to the new tracker
+    metrics.finish(2.0, "", "")
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    labels = (
+        """function="early_function",module="autometrics.tracker.test_temporary\""""
+    )
+    ok_count = f"""function_calls_total{{caller_function="",caller_module="",{labels},objective_name="",objective_percentile="",result="ok",service_name="autometrics"}} 4001.0"""
+    assert ok_count in data
+    error_count = f"""function_calls_total{{caller_function="",caller_module="",{labels},objective_name="",objective_percentile="",result="error",service_name="autometrics"}} 4000.0"""
+    assert error_count in data
+    bucket = f"""function_calls_duration_seconds_bucket{{{labels.replace(',module', ',le="0.1",module')},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 4000.0"""
+    assert bucket in data
+    duration_count = f"""function_calls_duration_seconds_count{{{labels},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 4001.0"""
+    assert duration_count in data
+
+
+def test_calls_before_init_keep_the_buckets_of_the_objective():
+    """Test that calls made before init() are aggregated in the buckets of the function,
+    so they are replayed in the buckets they belong in."""
+    objective = Objective(
+        "early", latency=(ObjectiveLatency.Ms250, ObjectivePercentile.P99)
+    )
+    temporary_tracker = get_tracker()
+    assert isinstance(temporary_tracker, TemporaryTracker)
+    metrics = temporary_tracker.register_function(
+        "early_objective_function", __name__, objective
+    )
+    metrics.finish(0.2, "", "")
+    metrics.finish(0.24, "", "")
+
+    init(tracker="prometheus")
+    buckets = {
+        sample.labels["le"]: sample.value
+        for metric in REGISTRY.collect()
+        for sample in metric.samples
+        if sample.name == "function_calls_duration_seconds_bucket"
+        and sample.labels["function"] == "early_objective_function"
+    }
+    assert buckets["0.225"] == 1.0
+    assert buckets["0.25"] == 2.0
+
+
+class BucketRecorder:
+    """Records the calls that are replayed on it."""
+
+    def __init__(self):
+        self.starts = 0
+        self.updates = []
+
+    def register_function(self, *args):
+        return self
+
+    def start(self):
+        self.starts += 1
+
+    def add_bucketed(self, *args):
+        self.updates.append(args)
+
+
+def test_calls_before_init_are_replayed_by_bucket():
+    """Test that many calls made before init() are replayed with one update per series,
+    with the counts and sums of its buckets, and that the calls still in flight are
+    started again."""
+    metrics = TemporaryTracker().register_function(
+        "many_calls", __name__, track_concurrency=True
+    )
+    for _ in range(100_002):
+        metrics.start()
+    for _ in range(100_000):
+        metrics.finish(0.02, "", "")
+    metrics.finish_many([0.3, None], "", "", [Result.ERROR, Result.ERROR])
+
+    recorder = BucketRecorder()
+    metrics.replay(recorder)  # type: ignore
+    assert recorder.starts == 0
+    assert len(recorder.updates) == 2
+    error, ok = sorted(recorder.updates, key=lambda update: update[2].value)
+    caller_module, caller_function, result, untimed, bounds, counts, sums = error
+    assert (result, untimed, list(bounds)) == (Result.ERROR, 1, BUCKETS)
+    assert sum(counts) == 1 and counts[BUCKETS.index(0.5)] == 1
+    assert sum(sums) == pytest.approx(0.3)
+    _, _, result, untimed, _, counts, sums = ok
+    assert (result, untimed) == (Result.OK, 0)
+    assert counts[BUCKETS.index(0.025)] == 100_000 and sum(counts) == 100_000
+    assert sums[BUCKETS.index(0.025)] == pytest.approx(2000.0)
+
+    # Calls that were started but had not finished at the replay finish afterwards
+    metrics = TemporaryTracker().register_function(
+        "in_flight", __name__, track_concurrency=True
+    )
+    metrics.start()
+    metrics.start()
+    metrics.finish(0.02, "", "")
+    recorder = BucketRecorder()
+    metrics.replay(recorder)  # type: ignore
+    assert recorder.starts == 1
@@ -1,10 +1,28 @@
 import pytest
 
+from bisect import bisect_left
+
+from opentelemetry.context import get_current
+from opentelemetry.exporter import prometheus as prometheus_exporter
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics._internal.measurement import Measurement
+from opentelemetry.sdk.metrics._internal.view import _default_reservoir_factory
+from opentelemetry.sdk.metrics.view import ExplicitBucketHistogramAggregation
+from prometheus_client import REGISTRY
 from prometheus_client.exposition import generate_latest
 
-from .opentelemetry import OpenTelemetryTracker
-from .prometheus import PrometheusTracker
-from .tracker import get_tracker
+from .batch import bucket_counts
+from .opentelemetry import (
+    FunctionBucketAggregation,
+    FunctionExponentialAggregation,
+    OpenTelemetryTracker,
+    OpenTelemetryFunctionMetrics,
+    PrometheusExemplarReader,
+)
+from .prometheus import PrometheusTracker, PrometheusFunctionMetrics, use_collector
+from .temporary import BUCKETS, TemporaryFunctionMetrics
+from .tracker import FunctionHandle, get_tracker
+from .types import Result
 
 from ..initialization import init
 
@@ -54,7 +72,7 @@ def test_init_prometheus_tracker_set_build_info(monkeypatch):
     assert blob is not None
     data = blob.decode("utf-8")
 
-    prom_build_info = f"""build_info{{autometrics_version="1.0.0",branch="{branch}",commit="{commit}",repository_provider="github",repository_url="git@github.com:autometrics-dev/autometrics-py.git",service_name="autometrics",version="{version}"}} 1.0"""
+    prom_build_info = f"""build_info{{autometrics_sample_rate="1.0",autometrics_version="1.0.0",branch="{branch}",commit="{commit}",repository_provider="github",repository_url="git@github.com:autometrics-dev/autometrics-py.git",service_name="autometrics",version="{version}"}} 1.0"""
     assert prom_build_info in data
 
     monkeypatch.delenv("AUTOMETRICS_VERSION", raising=False)
@@ -87,10 +105,247 @@ def test_init_otel_tracker_set_build_info(monkeypatch):
     assert blob is not None
     data = blob.decode("utf-8")
 
-    otel_build_info = f"""build_info{{autometrics_version="1.0.0",branch="{branch}",commit="{commit}",repository_provider="github",repository_url="git@github.com:autometrics-dev/autometrics-py.git",service_name="autometrics",version="{version}"}} 1.0"""
+    otel_build_info = f"""build_info{{autometrics_sample_rate="1.0",autometrics_version="1.0.0",branch="{branch}",commit="{commit}",repository_provider="github",repository_url="git@github.com:autometrics-dev/autometrics-py.git",service_name="autometrics",version="{version}"}} 1.0"""
     assert otel_build_info in data
 
     monkeypatch.delenv("AUTOMETRICS_VERSION", raising=False)
     monkeypatch.delenv("AUTOMETRICS_COMMIT", raising=False)
     monkeypatch.delenv("AUTOMETRICS_BRANCH", raising=False)
     monkeypatch.delenv("AUTOMETRICS_TRACKER", raising=False)
+
+
+def test_function_handle_follows_tracker():
+    """Test that a function handle created before init() is bound to the tracker created by init()."""
+    handle = FunctionHandle("handle_function", "autometrics.tracker.test_tracker")
+    assert isinstance(handle.metrics(), TemporaryFunctionMetrics)
+
+    init(tracker="prometheus")
+
+    metrics = handle.metrics()
+    assert isinstance(metrics, PrometheusFunctionMetrics)
+    assert handle.metrics() is metrics
+
+    metrics.finish(0.1, "caller_module", "caller_function")
+    metrics.finish(0.1, "caller_module", "caller_function")
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    total_count = """function_calls_total{caller_function="caller_function",caller_module="caller_module",function="handle_function",module="autometrics.tracker.test_tracker",objective_name="",objective_percentile="",result="ok",service_name="autometrics"} 2.0"""
+    assert total_count in data
+
+
+def test_opentelemetry_function_metrics():
+    """Test that the OpenTelemetry tracker reuses the function metrics and their attributes."""
+    init(tracker="opentelemetry")
+    tracker = get_tracker()
+
+    metrics = tracker.register_function(
+        "otel_function", "autometrics.tracker.test_tracker"
+    )
+    assert isinstance(metrics, OpenTelemetryFunctionMetrics)
+    assert (
+        tracker.register_function("otel_function", "autometrics.tracker.test_tracker")
+        is metrics
+    )
+
+    metrics.finish(0.1, "caller_module", "caller_function", Result.ERROR)
+    metrics.finish(0.1, "caller_module", "caller_function", Result.ERROR)
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    total_count = """function_calls_total{caller_function="caller_function",caller_module="caller_module",function="otel_function",module="autometrics.tracker.test_tracker",objective_name="",objective_percentile="",result="error",service_name="autometrics"} 2.0"""
+    assert total_count in data
+
+
+@pytest.mark.parametrize("tracker", ["prometheus", "opentelemetry"])
+def test_finish_many(tracker):
+    """Test that a batch of calls is recorded like the same calls made one by one."""
+    init(tracker=tracker)
+    metrics = get_tracker().register_function(
+        f"batch_function_{tracker}", "autometrics.tracker.test_tracker"
+    )
+
+    metrics.finish_many(
+        [0.01, 0.2, None],
+        "caller_module",
+        "caller_function",
+        [Result.OK, Result.ERROR, Result.OK],
+    )
+    assert (metrics.calls, metrics.timed_calls) == (3, 2)
+    with pytest.raises(ValueError):
+        metrics.finish_many([0.1], "caller_module", "caller_function", [])
+
+    blob = generate_latest()
+    assert blob is not None
+    data = blob.decode("utf-8")
+
+    labels = f"""function="batch_function_{tracker}",module="autometrics.tracker.test_tracker\""""
+    ok_count = f"""function_calls_total{{caller_function="caller_function",caller_module="caller_module",{labels},objective_name="",objective_percentile="",result="ok",service_name="autometrics"}} 2.0"""
+    assert ok_count in data
+    error_count = f"""function_calls_total{{caller_function="caller_function",caller_module="caller_module",{labels},objective_name="",objective_percentile="",result="error",service_name="autometrics"}} 1.0"""
+    assert error_count in data
+    bucket = f"""function_calls_duration_seconds_bucket{{{labels.replace(',module', ',le="0.01",module')},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 1.0"""
+    assert bucket in data
+    duration_count = f"""function_calls_duration_seconds_count{{{labels},objective_latency_threshold="",objective_name="",objective_percentile="",service_name="autometrics"}} 2.0"""
+    assert duration_count in data
+
+
+def get_histogram(function: str):
+    """Get the exposed histogram samples of a function, by name and bucket."""
+    samples = {}
+    for metric in REGISTRY.collect():
+        if metric.type != "histogram":
+            continue
+        for sample in metric.samples:
+            if sample.labels.get("function") == function:
+                samples[(sample.name, sample.labels.get("le"))] = sample.value
+    return samples
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"exponential_histograms": True}, {"thread_sharding": True}],
+    ids=["explicit", "exponential", "sharded"],
+)
+def test_opentelemetry_finish_many(options):
+    """Test that the OpenTelemetry tracker records a batch of durations with a single
+    measurement, that the aggregation adds like the durations recorded one by one."""
+    init(tracker="opentelemetry", **options)
+    try:
+        tracker = get_tracker()
+        one_by_one = tracker.register_function("one_by_one", __name__)
+        batch = tracker.register_function("batch", __name__)
+        durations = [0.0, 0.0, 0.001, 0.001, 0.002, 0.05, 0.05, 0.3, 1.2, 7.0] * 20
+
+        for duration in durations:
+            one_by_one.finish(duration, "", "")
+        recorded = []
+        if isinstance(batch, OpenTelemetryFunctionMetrics):
+            record = batch._histogram_record
+            batch._histogram_record = lambda *args: recorded.append(record(*args))
+        else:
+            record = batch._record_duration
+            batch._record_duration = lambda *args: recorded.append(record(*args))
+        batch.finish_many(durations, "", "")
+
+        assert len(recorded) == 1
+        expected = get_histogram("one_by_one")
+        assert expected[("function_calls_duration_seconds_count", None)] == 200
+        actual = get_histogram("batch")
+        assert actual.keys() == expected.keys()
+        for key, value in expected.items():
+            assert actual[key] == pytest.approx(value)
+    finally:
+        use_collector(None)
+
+
+@pytest.mark.parametrize(
+    "tracker, options",
+    [
+        ("prometheus", {}),
+        ("prometheus", {"thread_sharding": True}),
+        ("opentelemetry", {}),
+        ("opentelemetry", {"exponential_histograms": True}),
+        ("opentelemetry", {"thread_sharding": True}),
+    ],
+    ids=[
+        "prometheus",
+        "prometheus-sharded",
+        "opentelemetry",
+        "opentelemetry-exponential",
+        "opentelemetry-sharded",
+    ],
+)
+@pytest.mark.parametrize("bounds", [BUCKETS, [0.01, 1.0]], ids=["same", "other"])
+def test_add_bucketed(tracker, options, bounds):
+    """Test that calls added by histogram bucket are recorded like the same calls made
+    one by one, with the bucket bounds of the function or other ones."""
+    init(tracker=tracker, **options)
+    try:
+        one_by_one = get_tracker().register_function("one_by_one_bucketed", __name__)
+        bucketed = get_tracker().register_function("bucketed", __name__)
+        durations = [0.002] * 3 + [0.3] * 4 + [5.0] * 2
+        for duration in durations + [None, None]:
+            one_by_one.finish(duration, "", "", Result.ERROR)
+
+        counts = bucket_counts(bounds, durations)
+        sums = [0.0] * len(counts)
+        for duration in durations:
+            sums[bisect_left(bounds, duration)] += duration
+        bucketed.add_bucketed("", "", Result.ERROR, 2, bounds, counts, sums)
+
+        assert (bucketed.calls, bucketed.timed_calls) == (11, 9)
+        assert bucketed.timed_duration == pytest.approx(11.206)
+        expected = get_histogram("one_by_one_bucketed")
+        actual = get_histogram("bucketed")
+        assert actual.keys() == expected.keys()
+        for key, value in expected.items():
+            assert actual[key] == pytest.approx(value)
+        data = generate_latest().decode("utf-8")
+        assert (
+            f"""function_calls_total{{caller_function="",caller_module="",function="bucketed",module="{__name__}",objective_name="",objective_percentile="",result="error",service_name="autometrics"}} 11.0"""
+            in data
+        )
+    finally:
+        use_collector(None)
+
+
+def test_opentelemetry_private_api():
+    """Test that the private attributes of the OpenTelemetry SDK and Prometheus exporter
+    that the OpenTelemetry tracker relies on still exist. They are not covered by the
+    versioning of these packages, so an upgrade of the pinned versions can drop them."""
+    assert callable(
+        getattr(ExplicitBucketHistogramAggregation, "_create_aggregation", None)
+    ), "FunctionBucketAggregation needs ExplicitBucketHistogramAggregation._create_aggregation"
+
+    # The aggregations add a batch of durations to the state of the SDK aggregation
+    histogram = MeterProvider().get_meter(__name__).create_histogram("histogram")
+    explicit = FunctionBucketAggregation([0.1, 1.0], {})._create_aggregation(
+        histogram, {}, _default_reservoir_factory, 0
+    )
+    for name in [
+        "_lock",
+        "_value",
+        "_get_empty_bucket_counts",
+        "_sum",
+        "_min",
+        "_max",
+        "_record_min_max",
+        "_boundaries",
+        "_sample_exemplar",
+    ]:
+        assert hasattr(
+            explicit, name
+        ), f"aggregate_buckets needs the {name} attribute of the explicit bucket aggregation"
+    exponential = FunctionExponentialAggregation()._create_aggregation(
+        histogram, {}, _default_reservoir_factory, 0
+    )
+    exponential.aggregate(Measurement(0.5, 0, histogram, get_current(), {}), False)
+    for name in ["_lock", "_mapping", "_count", "_zero_count", "_sum", "_max"]:
+        assert hasattr(
+            exponential, name
+        ), f"aggregate_exponential_buckets needs the {name} attribute of the exponential bucket aggregation"
+    for name in ["map_to_index", "get_lower_boundary"]:
+        assert callable(getattr(exponential._mapping, name, None))
+    for name in ["index_start", "index_end", "index_base", "counts"]:
+        assert hasattr(exponential._value_positive, name)
+    assert callable(getattr(exponential._value_positive, "increment_bucket", None))
+
+    reader = PrometheusExemplarReader()
+    collector = getattr(reader, "_collector", None)
+    assert (
+        collector is not None
+    ), "PrometheusExemplarReader needs the _collector of the reader"
+    try:
+        for name in ["collect", "_sanitize", "_check_value"]:
+            assert callable(
+                getattr(collector, name, None)
+            ), f"PrometheusExemplarReader needs the {name} method of the exporter collector"
+        assert collector._sanitize("function.name") == "function_name"
+        assert collector._check_value(1) == "1"
+    finally:
+        prometheus_exporter.REGISTRY.unregister(collector)
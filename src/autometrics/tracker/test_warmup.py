@@ -0,0 +1,115 @@
+import json
+
+from random import Random
+
+import pytest
+
+from prometheus_client import REGISTRY
+
+from .exponential import ExponentialHistogram
+from .prometheus import use_collector
+from .tracker import get_tracker
+from .warmup import BucketCache, WarmupFunctionMetrics, learn_buckets
+
+from ..initialization import init
+
+
+def get_samples(function: str, name: str):
+    """Get the samples of a metric of a function."""
+    return [
+        sample
+        for metric in REGISTRY.collect()
+        for sample in metric.samples
+        if sample.name == name and sample.labels["function"] == function
+    ]
+
+
+def test_learn_buckets():
+    """Test that the buckets cover the durations, with the given relative error."""
+    sketch = ExponentialHistogram()
+    durations = Random(0)
+    for _ in range(1000):
+        sketch.observe(durations.lognormvariate(-7, 0.5))
+
+    buckets = learn_buckets(sketch, relative_error=0.1)
+    assert buckets is not None
+    bounds = sketch.buckets()[0]
+    assert buckets[0] < bounds[0] and bounds[-1] < buckets[-1]
+    for lower, upper in zip(buckets, buckets[1:]):
+        # Rounding the boundaries changes their ratio a little
+        assert upper / lower <= 1.1 / 0.9 * 1.02
+    assert learn_buckets(ExponentialHistogram()) is None
+    assert len(learn_buckets(sketch, relative_error=0.001)) == 40  # type: ignore
+
+
+@pytest.mark.parametrize("tracker", ["prometheus", "opentelemetry"])
+def test_warmup(tracker, tmp_path):
+    """Test that a function gets buckets learned from its first calls, and that they
+    are kept in the cache file."""
+    cache_file = tmp_path / "buckets.json"
+    init(tracker=tracker, warmup_calls=100, bucket_cache_file=str(cache_file))
+    function = f"warmup_{tracker}"
+    try:
+        metrics = get_tracker().register_function(function, __name__)
+        assert isinstance(metrics, WarmupFunctionMetrics)
+        for _ in range(100):
+            metrics.finish(0.0002, "", "")
+        assert not metrics.warming_up
+        metrics.finish(0.0003, "", "")
+
+        buckets = json.loads(cache_file.read_text())[f"{__name__}.{function}"]
+        assert buckets[0] <= 0.0001 and 0.0003 <= buckets[-1] < 0.01
+        bounds = [
+            float(sample.labels["le"])
+            for sample in get_samples(
+                function, "function_calls_duration_seconds_bucket"
+            )
+        ]
+        assert bounds == [*buckets, float("inf")]
+        # The warm-up calls are counted, but only the calls that follow are in the histogram
+        [count] = get_samples(function, "function_calls_duration_seconds_count")
+        assert count.value == 1
+        [calls] = [
+            sample
+            for sample in get_samples(function, "function_calls_total")
+            if sample.labels["result"] == "ok"
+        ]
+        assert calls.value == 101
+        assert metrics.calls == 101 and metrics.timed_calls == 101
+    finally:
+        use_collector(None)
+
+
+def test_warmup_cached_buckets(tmp_path):
+    """Test that functions with cached buckets skip the warm-up."""
+    cache_file = tmp_path / "buckets.json"
+    BucketCache(str(cache_file)).set("cached_function", __name__, (0.001, 0.002))
+    init(tracker="prometheus", warmup_seconds=60, bucket_cache_file=str(cache_file))
+    try:
+        metrics = get_tracker().register_function("cached_function", __name__)
+        assert not isinstance(metrics, WarmupFunctionMetrics)
+        metrics.finish(0.0015, "", "")
+        buckets = get_samples(
+            "cached_function", "function_calls_duration_seconds_bucket"
+        )
+        assert [(sample.labels["le"], sample.value) for sample in buckets] == [
+            ("0.001", 0.0),
+            ("0.002", 1.0),
+            ("+Inf", 1.0),
+        ]
+    finally:
+        use_collector(None)
+
+
+def test_warmup_seconds():
+    """Test that the warm-up ends after the given time, even with few calls."""
+    init(tracker="prometheus", warmup_seconds=0.0)
+    try:
+        metrics = get_tracker().register_function("warmup_seconds", __name__)
+        assert isinstance(metrics, WarmupFunctionMetrics)
+        metrics.finish(None, "", "")
+        # Without any timed calls, the function keeps the buckets of the settings
+        assert not metrics.warming_up
+        assert metrics.finish == metrics.metrics.finish
+    finally:
+        use_collector(None)
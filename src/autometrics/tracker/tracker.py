@@ -1,13 +1,24 @@
-from typing import Optional, cast
-from opentelemetry.sdk.metrics.export import MetricReader
+import os
+import threading
 
-from .types import TrackerType, TrackMetrics
+from typing import TYPE_CHECKING, Optional, Tuple, cast
+
+from .adaptive import OverheadController
+from .background import BackgroundTracker
+from .types import FunctionMetrics, TrackerType, TrackMetrics
 from .temporary import TemporaryTracker
-from ..exposition import create_exporter
-from ..settings import AutometricsSettings
+from ..objectives import Objective
+from ..settings import SettingsSnapshot
+from ..slo import EvaluatedFunctionMetrics
+
+if TYPE_CHECKING:
+    from opentelemetry.sdk.metrics.export import MetricReader
 
 
 _tracker: TrackMetrics = TemporaryTracker()
+_controller: Optional[OverheadController] = None
+_settings: Optional[SettingsSnapshot] = None
+"""The settings the tracker was created with, or that forked processes create it with."""
 
 
 def get_tracker() -> TrackMetrics:
@@ -22,33 +33,198 @@ def set_tracker(new_tracker: TrackMetrics):
     _tracker = new_tracker
 
 
+def get_controller() -> Optional[OverheadController]:
+    """Get the overhead controller, if an overhead budget is configured."""
+    return _controller
+
+
+class FunctionHandle:
+    """Handle to the metrics of a decorated function.
+
+    The labels are resolved once per tracker, so a call only costs a lookup of the
+    current tracker. When the tracker changes (e.g. after `init()` replaces the
+    temporary tracker), the handle is bound to the new tracker on the next call."""
+
+    __slots__ = (
+        "function",
+        "module",
+        "objective",
+        "track_concurrency",
+        "sample_rate",
+        "buckets",
+        "_binding",
+    )
+
+    def __init__(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ):
+        self.function = function
+        self.module = module
+        self.objective = objective
+        self.track_concurrency = track_concurrency
+        self.sample_rate = sample_rate
+        self.buckets = buckets
+        self._binding: Optional[Tuple[TrackMetrics, FunctionMetrics]] = None
+        self.metrics()
+
+    def metrics(self) -> FunctionMetrics:
+        """Get the metrics of the function for the current tracker."""
+        binding = self._binding
+        if binding is None or binding[0] is not _tracker:
+            tracker = _tracker
+            metrics = tracker.register_function(
+                self.function,
+                self.module,
+                self.objective,
+                self.track_concurrency,
+                self.sample_rate,
+                self.buckets,
+            )
+            objective = self.objective
+            if objective is not None and objective.evaluator is not None:
+                metrics = EvaluatedFunctionMetrics(metrics, objective.evaluator)
+            binding = self._binding = (tracker, metrics)
+        return binding[1]
+
+
 def init_tracker(
-    tracker_type: TrackerType, settings: AutometricsSettings
+    tracker_type: TrackerType, settings: SettingsSnapshot, forked: bool = False
 ) -> TrackMetrics:
     """Create a tracker"""
+    global _settings
+    _settings = settings
 
+    # The backends (and their dependencies) are only imported once they are selected
     tracker_instance: TrackMetrics
     if tracker_type == TrackerType.OPENTELEMETRY:
         # pylint: disable=import-outside-toplevel
         from .opentelemetry import OpenTelemetryTracker
 
-        exporter: Optional[MetricReader] = None
-        if settings["exporter"]:
-            exporter = create_exporter(settings["exporter"])
+        exporter: Optional["MetricReader"] = None
+        if settings.exporter:
+            from ..exposition import create_exporter
+
+            exporter = create_exporter(settings.exporter, forked)
         tracker_instance = OpenTelemetryTracker(exporter)
     elif tracker_type == TrackerType.PROMETHEUS:
         # pylint: disable=import-outside-toplevel
         from .prometheus import PrometheusTracker
 
-        if settings["exporter"]:
-            exporter = create_exporter(settings["exporter"])
+        if settings.exporter:
+            from ..exposition import create_exporter
+
+            create_exporter(settings.exporter, forked)
         tracker_instance = PrometheusTracker()
+    if settings.background_tracking:
+        tracker_instance = BackgroundTracker(tracker_instance)
     # NOTE - Only set the build info when the tracker is initialized
     tracker_instance.set_build_info(
-        commit=settings["commit"],
-        version=settings["version"],
-        branch=settings["branch"],
+        commit=settings.commit,
+        version=settings.version,
+        branch=settings.branch,
     )
 
+    if isinstance(_tracker, BackgroundTracker):
+        _tracker.shutdown()
     set_tracker(tracker_instance)
+
+    global _controller
+    if _controller is not None:
+        _controller.stop()
+        _controller = None
+    if settings.overhead_budget is not None:
+        _controller = OverheadController(
+            tracker_instance, overhead_budget=settings.overhead_budget
+        )
+        _controller.start()
     return tracker_instance
+
+
+def preload_tracker(settings: SettingsSnapshot):
+    """Defer the creation of the tracker to the processes that are forked from this one.
+
+    Until then, calls are aggregated on the temporary tracker. The calls of this process
+    are not reported, every forked process creates its own tracker and exporter."""
+    global _settings
+    _settings = settings
+
+
+def apply_settings(settings: SettingsSnapshot):
+    """Apply settings that were changed at runtime to the current tracker."""
+    global _settings
+    if _settings is not None:
+        _settings = settings
+    _tracker.apply_settings(settings)
+
+
+def reset_after_fork():
+    """Reset the state that a forked process inherited from its parent.
+
+    The calls that were recorded before the fork are dropped, since the parent reports them.
+    If autometrics was initialized (or preloaded), the tracker of this process is created
+    again, with its own exporter threads, when the first function is registered or called.
+    This runs automatically after `os.fork()`, and can be called from a post-fork hook on
+    platforms without `os.register_at_fork`."""
+    tracker = _tracker
+    tracker.reset_after_fork()
+    if _settings is not None:
+        set_tracker(ForkedTracker(_settings, tracker))
+
+
+class ForkedTracker(TemporaryTracker):
+    """The tracker of a forked process, until the process registers a function.
+
+    Starting threads is not safe while the process is being forked, so the tracker is
+    created the first time it is needed, and calls are passed on to it from then on."""
+
+    def __init__(self, settings: SettingsSnapshot, parent_tracker: TrackMetrics):
+        super().__init__()
+        self._settings = settings
+        self._parent_tracker = parent_tracker
+        self._init_lock = threading.Lock()
+
+    def register_function(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ) -> FunctionMetrics:
+        """Create the tracker of this process if needed, and register the function with it."""
+        if self._new_tracker is None:
+            with self._init_lock:
+                if self._new_tracker is None:
+                    # Not in the fork hook, where locks of the parent may still be held
+                    self._parent_tracker.close_after_fork()
+                    tracker = init_tracker(
+                        self._settings.tracker, self._settings, forked=True
+                    )
+                    if isinstance(self._parent_tracker, TemporaryTracker):
+                        # Initialize the functions that were registered before the fork
+                        self._parent_tracker.replay(tracker)
+                    self.replay(tracker)
+        return super().register_function(
+            function, module, objective, track_concurrency, sample_rate, buckets
+        )
+
+    def apply_settings(self, settings: SettingsSnapshot):
+        """Create the tracker with the new settings, or apply them to it if it exists."""
+        with self._init_lock:
+            self._settings = settings
+            new_tracker = self._new_tracker
+        if new_tracker is not None:
+            new_tracker.apply_settings(settings)
+
+
+# Only register the hook once, even if the module is reloaded
+if hasattr(os, "register_at_fork") and not globals().get("_fork_hook_registered"):
+    _fork_hook_registered = True
+    os.register_at_fork(after_in_child=lambda: reset_after_fork())
@@ -1,8 +1,11 @@
 from enum import Enum
-from typing import Union, Optional, Protocol, List, Literal, Tuple
+from typing import TYPE_CHECKING, Union, Optional, Protocol, List, Sequence, Tuple
 
 from ..objectives import Objective
 
+if TYPE_CHECKING:
+    from ..settings import SettingsSnapshot
+
 
 class Result(Enum):
     """Result of the function call."""
@@ -11,6 +14,70 @@ class Result(Enum):
     ERROR = "error"
 
 
+BatchResult = Union[Result, bool]
+"""The result of a call in a batch: a `Result`, or a boolean that is true for a successful call."""
+
+
+class FunctionMetrics(Protocol):
+    """Protocol for the metrics of a single function, with its labels resolved up front."""
+
+    sample_rate: float
+    """The fraction of calls for which the duration is recorded."""
+    calls: int
+    """The number of finished calls (approximate, it is not synchronized between threads)."""
+    timed_calls: int
+    """The number of finished calls for which the duration was recorded (approximate)."""
+    timed_duration: float
+    """The total duration of the timed calls in seconds (approximate)."""
+
+    def start(self):
+        """Start tracking metrics for a call to the function."""
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Finish tracking metrics for a call to the function.
+
+        The duration is None when the call was not sampled, in which case only the counter is updated.
+        """
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Finish tracking metrics for a batch of calls to the function from the same caller.
+
+        The results have the same length as the durations, without results all calls succeeded.
+        Each counter is updated once per batch.
+        """
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Add calls from the same caller and with the same result that were already
+        counted in histogram buckets.
+
+        `untimed` calls have no duration. The timed calls are counted per bucket of
+        `bounds` (with a last bucket for the calls above all bounds), with their total
+        duration per bucket. Each counter and histogram bucket is updated once. Unlike
+        `finish`, this does not end calls that were started, the concurrency is unchanged.
+        """
+
+
 class TrackMetrics(Protocol):
     """Protocol for tracking metrics."""
 
@@ -24,7 +91,7 @@ class TrackMetrics(Protocol):
 
     def finish(
         self,
-        duration: float,
+        duration: Optional[float],
         function: str,
         module: str,
         caller_module: str,
@@ -35,6 +102,19 @@ class TrackMetrics(Protocol):
     ):
         """Finish tracking metrics for a function call."""
 
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        function: str,
+        module: str,
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+    ):
+        """Finish tracking metrics for a batch of calls to a function from the same caller."""
+
     def initialize_counters(
         self,
         function: str,
@@ -43,27 +123,47 @@ class TrackMetrics(Protocol):
     ):
         """Initialize (counter) metrics for a function at zero."""
 
+    def register_function(
+        self,
+        function: str,
+        module: str,
+        objective: Optional[Objective] = None,
+        track_concurrency: Optional[bool] = False,
+        sample_rate: Optional[float] = None,
+        buckets: Optional[Tuple[float, ...]] = None,
+    ) -> FunctionMetrics:
+        """Initialize (counter) metrics for a function at zero and return a handle to its metrics.
+
+        With `buckets`, the latency histogram of the function has buckets of its own,
+        otherwise the buckets of the objective or the settings are used."""
+
+    def function_metrics(self) -> List[FunctionMetrics]:
+        """Get the metrics of all the functions registered with this tracker."""
+
+    def estimate_overhead(self, calls: int = 1000) -> float:
+        """Estimate the time (in seconds) it takes to record a timed call."""
+
+    def reset_after_fork(self):
+        """Swap in fresh state (like new locks) in a forked child, from the fork hook.
+
+        Other threads of the parent may have held locks when the process was forked, so
+        this should not acquire any. The tracker is replaced afterwards, so it does not
+        need to keep working."""
+
+    def close_after_fork(self):
+        """Drop the values inherited from the parent process, in a forked child.
+
+        This is called when the child creates its own tracker, outside of the fork hook.
+        """
+
+    def apply_settings(self, settings: "SettingsSnapshot"):
+        """Apply settings that were changed at runtime, see `update_settings`.
+
+        Functions without a sample rate of their own get the new sample rate."""
+
 
 class TrackerType(Enum):
     """Type of tracker."""
 
     OPENTELEMETRY = "opentelemetry"
     PROMETHEUS = "prometheus"
-
-
-TrackerMessage = Union[
-    Tuple[Literal["start"], str, str, Optional[bool]],
-    Tuple[
-        Literal["finish"],
-        float,
-        str,
-        str,
-        str,
-        str,
-        Result,
-        Optional[Objective],
-        Optional[bool],
-    ],
-    Tuple[Literal["initialize_counters"], str, str, Optional[Objective]],
-]
-MessageQueue = List[TrackerMessage]
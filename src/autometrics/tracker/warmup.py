@@ -0,0 +1,312 @@
+"""Histogram buckets learned from the durations of the first calls of every function."""
+import json
+import logging
+import os
+import threading
+
+from math import ceil, log
+from time import monotonic
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from ..buckets import validate_buckets
+from .batch import bucket_means, summarize_batch
+from .exponential import ExponentialHistogram
+from .types import BatchResult, FunctionMetrics, Result
+
+DEFAULT_RELATIVE_ERROR = 0.1
+MAX_LEARNED_BUCKETS = 40
+# How far the learned buckets reach below and above the durations of the warm-up
+LOW_HEADROOM = 0.5
+HIGH_HEADROOM = 4.0
+
+
+def learn_buckets(
+    sketch: ExponentialHistogram,
+    relative_error: float = DEFAULT_RELATIVE_ERROR,
+    max_buckets: int = MAX_LEARNED_BUCKETS,
+) -> Optional[Tuple[float, ...]]:
+    """Pick buckets that cover the durations of a sketch, or None if it is empty.
+
+    Every bucket is `(1 + relative_error) / (1 - relative_error)` times as wide as the
+    previous one, so the middle of a bucket is within the relative error of the durations
+    in it. When that takes more than `max_buckets` buckets, they grow faster instead. The
+    boundaries are rounded to 3 significant digits, so they read well as `le` labels."""
+    bounds, _ = sketch.buckets()
+    positive = [bound for bound in bounds if bound > 0.0]
+    if not positive:
+        return None
+    low = positive[0] * LOW_HEADROOM
+    high = positive[-1] * HIGH_HEADROOM
+    growth = (1.0 + relative_error) / (1.0 - relative_error)
+    count = ceil(log(high / low) / log(growth))
+    if count >= max_buckets:
+        count = max_buckets - 1
+        growth = (high / low) ** (1.0 / count)
+    return validate_buckets(
+        float(f"{low * growth**index:.3g}") for index in range(count + 1)
+    )
+
+
+class BucketCache:
+    """The learned buckets of the functions, by module and function name.
+
+    With a path, they are kept in a JSON file, so a function gets the same buckets after
+    a restart (and in every worker process) without warming up again."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._layouts: Optional[Dict[str, Tuple[float, ...]]] = None
+
+    def _read(self) -> Dict[str, Tuple[float, ...]]:
+        """Read the buckets from the file, if there is one."""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as file:
+                return {
+                    name: validate_buckets(bounds)
+                    for name, bounds in json.load(file).items()
+                }
+        except (OSError, ValueError, TypeError, AttributeError) as error:
+            logging.warning(
+                f"Could not read the histogram buckets from {self.path}: {error}"
+            )
+            return {}
+
+    def get(self, function: str, module: str) -> Optional[Tuple[float, ...]]:
+        """Get the learned buckets of a function."""
+        with self._lock:
+            if self._layouts is None:
+                self._layouts = self._read()
+            return self._layouts.get(f"{module}.{function}")
+
+    def set(self, function: str, module: str, buckets: Tuple[float, ...]):
+        """Keep the learned buckets of a function, and write them to the file."""
+        with self._lock:
+            # Other processes may have learned the buckets of other functions since
+            layouts = self._read()
+            layouts.update(self._layouts or {})
+            layouts[f"{module}.{function}"] = buckets
+            self._layouts = layouts
+            if not self.path:
+                return
+            try:
+                temporary_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(temporary_path, "w") as file:
+                    json.dump(
+                        {name: list(bounds) for name, bounds in layouts.items()},
+                        file,
+                        indent=2,
+                        sort_keys=True,
+                    )
+                os.replace(temporary_path, self.path)
+            except OSError as error:
+                logging.warning(
+                    f"Could not write the histogram buckets to {self.path}: {error}"
+                )
+
+
+class BucketWarmup:
+    """Warms up the functions of a tracker that have no buckets of their own."""
+
+    def __init__(
+        self,
+        calls: Optional[int] = None,
+        seconds: Optional[float] = None,
+        relative_error: float = DEFAULT_RELATIVE_ERROR,
+        cache: Optional[BucketCache] = None,
+    ):
+        self.calls = calls
+        self.seconds = seconds
+        self.relative_error = relative_error
+        self.cache = BucketCache() if cache is None else cache
+
+    def function_metrics(
+        self,
+        function: str,
+        module: str,
+        create: Callable[[Optional[Tuple[float, ...]]], FunctionMetrics],
+    ) -> FunctionMetrics:
+        """Create the metrics of a function with its learned buckets, or warm it up.
+
+        `create` creates the metrics of the function with the given buckets."""
+        buckets = self.cache.get(function, module)
+        if buckets is not None:
+            return create(buckets)
+        return WarmupFunctionMetrics(self, function, module, create)
+
+
+def create_warmup(settings: Any) -> Optional[BucketWarmup]:
+    """Create the warm-up of the settings, if it is enabled."""
+    if settings.warmup_calls is None and settings.warmup_seconds is None:
+        return None
+    return BucketWarmup(
+        settings.warmup_calls,
+        settings.warmup_seconds,
+        settings.bucket_relative_error,
+        BucketCache(settings.bucket_cache_file),
+    )
+
+
+class WarmupFunctionMetrics:
+    """Metrics of a function that learns its buckets from its first calls.
+
+    During the warm-up, the calls are counted, but their durations go into a sketch
+    instead of the histogram (like calls that are not sampled). When the warm-up is over,
+    the buckets are learned from the sketch and locked: the calls that follow are recorded
+    directly on metrics with those buckets."""
+
+    def __init__(
+        self,
+        warmup: BucketWarmup,
+        function: str,
+        module: str,
+        create: Callable[[Optional[Tuple[float, ...]]], FunctionMetrics],
+    ):
+        self.metrics = create(None)
+        """The metrics the calls are recorded on, with the learned buckets once locked."""
+        self.warming_up = True
+        self._warmup = warmup
+        self._function = function
+        self._module = module
+        self._create = create
+        self._sketch = ExponentialHistogram()
+        self._deadline = (
+            None if warmup.seconds is None else monotonic() + warmup.seconds
+        )
+        # The counts of the warm-up, which the metrics with the learned buckets lack
+        self._calls_before = 0
+        self._timed_calls = 0
+        self._timed_duration = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def sample_rate(self) -> float:
+        return self.metrics.sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, sample_rate: float):
+        self.metrics.sample_rate = sample_rate
+
+    @property
+    def calls(self) -> int:
+        return self.metrics.calls + self._calls_before
+
+    @calls.setter
+    def calls(self, calls: int):
+        self.metrics.calls = calls - self._calls_before
+
+    @property
+    def timed_calls(self) -> int:
+        return self.metrics.timed_calls + self._timed_calls
+
+    @timed_calls.setter
+    def timed_calls(self, timed_calls: int):
+        self.metrics.timed_calls = timed_calls - self._timed_calls
+
+    @property
+    def timed_duration(self) -> float:
+        return self.metrics.timed_duration + self._timed_duration
+
+    @timed_duration.setter
+    def timed_duration(self, timed_duration: float):
+        self.metrics.timed_duration = timed_duration - self._timed_duration
+
+    def start(self):
+        """Start tracking metrics for a call to the function."""
+        self.metrics.start()
+
+    def finish(
+        self,
+        duration: Optional[float],
+        caller_module: str,
+        caller_function: str,
+        result: Result = Result.OK,
+    ):
+        """Count a call, and add its duration to the sketch."""
+        self.metrics.finish(None, caller_module, caller_function, result)
+        if duration is not None:
+            self._timed_calls += 1
+            self._timed_duration += duration
+            self._sketch.observe(duration)
+        self._check_warmup()
+
+    def finish_many(
+        self,
+        durations: Sequence[Optional[float]],
+        caller_module: str,
+        caller_function: str,
+        results: Optional[Sequence[BatchResult]] = None,
+    ):
+        """Count a batch of calls, and add their durations to the sketch."""
+        _, timed, total = summarize_batch(durations, results)
+        self.metrics.finish_many(
+            [None] * len(durations), caller_module, caller_function, results
+        )
+        if len(timed):
+            self._timed_calls += len(timed)
+            self._timed_duration += total
+            self._sketch.observe_many(timed, total)
+        self._check_warmup()
+
+    def add_bucketed(
+        self,
+        caller_module: str,
+        caller_function: str,
+        result: Result,
+        untimed: int,
+        bounds: Sequence[float],
+        bucket_counts: Sequence[int],
+        bucket_sums: Sequence[float],
+    ):
+        """Count calls that were already counted in histogram buckets, and add the mean
+        duration of every bucket to the sketch."""
+        timed = sum(bucket_counts)
+        self.metrics.add_bucketed(
+            caller_module,
+            caller_function,
+            result,
+            untimed + timed,
+            bounds,
+            [0] * len(bucket_counts),
+            [0.0] * len(bucket_sums),
+        )
+        if timed:
+            total = sum(bucket_sums)
+            self._timed_calls += timed
+            self._timed_duration += total
+            means, counts = bucket_means(bounds, bucket_counts, bucket_sums)
+            self._sketch.observe_many(means, total, counts)
+        self._check_warmup()
+
+    def _check_warmup(self):
+        """Lock the buckets once enough calls were timed, or enough time has passed."""
+        warmup = self._warmup
+        if (warmup.calls is not None and self._timed_calls >= warmup.calls) or (
+            self._deadline is not None and monotonic() >= self._deadline
+        ):
+            self.lock_buckets()
+
+    def lock_buckets(self):
+        """End the warm-up: learn the buckets from the sketch, and record the calls that
+        follow on metrics with those buckets. Without timed calls, the function keeps
+        the buckets of the settings."""
+        with self._lock:
+            if not self.warming_up:
+                return
+            warmup = self._warmup
+            buckets = learn_buckets(self._sketch, warmup.relative_error)
+            metrics = self.metrics
+            if buckets is not None:
+                warmup.cache.set(self._function, self._module, buckets)
+                metrics = self._create(buckets)
+                self._calls_before = self.metrics.calls
+            self.metrics = metrics
+            self.warming_up = False
+            self._sketch = ExponentialHistogram()
+            # Skip this wrapper from now on
+            self.start = metrics.start  # type: ignore
+            self.finish = metrics.finish  # type: ignore
+            self.finish_many = metrics.finish_many  # type: ignore
+            self.add_bucketed = metrics.add_bucketed  # type: ignore
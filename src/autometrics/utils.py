@@ -2,15 +2,23 @@ import inspect
 import os
 
 from collections.abc import Callable
-from typing import Optional
+from functools import lru_cache
+from types import FrameType
+from typing import TYPE_CHECKING, Optional
 from urllib.parse import urlparse
-from prometheus_client import start_wsgi_server, REGISTRY, CollectorRegistry
 
 from .prometheus_url import Generator
 
+if TYPE_CHECKING:
+    from prometheus_client import CollectorRegistry
+
 
 def get_module_name(func: Callable) -> str:
     """Get the name of the module that contains the function."""
+    # Looking the module up with `inspect` can scan `sys.modules`, the name is usually known
+    name = getattr(func, "__module__", None)
+    if isinstance(name, str) and name != "__main__":
+        return name
     module = inspect.getmodule(func)
     if module is None or module.__name__ == "__main__":
         return get_filename_as_module(func)
@@ -19,15 +27,32 @@ def get_module_name(func: Callable) -> str:
 
 def get_filename_as_module(func: Callable) -> str:
     """Get the filename of the module that contains the function."""
+    code = getattr(func, "__code__", None)
+    if code is not None and not code.co_filename.startswith("<"):
+        return get_path_as_module(code.co_filename)
     fullpath = inspect.getsourcefile(func)
     if fullpath is None:
         return ""
+    return get_path_as_module(fullpath)
+
 
-    filename = os.path.basename(fullpath)
+@lru_cache(maxsize=None)
+def get_path_as_module(path: str) -> str:
+    """Get the filename of a path, without its extension."""
+    filename = os.path.basename(path)
     module_part = os.path.splitext(filename)[0]
     return module_part
 
 
+def get_frame_module_name(frame: FrameType) -> str:
+    """Get the name of the module that the code of a frame is running in."""
+    name = frame.f_globals.get("__name__")
+    if name is None or name == "__main__":
+        filename = os.path.basename(frame.f_code.co_filename)
+        return os.path.splitext(filename)[0]
+    return name
+
+
 def get_function_name(func: Callable) -> str:
     """Get the name of the function."""
     return func.__qualname__ or func.__name__
@@ -55,10 +80,17 @@ def append_docs_to_docstring(func, func_name, module_name):
 
 
 def start_http_server(
-    port: int = 9464, addr: str = "0.0.0.0", registry: CollectorRegistry = REGISTRY
+    port: int = 9464,
+    addr: str = "0.0.0.0",
+    registry: Optional["CollectorRegistry"] = None,
 ):
-    """Starts a WSGI server for prometheus metrics as a daemon thread."""
-    start_wsgi_server(port, addr, registry)
+    """Starts a WSGI server for prometheus metrics as a daemon thread.
+
+    The metrics of the default registry are served, unless another registry is given."""
+    # pylint: disable=import-outside-toplevel
+    from prometheus_client import REGISTRY, start_wsgi_server
+
+    start_wsgi_server(port, addr, REGISTRY if registry is None else registry)
 
 
 def read_repository_url_from_fs() -> Optional[str]: